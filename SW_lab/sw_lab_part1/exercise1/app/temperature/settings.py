@@ -25,7 +25,7 @@ Settings for the converter API
 import cherrypy
 
 # Internals
-from ..utils import jsonify_error
+from ..utils import jsonify_error, timed_json_handler, timed_json_processor
 
 # --------------------------------------------------------------------------------------------------
 
@@ -34,8 +34,21 @@ TEMPERATURE_CONFIG = {
     "/": {
         "request.dispatch": cherrypy.dispatch.MethodDispatcher(),
         "tools.sessions.on": True,
+        # Measure the latency of every request
+        "tools.timing.on": True,
+        "tools.json_in.processor": timed_json_processor,
+        "tools.json_out.handler": timed_json_handler,
         # Replace the default error handler
         "error_page.default": jsonify_error
     }
 }
 """Configuration of the Converter API"""
+
+METRICS_CONFIG = {
+    "/": {
+        "request.dispatch": cherrypy.dispatch.MethodDispatcher(),
+        # Replace the default error handler
+        "error_page.default": jsonify_error
+    }
+}
+"""Configuration of the Metrics API"""
@@ -20,9 +20,10 @@ import cherrypy
 
 # Internal
 from .temperature.api import Converter
+from .utils import Metrics
 
 # Setting
-from .temperature.settings import TEMPERATURE_CONFIG
+from .temperature.settings import TEMPERATURE_CONFIG, METRICS_CONFIG
 
 # -----------------------------------------------------------------------------
 
@@ -34,6 +35,7 @@ def start():
 
     # Mount the Endpoints
     cherrypy.tree.mount(Converter(), "/converter", TEMPERATURE_CONFIG)
+    cherrypy.tree.mount(Metrics(), "/metrics", METRICS_CONFIG)
 
     # Update Server Config
     cherrypy.config.update({"server.socket_host": "0.0.0.0"})
@@ -29,11 +29,21 @@ from cherrypy.test import helper
 
 # Internals
 from app.temperature.api import Converter
-from app.temperature.settings import TEMPERATURE_CONFIG
+from app.temperature.settings import TEMPERATURE_CONFIG, METRICS_CONFIG
+from app.utils import Metrics
 
 # ----------------------------------------------------------------------------------------------
 
 
+@cherrypy.expose
+class Broken:
+    """Endpoint that always fails with an unhandled exception"""
+
+    def GET(self):
+        """Raise an error that isn't an HTTPError"""
+        raise RuntimeError("broken")
+
+
 class TestConverter(helper.CPWebCase):
     """
     Class that handles the unittest for the Converter API, using
@@ -48,6 +58,8 @@ class TestConverter(helper.CPWebCase):
         """
         # Mount the Endpoint
         cherrypy.tree.mount(Converter(), "/converter", TEMPERATURE_CONFIG)
+        cherrypy.tree.mount(Metrics(), "/metrics", METRICS_CONFIG)
+        cherrypy.tree.mount(Broken(), "/broken", TEMPERATURE_CONFIG)
 
     def test_exercise3_put(self):
         """
@@ -200,3 +212,53 @@ class TestConverter(helper.CPWebCase):
             method="PUT", body=wrong_scale
         )
         self.assertStatus("422 Unprocessable Entity")
+
+    def test_timing(self):
+        """
+        Test the Server-Timing header and the latency summary exposed on /metrics
+        """
+        body = json.dumps(
+            {
+                "values": [10],
+                "originalUnit": "C",
+                "targetUnit": "K"
+            }
+        )
+
+        # Every phase of the request must be inside the header
+        self.getPage(
+            "/converter",
+            headers=[
+                ("Content-Type", "application/json"),
+                ("Content-Length", f"{len(body)}")
+            ],
+            method="PUT", body=body
+        )
+        self.assertStatus("200 OK")
+        server_timing = self.assertHeader("Server-Timing")
+        for phase in ("decode", "handler", "encode", "total"):
+            self.assertIn(f"{phase};dur=", server_timing)
+
+        # The request must be inside the summary
+        self.getPage("/metrics")
+        self.assertStatus("200 OK")
+        summary = json.loads(self.body)
+        self.assertIn("/converter Converter.PUT", summary)
+        self.assertEqual(
+            set(summary["/converter Converter.PUT"]["total"].keys()),
+            {"count", "p50", "p95", "p99"}
+        )
+
+    def test_timing_server_error(self):
+        """
+        Test that the requests failed with an unhandled exception are measured too
+        """
+        self.getPage("/broken")
+        self.assertStatus("500 Internal Server Error")
+        self.assertHeader("Server-Timing")
+
+        self.getPage("/metrics")
+        self.assertStatus("200 OK")
+        summary = json.loads(self.body)
+        self.assertIn("/broken Broken.GET", summary)
+        self.assertGreaterEqual(summary["/broken Broken.GET"]["total"]["count"], 1)
@@ -26,9 +26,10 @@ import cherrypy
 # Internal
 from .catalog.root import Catalog
 from .catalog.database import DataBase
+from .utils import Metrics
 
 # Setting
-from .catalog.settings import CATALOG_CONFIG, NO_AUTORELOAD
+from .catalog.settings import CATALOG_CONFIG, METRICS_CONFIG, NO_AUTORELOAD
 
 # -----------------------------------------------------------------------------
 
@@ -48,6 +49,7 @@ def start():
 
     # Mount the Endpoints
     cherrypy.tree.mount(Catalog(), "/catalog", CATALOG_CONFIG)
+    cherrypy.tree.mount(Metrics(), "/metrics", METRICS_CONFIG)
 
     # Update Server Config
     cherrypy.config.update(NO_AUTORELOAD)
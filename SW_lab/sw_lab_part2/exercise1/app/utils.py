@@ -21,10 +21,15 @@ Utilities module for the server
     limitations under the License.
 """
 # Standard Library
+from collections import defaultdict, deque
 import json
+from threading import Lock
+import time
+from typing import DefaultDict, Deque, Dict
 
 # Third Party
 import cherrypy
+from cherrypy.lib import jsontools
 
 # --------------------------------------------------------------------------------------
 
@@ -53,3 +58,180 @@ def jsonify_error(status: str, message: str, **traceback: dict) -> str:
             "status_details": {"message": status, "description": message},
         }
     )
+
+
+# --------------------------------------------------------------------------------------
+
+
+##########
+# TIMING #
+##########
+
+LATENCY_WINDOW = 1024
+"""Number of samples kept for every phase of every endpoint"""
+
+PERCENTILES = (50, 95, 99)
+"""Percentiles exposed by the latency summary"""
+
+
+class LatencySummary:
+    """
+    Rolling summary of the latencies measured by the timing tool.
+    Only the last LATENCY_WINDOW samples of every (endpoint, phase) are kept,
+    so the memory used doesn't depend on the number of requests served
+    """
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        """
+        Instantiate the summary
+
+        :param window: Number of samples kept for every phase of every endpoint
+        """
+        self._samples: DefaultDict[str, Dict[str, Deque[float]]] = defaultdict(
+            lambda: defaultdict(lambda: deque(maxlen=window))
+        )
+        self._lock = Lock()
+
+    def add(self, endpoint: str, timing: Dict[str, float]) -> None:
+        """
+        Store the phases measured for a request
+
+        :param endpoint: Endpoint that served the request
+        :param timing: Duration in milliseconds of every phase
+        """
+        with self._lock:
+            for phase, duration in timing.items():
+                self._samples[endpoint][phase].append(duration)
+
+    def summary(self) -> dict:
+        """
+        Compute the percentiles of every phase of every endpoint
+
+        :return: a dict {endpoint: {phase: {"count": .., "p50": .., "p95": .., "p99": ..}}}
+        """
+        with self._lock:
+            samples = {
+                endpoint: {phase: sorted(values) for phase, values in phases.items()}
+                for endpoint, phases in self._samples.items()
+            }
+
+        return {
+            endpoint: {
+                phase: {
+                    "count": len(values),
+                    **{
+                        f"p{percentile}": round(
+                            values[min(len(values) - 1, len(values) * percentile // 100)], 3
+                        )
+                        for percentile in PERCENTILES
+                    }
+                }
+                for phase, values in phases.items()
+            }
+            for endpoint, phases in samples.items()
+        }
+
+
+latency_summary = LatencySummary()
+"""Latency summary shared by all the endpoints of the server"""
+
+
+def timed_json_processor(entity) -> None:
+    """
+    Same as the default processor of @cherrypy.tools.json_in(),
+    but it measures the time spent decoding the body
+
+    :param entity: Body of the request
+    """
+    start = time.perf_counter()
+    try:
+        jsontools.json_processor(entity)
+    finally:
+        cherrypy.serving.request.timing["decode"] = (time.perf_counter() - start) * 1000
+
+
+def timed_json_handler(*args, **kwargs) -> bytes:
+    """
+    Same as the default handler of @cherrypy.tools.json_out(),
+    but it measures separately the time spent inside the handler and encoding the response
+
+    :return: the response encoded in JSON
+    """
+    request = cherrypy.serving.request
+
+    start = time.perf_counter()
+    value = request._json_inner_handler(*args, **kwargs)
+    end = time.perf_counter()
+    request.timing["handler"] = (end - start) * 1000
+
+    body = json.dumps(value).encode("utf-8")
+    request.timing["encode"] = (time.perf_counter() - end) * 1000
+    return body
+
+
+class TimingTool(cherrypy.Tool):
+    """
+    Measure the time needed to serve every request, add the Server-Timing header
+    to the response and feed the latency summary.
+    To measure separately the decode and encode phases, use it together with
+    tools.json_in.processor = timed_json_processor and tools.json_out.handler = timed_json_handler
+    """
+
+    def __init__(self):
+        """
+        Register the tool on the first hook point of the request
+        """
+        cherrypy.Tool.__init__(self, "on_start_resource", self.start_timer, priority=10)
+
+    def _setup(self):
+        """
+        Hook the tool into cherrypy.request, the timer is stopped just before the response is finalized,
+        or after the error page of an unhandled exception (500), which skips before_finalize
+        """
+        cherrypy.Tool._setup(self)
+        cherrypy.serving.request.hooks.attach("before_finalize", self.stop_timer, priority=90)
+        cherrypy.serving.request.hooks.attach("after_error_response", self.stop_timer, priority=90)
+
+    @staticmethod
+    def start_timer() -> None:
+        """
+        Start measuring the request
+        """
+        request = cherrypy.serving.request
+        request.timing = {}
+        request.timing_start = time.perf_counter()
+
+        # Use the page handler as name of the endpoint so the
+        # resource ids inside the path don't generate new entries
+        handler = getattr(request.handler, "callable", None)
+        request.timing_endpoint = f"{request.script_name} {getattr(handler, '__qualname__', 'unknown')}"
+
+    @staticmethod
+    def stop_timer() -> None:
+        """
+        Stop measuring the request, add the Server-Timing header and store the samples
+        """
+        request = cherrypy.serving.request
+        timing = getattr(request, "timing", None)
+        # Not started, or already stopped
+        if timing is None or "total" in timing:
+            return
+        timing["total"] = (time.perf_counter() - request.timing_start) * 1000
+
+        cherrypy.serving.response.headers["Server-Timing"] = ", ".join(
+            f"{phase};dur={duration:.3f}" for phase, duration in timing.items()
+        )
+        latency_summary.add(request.timing_endpoint, timing)
+
+
+cherrypy.tools.timing = TimingTool()
+
+
+@cherrypy.expose
+class Metrics:
+    """Metrics endpoint"""
+
+    @cherrypy.tools.json_out()
+    def GET(self):
+        """Get the latency percentiles of every endpoint"""
+        return latency_summary.summary()
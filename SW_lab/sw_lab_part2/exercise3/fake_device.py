@@ -21,7 +21,8 @@ Fake Rest Device entry point
 """
 # Standard library
 import json
-from random import randrange
+from random import randrange, uniform
+import time
 
 # Third party
 import cherrypy
@@ -97,6 +98,15 @@ FAKE_DEVICE_CONFIG = {
 
 NO_AUTORELOAD = {"global": {"engine.autoreload.on": False}}
 
+CATALOG_TIMEOUT = (3.05, 5)
+"""Connect and read timeouts of the requests to the catalog"""
+
+CATALOG_RETRIES = 2
+"""Retries of a registration failed, after 0.5, 1... seconds with jitter"""
+
+SESSION = requests.Session()
+"""Session shared by the registrations, so that the connection to the catalog is kept alive"""
+
 # -----------------------------------------------------------------------------
 
 
@@ -109,14 +119,19 @@ def update_registration():
     """
     Update registration of the fake device to the catalog
     """
-    try:
-        requests.post(
-            f'http://{CATALOG_IP_PORT["ip"]}:{CATALOG_IP_PORT["port"]}/catalog/devices',
-            data=UPDATE_BODY,
-            headers={"Content-Type": "application/json"}
-        )
-    except requests.ConnectionError:
-        pass
+    for attempt in range(CATALOG_RETRIES + 1):
+        if attempt:
+            time.sleep(0.5 * 2 ** (attempt - 1) * uniform(0.5, 1))
+        try:
+            SESSION.post(
+                f'http://{CATALOG_IP_PORT["ip"]}:{CATALOG_IP_PORT["port"]}/catalog/devices',
+                data=UPDATE_BODY,
+                headers={"Content-Type": "application/json"},
+                timeout=CATALOG_TIMEOUT
+            )
+            return
+        except requests.RequestException:
+            pass
 
 
 BAKGROUND_TASK = cherrypy.process.plugins.BackgroundTask(60, update_registration)
@@ -157,16 +172,7 @@ class Temperature:
 
 
 def setup_device():
-    url = f'http://{CATALOG_IP_PORT["ip"]}:{CATALOG_IP_PORT["port"]}/catalog/devices'
-    try:
-        result = requests.post(
-            f'http://{CATALOG_IP_PORT["ip"]}:{CATALOG_IP_PORT["port"]}/catalog/devices',
-            data=UPDATE_BODY,
-            headers={"Content-Type": "application/json"}
-        )
-
-    except requests.ConnectionError:
-        pass
+    update_registration()
     BAKGROUND_TASK.start()
 
 
@@ -42,6 +42,16 @@ class Broker:
     __ip__ = "test.mosquitto.org"
     __port__ = 1883
 
+    def __init__(self, ip: str = __ip__, port: int = __port__):
+        """
+        Setup the broker advertised to services and devices
+
+        :param ip: Address of the broker
+        :param port: Port of the broker
+        """
+        self.__ip__ = ip
+        self.__port__ = port
+
     @cherrypy.tools.json_out()
     def GET(self):
         """Get Broker info"""
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+"""
+Aggregation Package
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
\ No newline at end of file
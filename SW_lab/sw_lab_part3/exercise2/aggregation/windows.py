@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""
+Windowed aggregation
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import math
+from threading import Lock
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# ---------------------------------------------------------------
+
+HISTOGRAM = {"low": -50.0, "high": 100.0, "step": 0.5}
+"""Range and resolution of the histograms used for the percentiles, values outside are clamped"""
+
+BINS = int((HISTOGRAM["high"] - HISTOGRAM["low"]) / HISTOGRAM["step"]) + 1
+
+GLOBAL = "all"
+"""Key of the aggregate of all the devices"""
+
+# ---------------------------------------------------------------
+
+
+class Pane:
+    """
+    Partial aggregate of the readings received in a slice of time.
+    Its size doesn't depend on the number of readings
+    """
+
+    __slots__ = ("count", "total", "minimum", "maximum", "histogram")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.histogram: Optional[List[int]] = None
+
+    def add(self, value: float):
+        """
+        Add a reading
+
+        :param value: value of the reading
+        """
+        self.count += 1
+        self.total += value
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+        if self.histogram is None:
+            self.histogram = [0] * BINS
+        position = int((value - HISTOGRAM["low"]) / HISTOGRAM["step"])
+        self.histogram[min(max(position, 0), BINS - 1)] += 1
+
+    def merge(self, other: "Pane") -> "Pane":
+        """
+        Combine two panes
+
+        :param other: pane to combine
+        :return: new pane
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            return other
+        pane = Pane()
+        pane.count = self.count + other.count
+        pane.total = self.total + other.total
+        pane.minimum = min(self.minimum, other.minimum)
+        pane.maximum = max(self.maximum, other.maximum)
+        pane.histogram = [first + second for first, second in zip(self.histogram, other.histogram)]
+        return pane
+
+    def percentile(self, percent: float) -> float:
+        """
+        Estimate a percentile from the histogram
+
+        :param percent: percentile between 0 and 100
+        """
+        rank = max(1, math.ceil(percent / 100 * self.count))
+        seen = 0
+        for position, count in enumerate(self.histogram):
+            seen += count
+            if seen >= rank:
+                value = HISTOGRAM["low"] + (position + 0.5) * HISTOGRAM["step"]
+                return min(max(value, self.minimum), self.maximum)
+        return self.maximum
+
+    def result(self, percentiles: Iterable[float]) -> dict:
+        """
+        Statistics of the pane
+
+        :param percentiles: percentiles to compute
+        """
+        result = {
+            "count": self.count,
+            "mean": self.total / self.count,
+            "min": self.minimum,
+            "max": self.maximum
+        }
+        for percent in percentiles:
+            result[f"p{percent:g}"] = self.percentile(percent)
+        return result
+
+
+EMPTY = Pane()
+
+
+class TwoStackAggregator:
+    """
+    FIFO of panes that returns the aggregate of its content with O(1) amortised
+    push, pop and query. The back stack keeps a running aggregate of the pushed panes,
+    the front stack stores for each pane the aggregate of it and of all the older ones
+    """
+
+    def __init__(self):
+        self._front: List[Tuple[Pane, Pane]] = []
+        self._back: List[Pane] = []
+        self._back_aggregate = EMPTY
+
+    def __len__(self) -> int:
+        return len(self._front) + len(self._back)
+
+    def push(self, pane: Pane):
+        """
+        Add the newest pane
+
+        :param pane: pane to add
+        """
+        self._back.append(pane)
+        self._back_aggregate = self._back_aggregate.merge(pane)
+
+    def pop(self):
+        """
+        Remove the oldest pane
+        """
+        if not self._front:
+            aggregate = EMPTY
+            while self._back:
+                pane = self._back.pop()
+                aggregate = pane.merge(aggregate)
+                self._front.append((pane, aggregate))
+            self._back_aggregate = EMPTY
+        self._front.pop()
+
+    def query(self) -> Pane:
+        """
+        Aggregate of all the panes
+        """
+        front = self._front[-1][1] if self._front else EMPTY
+        return front.merge(self._back_aggregate)
+
+
+class _Window:
+    """Sliding window of a single key"""
+
+    __slots__ = ("start", "current", "closed", "empty")
+
+    def __init__(self, start: float):
+        self.start = start
+        self.current = Pane()
+        self.closed = TwoStackAggregator()
+        self.empty = 0
+
+
+class WindowedAggregator:
+    """
+    Per-key sliding windows of size seconds, emitted every slide seconds.
+    A tumbling window is a sliding window with slide equal to size. Every window is split
+    in panes of slide seconds, so adding a reading is O(1) and memory is bounded
+    by the number of keys, not by the message rate
+    """
+
+    def __init__(self, size: float, slide: float, percentiles: Iterable[float] = (50, 95)):
+        """
+        :param size: size of the window in seconds
+        :param slide: seconds between two results, size must be a multiple of it
+        :param percentiles: percentiles to compute
+        """
+        panes = size / slide
+        if panes < 1 or not panes.is_integer():
+            raise ValueError("size must be a multiple of slide")
+        self.size = size
+        self.slide = slide
+        self.panes = int(panes)
+        self.percentiles = tuple(percentiles)
+        self._windows: Dict[str, _Window] = {}
+        self._results: List[Tuple[str, float, dict]] = []
+        self._lock = Lock()
+
+    def _pane_start(self, timestamp: float) -> float:
+        """
+        Start of the pane containing a timestamp
+
+        :param timestamp: time in seconds
+        """
+        return math.floor(timestamp / self.slide) * self.slide
+
+    def _close(self, key: str, window: _Window, until: float):
+        """
+        Close all the panes of a window that end before until, storing the results
+
+        :param key: key of the window
+        :param window: window to close
+        :param until: time before which the panes are closed
+        """
+        while window.start + self.slide <= until:
+            if window.empty >= self.panes and window.current.count == 0:
+                # Nothing left in the window, jump to the pane containing until
+                window.start = self._pane_start(until)
+                break
+            window.empty = window.empty + 1 if window.current.count == 0 else 0
+            window.closed.push(window.current)
+            if len(window.closed) > self.panes:
+                window.closed.pop()
+            window.start += self.slide
+            window.current = Pane()
+
+            aggregate = window.closed.query()
+            if aggregate.count:
+                self._results.append((key, window.start, aggregate.result(self.percentiles)))
+
+    def add(self, key: str, value: float, timestamp: float):
+        """
+        Add a reading
+
+        :param key: device that generated the reading
+        :param value: value of the reading
+        :param timestamp: time of the reading in seconds
+        """
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                window = self._windows[key] = _Window(self._pane_start(timestamp))
+            elif timestamp >= window.start + self.slide:
+                self._close(key, window, timestamp)
+            window.current.add(value)
+
+    def advance(self, now: float) -> List[Tuple[str, float, dict]]:
+        """
+        Close the panes ended before now and return the results of the windows closed
+        since the last call. Keys without readings for a whole window are dropped
+
+        :param now: current time in seconds
+        :return: list of (key, end of the window, statistics)
+        """
+        with self._lock:
+            for key in list(self._windows):
+                window = self._windows[key]
+                self._close(key, window, now)
+                if window.empty >= self.panes and window.current.count == 0:
+                    del self._windows[key]
+            results, self._results = self._results, []
+        return results
+
+    def forget(self, key: str):
+        """
+        Drop the state of a key
+
+        :param key: key to drop
+        """
+        with self._lock:
+            self._windows.pop(key, None)
+
+
+class _EventWindow:
+    """Event-time panes of a single key"""
+
+    __slots__ = ("panes", "max_event", "watermark", "last_arrival", "emitted", "dirty")
+
+    def __init__(self, emitted: float, arrival: float):
+        self.panes: Dict[float, Pane] = {}
+        self.max_event = -math.inf
+        self.watermark = -math.inf
+        self.last_arrival = arrival
+        self.emitted = emitted
+        self.dirty: Set[float] = set()
+
+
+class EventTimeAggregator:
+    """
+    Per-key sliding windows assigned by the time carried by the readings instead of the
+    time they are received. The watermark of a key is its greatest event time minus max_delay
+    and, once the key stops sending, it advances with the clock. A window is emitted when
+    the watermark passes its end and, if readings of it arrive late but within lateness
+    seconds, emitted again with the updated statistics. Older readings are dropped
+    """
+
+    def __init__(
+        self,
+        size: float,
+        slide: float,
+        percentiles: Iterable[float] = (50, 95),
+        max_delay: float = 5.0,
+        lateness: float = 60.0
+    ):
+        """
+        :param size: size of the window in seconds
+        :param slide: seconds between two results, size must be a multiple of it
+        :param percentiles: percentiles to compute
+        :param max_delay: expected out-of-orderness of the readings in seconds
+        :param lateness: seconds after the watermark during which a window is still updated
+        """
+        panes = size / slide
+        if panes < 1 or not panes.is_integer():
+            raise ValueError("size must be a multiple of slide")
+        self.size = size
+        self.slide = slide
+        self.percentiles = tuple(percentiles)
+        self.max_delay = max_delay
+        self.lateness = lateness
+        self.counters = {"late": 0, "dropped": 0}
+        self._windows: Dict[str, _EventWindow] = {}
+        self._lock = Lock()
+
+    def _pane_start(self, timestamp: float) -> float:
+        """
+        Start of the pane containing a timestamp
+
+        :param timestamp: time in seconds
+        """
+        return math.floor(timestamp / self.slide) * self.slide
+
+    def _watermark(self, window: _EventWindow, now: float) -> float:
+        """
+        Event time before which no more readings are expected, it never goes back
+
+        :param window: window of the key
+        :param now: current time in seconds
+        """
+        idle = max(0.0, now - window.last_arrival - self.max_delay)
+        window.watermark = max(window.watermark, window.max_event - self.max_delay + idle)
+        return window.watermark
+
+    def add(self, key: str, value: float, timestamp: float, arrival: Optional[float] = None):
+        """
+        Add a reading
+
+        :param key: device that generated the reading
+        :param value: value of the reading
+        :param timestamp: event time of the reading in seconds
+        :param arrival: time the reading was received, default now
+        """
+        arrival = time.time() if arrival is None else arrival
+        start = self._pane_start(timestamp)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                window = self._windows[key] = _EventWindow(start, arrival)
+
+            # The last window containing the reading is already final
+            watermark = self._watermark(window, arrival)
+            if start + self.size + self.lateness <= watermark:
+                self.counters["dropped"] += 1
+                return
+
+            pane = window.panes.get(start)
+            if pane is None:
+                pane = window.panes[start] = Pane()
+            pane.add(value)
+
+            # Windows already emitted, but not final, that contain the reading have to be emitted again
+            if start < window.emitted:
+                self.counters["late"] += 1
+                end = start + self.slide
+                while end <= window.emitted and end <= start + self.size:
+                    if end + self.lateness > watermark:
+                        window.dirty.add(end)
+                    end += self.slide
+
+            window.last_arrival = arrival
+            if timestamp > window.max_event:
+                window.max_event = timestamp
+
+    def _result(self, window: _EventWindow, end: float) -> Optional[dict]:
+        """
+        Statistics of the window ending at end
+
+        :param window: window of the key
+        :param end: end of the window
+        """
+        aggregate = EMPTY
+        start = end - self.size
+        while start < end:
+            aggregate = aggregate.merge(window.panes.get(start, EMPTY))
+            start += self.slide
+        return aggregate.result(self.percentiles) if aggregate.count else None
+
+    def advance(self, now: float) -> List[Tuple[str, float, dict]]:
+        """
+        Return the results of the windows whose end has been passed by the watermark since
+        the last call and of the windows updated by late readings. The watermark of a key is
+        kept until forget is called, so late readings of idle keys are still recognised
+
+        :param now: current time in seconds
+        :return: list of (key, end of the window, statistics)
+        """
+        results = []
+        with self._lock:
+            for key in list(self._windows):
+                window = self._windows[key]
+                watermark = self._watermark(window, now)
+
+                ends = sorted(window.dirty)
+                window.dirty.clear()
+                end = window.emitted + self.slide
+                if window.panes and end <= watermark:
+                    # Skip the windows ending before the first pane
+                    end = max(end, min(window.panes) + self.slide)
+                last_pane = max(window.panes, default=-math.inf)
+                while end <= watermark:
+                    ends.append(end)
+                    window.emitted = end
+                    if end - self.size > last_pane:
+                        # No more panes, jump to the watermark
+                        window.emitted = self._pane_start(watermark)
+                        break
+                    end += self.slide
+
+                for end in ends:
+                    result = self._result(window, end)
+                    if result is not None:
+                        results.append((key, end, result))
+
+                # Drop the panes that can't be updated anymore
+                for start in [start for start in window.panes if start + self.size + self.lateness <= watermark]:
+                    del window.panes[start]
+        return results
+
+    def forget(self, key: str):
+        """
+        Drop the state of a key
+
+        :param key: key to drop
+        """
+        with self._lock:
+            self._windows.pop(key, None)
@@ -42,6 +42,16 @@ class Broker:
     __ip__ = "test.mosquitto.org"
     __port__ = 1883
 
+    def __init__(self, ip: str = __ip__, port: int = __port__):
+        """
+        Setup the broker advertised to services and devices
+
+        :param ip: Address of the broker
+        :param port: Port of the broker
+        """
+        self.__ip__ = ip
+        self.__port__ = port
+
     @cherrypy.tools.json_out()
     def GET(self):
         """Get Broker info"""
@@ -350,12 +360,21 @@ class User:
     @cherrypy.tools.json_out()
     def GET(self, *uri, **params):
         """
-        Get user, or users list
+        Get user, or users list. users/changes?since=<revision> returns
+        the users inserted or changed after that revision
 
         :param uri: path
-        :param params: body, must be None
+        :param params: body, must be None, except since for the changes
         :return: User or users info
         """
+        if uri == ("changes",):
+            try:
+                since = int(params.pop("since", 0))
+            except ValueError:
+                raise cherrypy.HTTPError(status=400, message="since must be an integer revision. ")
+            if params:
+                raise cherrypy.HTTPError(status=400, message="Only the parameter since is allowed. ")
+            return DataBase.get_users_since(since)
         if len(uri) != 1 or params:
             # Wrong uri number or body inside the request
             raise cherrypy.HTTPError(
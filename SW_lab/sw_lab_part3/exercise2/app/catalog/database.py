@@ -76,13 +76,22 @@ class DataBase:
                     userID text, 
                     name text,
                     surname text,
-                    email dict);"""
+                    email dict,
+                    revision integer DEFAULT 0);"""
                 )
                 # Create index
                 con.execute(f"""CREATE UNIQUE INDEX user_index on user(userID);""")
             except sqlite3.OperationalError:
                 # The table already exist
                 pass
+            try:
+                # Add the revision to a user table created before it existed
+                con.execute(f"""ALTER TABLE user ADD COLUMN revision integer DEFAULT 0;""")
+                con.execute(f"""UPDATE user SET revision = rowid;""")
+            except sqlite3.OperationalError:
+                # The column already exist
+                pass
+            con.execute(f"""CREATE INDEX IF NOT EXISTS user_revision_index on user(revision);""")
             try:
                 # Try to create the service table
                 con.execute(
@@ -220,7 +229,8 @@ class DataBase:
     ) -> None:
         """
         Insert a user in the db,
-        if the user is already present, update its email addresses
+        if the user is already present, update its email addresses.
+        Every insert or change gets the next revision of the user table
 
         :param userID: Unique identifier of the user
         :param name: Name of the user
@@ -239,17 +249,18 @@ class DataBase:
                         userID, 
                         name, 
                         surname, 
-                        email
-                        ) VALUES ($1, $2, $3, $4);""",
+                        email,
+                        revision
+                        ) VALUES ($1, $2, $3, $4, (SELECT COALESCE(MAX(revision), 0) + 1 FROM user));""",
                     (userID, name, surname, email),
                 )
             except sqlite3.IntegrityError:
-                # Update Device
+                # Update Device, the revision changes only if the email addresses changed
                 con.execute(
                     f"""update user 
-                        set email = ? 
-                        where userID = ?;""",
-                    (email, userID),
+                        set email = ?, revision = (SELECT MAX(revision) + 1 FROM user)
+                        where userID = ? and email != ?;""",
+                    (email, userID, email),
                 )
         return
 
@@ -291,6 +302,33 @@ class DataBase:
             for user in users
         ]
 
+    @classmethod
+    def get_users_since(cls, revision: int) -> dict:
+        """
+        Retrieve the users inserted or changed after a revision
+
+        :param revision: last revision known by the caller, 0 for all the users
+        :return: dictionary with the current revision of the user table and the users changed
+        """
+        with sqlite3.connect(cls.__db__, detect_types=sqlite3.PARSE_DECLTYPES) as con:
+            version = con.execute("SELECT COALESCE(MAX(revision), 0) FROM user;").fetchone()[0]
+            users = con.execute(
+                "SELECT userID, name, surname, email FROM user WHERE revision > ? ORDER BY revision;",
+                (revision,)
+            ).fetchall()
+        return {
+            "version": version,
+            "users": [
+                {
+                    "userID": user[0],
+                    "name": user[1],
+                    "surname": user[2],
+                    "email_addresses": user[3],
+                }
+                for user in users
+            ]
+        }
+
     @classmethod
     def insert_service(
         cls, serviceID: str, description: str, end_points: Dict[str, List[str]],
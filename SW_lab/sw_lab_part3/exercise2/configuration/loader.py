@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Layered configuration
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import argparse
+from copy import deepcopy
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+# Third Party
+import requests
+
+# ---------------------------------------------------------------
+
+DISCOVERY_TIMEOUT = 0.4
+"""
+Connect and read timeout of the broker discovery: it runs before the service starts,
+so an unreachable catalog delays the startup by less than a second. A slower catalog is asked
+again by the services at every update of their registration (CatalogService.check_broker)
+"""
+
+DEFAULTS = {
+    "catalog": {"ip": "0.0.0.0", "port": 8080},
+    "server": {"host": "0.0.0.0", "port": 8080, "db": "catalog.db"},
+    "broker": {"ip": "test.mosquitto.org", "port": 1883},
+    "device_broker": {"ip": "broker.hivemq.com", "port": 1883},
+    "http": {
+        "connect_timeout": 3.05, "read_timeout": 5.0, "retries": 2, "backoff": 0.5, "failures": 3, "reset_timeout": 30.0
+    },
+}
+"""
+Default configuration shared by all the entry points, every service adds its own sections
+with register_defaults:
+    catalog: address of the catalog used by services and devices
+    server: address and database of the catalog REST server
+    broker: broker used by the catalog and advertised on GET /catalog/broker
+    device_broker: broker used by the fake devices
+    http: connect and read timeouts, retries with their initial backoff (seconds), consecutive
+        failures that open the circuit breaker and seconds before trying again, of the catalog client
+"""
+
+CONFIG_FILE_ENV = "IOT_CONFIG"
+"""Environment variable containing the path of the configuration file"""
+
+CONFIG_FILE = "config.json"
+"""Configuration file loaded, if present, when no other file is specified"""
+
+ENV_PREFIX = "IOT_"
+"""Every option can be overridden by the environment variable IOT_<SECTION>_<KEY>, e.g. IOT_BROKER_IP"""
+
+settings: Dict[str, dict] = deepcopy(DEFAULTS)
+"""Configuration in use, filled by load_settings"""
+
+_loaded = False
+
+# ---------------------------------------------------------------
+
+
+def register_defaults(section: str, options: dict):
+    """
+    Add the section of a service to the configuration, before load_settings merges
+    the configuration file, the environment variables and the command line over it
+
+    :param section: name of the section
+    :param options: default value of every option, its type is the one of the option
+    """
+    DEFAULTS[section] = dict(options)
+    settings[section] = dict(options)
+
+
+def _cast(section: str, key: str, value):
+    """
+    Convert a value to the type of its default
+
+    :param section: section of the option
+    :param key: name of the option
+    :param value: value to convert
+    :return: converted value
+    :raise ValueError: the value can't be converted
+    """
+    default = DEFAULTS.get(section, {}).get(key)
+    if default is None or isinstance(value, type(default)):
+        return value
+    try:
+        return type(default)(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{section}.{key} must be of type {type(default).__name__}, not {value!r}") from None
+
+
+def _merge(layer: Dict[str, dict]):
+    """
+    Merge a configuration layer over the settings
+
+    :param layer: dict {section: {key: value}}
+    """
+    for section, options in layer.items():
+        for key, value in options.items():
+            settings.setdefault(section, {})[key] = _cast(section, key, value)
+
+
+def _address(value: str) -> dict:
+    """
+    Parse an address in the form ip:port
+
+    :param value: address to parse
+    :return: dict {"ip": .., "port": ..}
+    """
+    ip, _, port = value.rpartition(":")
+    if not ip:
+        raise argparse.ArgumentTypeError(f"{value} is not in the form ip:port")
+    return {"ip": ip, "port": int(port)}
+
+
+def load_settings(argv: Optional[List[str]] = None) -> Dict[str, dict]:
+    """
+    Load the configuration once, merging in order: defaults, configuration file,
+    environment variables and command line. Unknown command line arguments are ignored,
+    so entry points can still parse their own. A value that doesn't have the type of its default
+    is reported as an error of the arguments
+
+    :param argv: command line arguments, default sys.argv
+    :return: the configuration in use
+    """
+    global _loaded
+    if _loaded:
+        return settings
+
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--config", help="JSON configuration file")
+    parser.add_argument("--catalog", type=_address, help="catalog address ip:port")
+    parser.add_argument("--broker", type=_address, help="MQTT broker address ip:port")
+    parser.add_argument("--device-broker", type=_address, help="MQTT broker of the devices ip:port")
+    parser.add_argument(
+        "--set", action="append", default=[], metavar="SECTION.KEY=VALUE", help="override a single option"
+    )
+    args, _ = parser.parse_known_args(argv)
+    try:
+        _load(args)
+    except ValueError as error:
+        parser.error(str(error))
+
+    _loaded = True
+    return settings
+
+
+def _load(args: argparse.Namespace):
+    """
+    Merge the configuration file, the environment variables and the command line over the defaults
+
+    :param args: parsed command line
+    :raise ValueError: an option doesn't have the type of its default, or the file isn't valid JSON
+    """
+    # Configuration file
+    path = args.config or os.environ.get(CONFIG_FILE_ENV)
+    if path or os.path.exists(CONFIG_FILE):
+        with open(path or CONFIG_FILE) as fp:
+            try:
+                layer = json.load(fp)
+            except ValueError as error:
+                raise ValueError(f"{fp.name} is not valid JSON: {error}") from None
+        _merge(layer)
+
+    # Environment variables
+    _merge(
+        {
+            section: {
+                key: os.environ[f"{ENV_PREFIX}{section}_{key}".upper()]
+                for key in options
+                if f"{ENV_PREFIX}{section}_{key}".upper() in os.environ
+            }
+            for section, options in DEFAULTS.items()
+        }
+    )
+
+    # Command line
+    _merge(
+        {
+            section: getattr(args, section)
+            for section in ("catalog", "broker", "device_broker")
+            if getattr(args, section)
+        }
+    )
+    for option in args.set:
+        name, _, value = option.partition("=")
+        section, _, key = name.partition(".")
+        _merge({section: {key: value}})
+
+
+def discover_broker(
+    catalog: dict, timeout: float = DISCOVERY_TIMEOUT, session: Optional[requests.Session] = None
+) -> dict:
+    """
+    Ask the catalog which broker to use, if the catalog isn't reachable
+    use the broker of the configuration, loudly
+
+    :param catalog: address of the catalog {"ip": .., "port": ..}
+    :param timeout: connect and read timeout of the request, in seconds
+    :param session: session to use, so that its connection is kept for the next requests
+    :return: dict {"ip": .., "port": ..}
+    """
+    try:
+        result = (session or requests).get(
+            f"http://{catalog['ip']}:{catalog['port']}/catalog/broker", timeout=timeout
+        )
+        if result.status_code == 200:
+            broker = result.json()
+            print(f"[{time.ctime()}] BROKER discovered: {broker['ip']}:{broker['port']}")
+            return {"ip": broker["ip"], "port": int(broker["port"])}
+    except (requests.RequestException, ValueError, KeyError):
+        pass
+    print(
+        f"[{time.ctime()}] WARNING BROKER DISCOVERY FAILED, the catalog {catalog['ip']}:{catalog['port']} "
+        f"didn't answer in {timeout} seconds: using the configured broker {settings['broker']['ip']}:"
+        f"{settings['broker']['port']} until the catalog advertises another one"
+    )
+    return dict(settings["broker"])
@@ -16,17 +16,20 @@ Exercise2 sw_lab3
     limitations under the License.
 """
 # Standard Library
-from collections import defaultdict
 import json
-from random import randrange
-import sys
 import time
-from typing import Any, Dict, List, DefaultDict
-from threading import Timer, Lock
+from typing import Any, Dict, List, Optional, Tuple
 
 # Third Party
 from paho.mqtt.client import Client, MQTTMessage
-import requests
+
+# Internals
+from aggregation.windows import GLOBAL, EventTimeAggregator, WindowedAggregator
+from configuration.loader import discover_broker, load_settings, register_defaults
+from profiler.sampler import profile_from_env
+from runtime.http import catalog_client
+from runtime.scheduler import Task
+from runtime.service import CatalogService
 
 # -----------------------------------------------------------------------------
 
@@ -39,18 +42,33 @@ ARDUINO_UNIQUE_ID = "YUN"
 CATALOG_IP_PORT = {"ip": "0.0.0.0", "port": 8080}
 
 SERVICE_BROKER_PORT = {"ip": "test.mosquitto.org", "port": 1883}
-SERVICE_INFO = json.dumps(
-    {
-        "serviceID": "Exercise2/LabSw3",
-        "description": "Temperature Average of the Arduino Yun in a interval of 5 minutes",
-        "end_points": {
-            "MQTT": {
-                "broker": SERVICE_BROKER_PORT,
-                "subscribe": ["labsw3/temperature/arduino/average"]
-            }
+SERVICE_INFO = {
+    "serviceID": "Exercise2/LabSw3",
+    "description": "Temperature statistics (mean, min, max, percentiles) of the Arduino Yun over a window, "
+                   "for each device and for all of them",
+    "end_points": {
+        "MQTT": {
+            "broker": SERVICE_BROKER_PORT,
+            "subscribe": ["labsw3/temperature/arduino/average", "labsw3/temperature/arduino/average/+"]
         }
     }
-)
+}
+
+# Statistics are computed over the last size seconds and published every slide seconds,
+# slide equal to size gives tumbling windows. With "event" time readings are assigned to the
+# windows by their SenML time, allowing max_delay seconds of disorder and updating the windows
+# already published for lateness seconds. With "processing" time the time of reception is used
+WINDOW = {
+    "size": 5 * 60.0,
+    "slide": 5 * 60.0,
+    "time": "event",
+    "max_delay": 5.0,
+    "lateness": 5 * 60.0
+}
+PERCENTILES = (50, 95)
+
+# Seconds between two checks of the windows to close
+TICK = 1
 
 # -----------------------------------------------------------------------------
 
@@ -71,370 +89,173 @@ def find_arduino(data: dict) -> bool:
     return False
 
 
-class Service:
+def senml_records(data: dict, now: float) -> List[Tuple[float, str, float]]:
+    """
+    Extract value, unit and time of every record of a SenML message. Times lower than 2**28
+    are relative to now, as in RFC 8428, and missing times are now
+    :param data: a record {"n", "v", "u", "t"} or a pack {"bn", "bt", "e": [records]}
+    :param now: time of reception
+    """
+    records = data["e"] if "e" in data else [data]
+    base_time = data.get("bt", 0)
+    result = []
+    for record in records:
+        timestamp = base_time + record.get("t", 0)
+        if timestamp < 2 ** 28:
+            timestamp += now
+        result.append((record["v"], record.get("u", data.get("bu")), timestamp))
+    return result
+
+
+class Service(CatalogService):
     """Service that gives the temperature average"""
 
-    _mqtt_client: Dict[str, Client] = {}
-    _device_list: Dict[str, dict] = {}
-    _broker: DefaultDict[str, set] = defaultdict(set)
-    _broker_port: Dict[str, int] = {}
-    _topic: DefaultDict[str, set] = defaultdict(set)
-    _update_thread: Timer = None
+    client_prefix = "TemperatureMeanService"
     average_topic = "labsw3/temperature/arduino/average"
 
     def __init__(self):
         """
         Instantiate the service
         """
-        self.service = Client(client_id=f"TemperatureMeanService{randrange(1, 100000)}")
-        self.service.on_message = self.my_on_message
-        self.lock = Lock()
-        self.device_lock = Lock()
-        self.timer = int(time.time())
-        self.temperature = 0
+        super().__init__(CATALOG_IP_PORT, SERVICE_BROKER_PORT, SERVICE_INFO)
+        # Topic -> device. Never modified in place: writers build a new dict
+        # under device_lock and swap it, so my_on_message can read it without locking
+        self._routes: Dict[str, str] = {}
         self.unit = ""
-        self.values_number = 0
+        self.event_time = WINDOW["time"] == "event"
+        if self.event_time:
+            self.windows = EventTimeAggregator(
+                WINDOW["size"], WINDOW["slide"], PERCENTILES, WINDOW["max_delay"], WINDOW["lateness"]
+            )
+        else:
+            self.windows = WindowedAggregator(WINDOW["size"], WINDOW["slide"], PERCENTILES)
+        self._window_task: Optional[Task] = None
 
-    def _update(self, device_list: List[dict]):
+    def find(self, entry: dict) -> bool:
         """
-        Update reserved dicts
-
-        :param device_list: device list to add
+        Follow the arduino offering temperature
+        :param entry: device of the catalog
         """
-        for arduino in device_list:
-            device = arduino["deviceID"]
-            broker = arduino["end_points"]["MQTT"]["ip"]
-            port = arduino["end_points"]["MQTT"]["port"]
-            topics = {
-                topic
-                for topic in arduino["end_points"]["MQTT"]["end_points"]["subscribe"]
-                if "temp" in topic
-            }
-            self._device_list[device] = {"ip": broker, "temperature_topics": topics}
+        return find_arduino(entry)
 
-            self._broker_port[broker] = port
-
-            self._broker[broker].update({device})
-            self._topic[broker].update(topics)
-
-            print(f"[{time.ctime()}] DEVICE {device} CONNECTED")
-
-    def setup(self, first_time: bool = True):
+    def describe(self, entry: dict) -> dict:
         """
-        Setup the service
+        Temperature topics of an arduino
+        :param entry: device of the catalog
         """
-        try:
-            print(f"[{time.ctime()}] EXTRACT info about all the devices registered")
-            result: requests.Response = requests.get(
-                url=f"http://{CATALOG_IP_PORT['ip']}:{CATALOG_IP_PORT['port']}/catalog/devices/all"
-            )
-            while result.status_code != 200:
-                print(
-                    f"[{time.ctime()}] WARNING no device registered found, retrying after 30 seconds"
-                )
-                time.sleep(30)
-                result: requests.Response = requests.get(
-                    url=f"http://{CATALOG_IP_PORT['ip']}:{CATALOG_IP_PORT['port']}"
-                    f"/catalog/devices/all"
-                )
-            print(f"[{time.ctime()}] DEVICES found")
-            data = json.loads(result.content.decode())
+        mqtt = entry["end_points"]["MQTT"]
+        return {
+            "ip": mqtt["ip"],
+            "port": mqtt["port"],
+            "topics": {topic for topic in mqtt["end_points"]["subscribe"] if "temp" in topic}
+        }
 
-            print(
-                f"[{time.ctime()}] EXTRACT from the devices list info about ArduinoYUN"
-            )
-            device_list = [device for device in data if find_arduino(device)]
-            if len(device_list) == 0:
-                print(f"[{time.ctime()}] No ArduinoYUN found... retrying in 10 seconds")
-                time.sleep(10)
-                self.setup(first_time)
-                return
-        except KeyboardInterrupt:
-            print(f"[{time.ctime()}] EXIT")
-            if first_time:
-                sys.exit()
-            return
+    def added(self, records: Dict[str, dict]):
+        """
+        Route the temperatures of the new devices
+        :param records: new devices
+        """
+        routes = dict(self._routes)
+        for device, record in records.items():
+            for topic in record["topics"]:
+                routes[topic] = device
+        self._routes = routes
 
-        if first_time:
-            # Connect the service
-            self.service.connect(
-                host=SERVICE_BROKER_PORT["ip"], port=SERVICE_BROKER_PORT["port"]
-            )
+    def removed(self, records: Dict[str, dict]):
+        """
+        Forget the routes and the windows of the devices removed
+        :param records: devices removed
+        """
+        routes = dict(self._routes)
+        for device, record in records.items():
+            for topic in record["topics"]:
+                routes.pop(topic, None)
+            self.windows.forget(device)
+        self._routes = routes
+
+    def registered(self):
+        """
+        Report the late readings
+        """
+        if self.event_time:
             print(
-                f"[{time.ctime()}] SERVICE CONNECTED to "
-                f"broker: {SERVICE_BROKER_PORT['ip']} "
-                f"on port: port={SERVICE_BROKER_PORT['port']}"
+                f"[{time.ctime()}] WINDOWS late readings: {self.windows.counters['late']} "
+                f"updated a published window, {self.windows.counters['dropped']} dropped"
             )
 
-        # Update registered devices and subscribe to all the topics
-        with self.device_lock:
-            self._update(device_list)
-            self.subscribe(device_list)
-
-        # Register inside the catalog
-        print(f"[{time.ctime()}] PING the Catalog on : {CATALOG_IP_PORT['ip']}")
-        requests.post(
-            f'http://{CATALOG_IP_PORT["ip"]}:{CATALOG_IP_PORT["port"]}/catalog/services',
-            data=SERVICE_INFO,
-            headers={"Content-Type": "application/json"}
-        )
-
-    def start(self):
+    def started(self):
         """
-        Start the service.
+        Publish the windows when they close
         """
-        # Setup the service
-        self.setup()
+        self._window_task = self.scheduler.call_every(TICK, self._publish_windows)
 
-        # Start all the external mqtt_clients
-        for broker in self._mqtt_client:
-            self._mqtt_client[broker].loop_start()
-
-        # Schedule the update of the registration
-        self._update_thread = Timer(60, self.update_registration)
-        self._update_thread.start()
-
-        try:
-            # Run the service forever
-            self.service.loop_forever()
-        except KeyboardInterrupt:
-            self.stop()
+    def stopping(self):
+        """
+        Stop the publication of the windows
+        """
+        if self._window_task is not None:
+            self._window_task.cancel()
 
     def my_on_message(self, client: Client, userdata: Any, msg: MQTTMessage):
         """
-        Update temperature and numbers of lectures.
-        If are passed more than 5 minutes, publish the temperature mean
+        Add the temperatures to the windows of their device and to the global ones
         :param client: MQTT client
         :param userdata: They could be any type
         :param msg: MQTT message
         """
-        data = json.loads(msg.payload.decode())
-        self.temperature = self.temperature + data["v"]
-        self.unit = data["u"]
-        self.values_number += 1
-        now = int(time.time())
-        with self.lock:
-            if now - self.timer >= 60 * 6:
-                print(f"[{time.ctime()}] Service Restarted")
-                self.temperature = 0
-                self.values_number = 0
-                self.timer = now
-                return
-            if now - self.timer >= 60 * 5:
-                print(
-                    f"[{time.ctime()}] PUBLISHING Temperature mean on topic: {self.average_topic}"
-                )
-                self.service.publish(
-                    self.average_topic,
-                    payload=json.dumps(
-                        {
-                            "n": "temperature mean",
-                            "v": round(self.temperature / self.values_number, 2),
-                            "u": self.unit
-                        }
-                    ),
-                )
-                self.temperature = 0
-                self.values_number = 0
-                self.timer = now
-
-    def update_registration(self):
-        """
-        Update service registration to the catalog
-        """
-
-        print(f"[{time.ctime()}] EXTRACT info about all the devices registered")
-        result: requests.Response = requests.get(
-            url=f"http://{CATALOG_IP_PORT['ip']}:{CATALOG_IP_PORT['port']}/catalog/devices/all"
-        )
-
-        # No device found
-        if result.status_code != 200:
-            self.reset()
-            return
-        data = json.loads(result.content.decode())
-        device_list = [device for device in data if find_arduino(device)]
-        if len(device_list) == 0:
-            self.reset()
+        device = self._routes.get(msg.topic)
+        if device is None:
             return
 
-        # New Devices Found
-        new_devices = {arduino["deviceID"] for arduino in device_list}
-        # Old devices list
-        old_devices = set(self._device_list.keys())
-
-        # Check if there are update to do
-        if old_devices == new_devices:
-            # No update, ping the catalog
-            print(f"[{time.ctime()}] PING the Catalog on : {CATALOG_IP_PORT['ip']}")
-            requests.post(
-                f'http://{CATALOG_IP_PORT["ip"]}:{CATALOG_IP_PORT["port"]}/catalog/services',
-                data=SERVICE_INFO,
-                headers={"Content-Type": "application/json"}
-            )
-            self._update_thread = Timer(60, self.update_registration)
-            self._update_thread.start()
-            return
-
-        with self.device_lock:
-            # Delete inactive devices
-            delete_list = {
-                arduino: self._device_list[arduino]
-                for arduino in self._device_list
-                if arduino not in new_devices
-            }
-            # Unsubscribe from devices
-            self.unsubscribe(delete_list)
-
-            # Update registered devices and subscribe
-            new_devices = [
-                arduino
-                for arduino in device_list
-                if arduino["deviceID"] not in old_devices
-            ]
-
-            self._update(new_devices)
-            self.subscribe(new_devices)
-
-        self._update_thread = Timer(60, self.update_registration)
-        self._update_thread.start()
-
-    def reset(self):
-        """
-        Reset the service
+        data = json.loads(msg.payload.decode())
+        now = time.time()
+        for value, unit, timestamp in senml_records(data, now):
+            if not self.event_time:
+                timestamp = now
+            self.unit = unit
+            self.windows.add(device, value, timestamp)
+            self.windows.add(GLOBAL, value, timestamp)
+
+    def _publish_windows(self):
         """
-        with self.device_lock:
-            self._clear()
-        self.setup(first_time=False)
-        # Start all the external mqtt_clients
-        for broker in self._mqtt_client:
-            self._mqtt_client[broker].loop_start()
-        self._update_thread = Timer(60, self.update_registration)
-        self._update_thread.start()
-
-    def unsubscribe(self, device_list: dict):
+        Publish the statistics of the windows closed, run every TICK seconds: the global ones
+        on average_topic, the ones of each device on average_topic/device
         """
-        Unsubscribe from devices
+        for device, end, result in self.windows.advance(time.time()):
+            topic = self.average_topic if device == GLOBAL else f"{self.average_topic}/{device}"
+            print(f"[{time.ctime()}] PUBLISHING Temperature statistics on topic: {topic}")
+            self.service.publish(topic, payload=json.dumps(self._senml(device, end, result)))
 
-        :param device_list: device list
+    def _senml(self, device: str, end: float, result: dict) -> List[dict]:
         """
-        for arduino in device_list:
-            print(f"[{time.ctime()}] DEVICE {arduino} DISCONNECTED")
-            broker = device_list[arduino]["ip"]
-            topics = device_list[arduino]["temperature_topics"]
-
-            if broker == SERVICE_BROKER_PORT["ip"]:
-                for topic in topics:
-                    self.service.unsubscribe(topic)
-                    print(f"[{time.ctime()}] UNSUBSCRIBED from : {topic}")
-
-            else:
-                for topic in topics:
-                    self._mqtt_client[broker].unsubscribe(topic)
-                    print(f"[{time.ctime()}] UNSUBSCRIBED from : {topic}")
-
-            # Update topics
-            self._topic[broker] = self._topic[broker].difference(topics)
-
-            # Disconnect from external broker
-            if len(self._topic[broker]) == 0:
-                if broker != SERVICE_BROKER_PORT["ip"]:
-                    self._mqtt_client[broker].disconnect()
-                    self._mqtt_client[broker].loop_stop()
-                    print(f"[{time.ctime()}] DISCONNECTED from broker: {broker}")
-                    del self._mqtt_client[broker]
-
-                # Clean
-                del self._topic[broker]
-                del self._broker_port[broker]
-
-            # Delete device
-            del self._device_list[arduino]
-            self._broker[broker].discard(arduino)
-
-    def subscribe(self, device_list: List[dict]):
+        Build the SenML pack of the statistics of a window
+        :param device: device of the window or GLOBAL
+        :param end: end of the window
+        :param result: statistics of the window
         """
-        Subscribe to all the devices registered
-
-        :param device_list: list of device
-        """
-        for arduino in device_list:
-            broker = arduino["end_points"]["MQTT"]["ip"]
-            topics = {
-                topic
-                for topic in arduino["end_points"]["MQTT"]["end_points"]["subscribe"]
-                if "temp" in topic
+        pack = [
+            {
+                "bn": f"{device}/",
+                "bt": end,
+                "n": "temperature mean",
+                "v": round(result["mean"], 2),
+                "u": self.unit
             }
-            # Subscribe to topics
-            if broker == SERVICE_BROKER_PORT["ip"]:
-                for topic in topics:
-                    self.service.subscribe(topic)
-                    print(f"[{time.ctime()}] SUBSCRIBED to : {topic}")
-
-            # Connect to external brokers
-            else:
-                if broker in self._mqtt_client:
-                    # Connection already made
-                    for topic in topics:
-                        self._mqtt_client[broker].subscribe(topic)
-                        print(f"[{time.ctime()}] SUBSCRIBED to : {topic}")
-                else:
-                    # Connect to the broker
-                    self._mqtt_client[broker] = Client(
-                        f"TemperatureMeanService{randrange(1, 1000000)}"
-                    )
-                    self._mqtt_client[broker].on_message = self.my_on_message
-                    self._mqtt_client[broker].connect(
-                        host=broker, port=self._broker_port[broker]
-                    )
-                    for topic in topics:
-                        self._mqtt_client[broker].subscribe(topic)
-                        print(f"[{time.ctime()}] SUBSCRIBED to : {topic}")
-
-    def _clear(self):
-        """
-        Clear all the data stored
-        """
-        # Unsubscribe from all topics
-        self.unsubscribe(self._device_list.copy())
-
-        # Disconnect from all the external brokers
-        for broker in self._mqtt_client:
-            self._mqtt_client[broker].disconnect()
-            self._mqtt_client[broker].loop_stop()
-            print(f"[{time.ctime()}] DISCONNECTED from broker: {broker}")
-
-        # Clear
-        self._mqtt_client.clear()
-        self._device_list.clear()
-        self._broker.clear()
-        self._broker_port.clear()
-        self._topic.clear()
-
-    def stop(self):
-        """
-        Stop the service
-        """
-        # Stop the schedule
-        self._update_thread.cancel()
-
-        # Wait for the threads to finish
-        if self._update_thread.is_alive():
-            self._update_thread.join()
-
-        # Disconnect the clients
-        print(f"[{time.ctime()}] SHUTTING DOWN")
-        for client in self._mqtt_client:
-            self._mqtt_client[client].disconnect()
-            self._mqtt_client[client].loop_stop()
-        # Disconnect the service
-        self.service.disconnect()
-        print(f"[{time.ctime()}] EXIT")
-
+        ]
+        for name in ["min", "max"] + [f"p{percent:g}" for percent in PERCENTILES]:
+            pack.append({"n": f"temperature {name}", "v": round(result[name], 2), "u": self.unit})
+        pack.append({"n": "count", "v": result["count"], "u": None})
+        return pack
 
 # -----------------------------------------------------------------------------------------------------------
 
 
 if __name__ == "__main__":
+    register_defaults("window", WINDOW)
+    settings = load_settings()
+    CATALOG_IP_PORT.update(settings["catalog"])
+    WINDOW.update(settings["window"])
+    SERVICE_BROKER_PORT.update(discover_broker(CATALOG_IP_PORT, session=catalog_client(CATALOG_IP_PORT).session))
+    profile_from_env()
     service = Service()
     service.start()
@@ -17,12 +17,16 @@ Fake MQTT Device entry point
 # Standard library
 import json
 from random import randrange
-from threading import Timer
 import time
 
 # Third party
 from paho.mqtt.client import Client
-import requests
+
+# Internals
+from configuration.loader import load_settings
+from profiler.sampler import profile_from_env
+from runtime.http import CatalogUnavailable, catalog_client
+from runtime.scheduler import Task, shared_scheduler
 
 
 # ------------------------------------------------------------------------------------------
@@ -39,16 +43,13 @@ CATALOG_IP_PORT = {"ip": "0.0.0.0", "port": 8080}
 
 FAKE_DEVICE_BROKER_PORT = {"addr": "broker.hivemq.com", "port": 1883}
 
-UPDATE_BODY = json.dumps(
-    {
-        "ID": FAKE_DEVICE_ID,
-        "PROT": "MQTT",
-        "IP": FAKE_DEVICE_BROKER_PORT["addr"],
-        "P": FAKE_DEVICE_BROKER_PORT["port"],
-        "ED": {"S": ["temperature/fake_thermometer"]},
-        "AR": ["Temp"]
-    }
-)
+# IP and P are added at registration time, using the broker in use
+UPDATE_BODY = {
+    "ID": FAKE_DEVICE_ID,
+    "PROT": "MQTT",
+    "ED": {"S": ["temperature/fake_thermometer"]},
+    "AR": ["Temp"]
+}
 
 # -------------------------------------------------------------------------------------------------------
 
@@ -60,8 +61,8 @@ UPDATE_BODY = json.dumps(
 class Thermometer:
     """Simulate a MQTT thermometer"""
 
-    _update_thread: Timer = None
-    _temperature_thread: Timer = None
+    _update_task: Task = None
+    _temperature_task: Task = None
 
     def __init__(self, broker: str, port: int):
         """
@@ -72,6 +73,7 @@ class Thermometer:
         self.broker = broker
         self.port = port
         self.client = Client(client_id="FakeThermometer")
+        self.catalog = catalog_client(CATALOG_IP_PORT)
 
     def start(self):
         """
@@ -82,11 +84,10 @@ class Thermometer:
         print(
             f"[{time.ctime()}] CONNECTED to broker: {self.broker} on port: {self.port}"
         )
-        self._temperature_thread = Timer(1, self.send_temperature)
-        self._temperature_thread.start()
-
-        self.update_registration()
-        # Schedule the publish of the calculated temperature
+        # Schedule the telemetry and the ping of the catalog on the scheduler of the process
+        scheduler = shared_scheduler()
+        self._temperature_task = scheduler.call_every(3, self.send_temperature, delay=1, jitter=0.1)
+        self._update_task = scheduler.call_every(60, self.update_registration, delay=0, jitter=0.1, blocking=True)
 
         try:
             # Run MQTT Client forever
@@ -101,14 +102,8 @@ class Thermometer:
         Stop the fake thermometer
         """
         # Stop the schedule
-        self._update_thread.cancel()
-        self._temperature_thread.cancel()
-
-        # Wait for the threads to finish
-        if self._update_thread.is_alive():
-            self._update_thread.join()
-        if self._temperature_thread.is_alive():
-            self._temperature_thread.join()
+        self._update_task.cancel()
+        self._temperature_task.cancel()
 
         # Disconnect the client
         self.client.disconnect()
@@ -119,23 +114,12 @@ class Thermometer:
 
     def update_registration(self):
         """
-        Ping the catalog on topic catalog/devices
+        Ping the catalog on topic catalog/devices, every 60 seconds
         """
         try:
-            try:
-                requests.post(
-                    f'http://{CATALOG_IP_PORT["ip"]}:{CATALOG_IP_PORT["port"]}/catalog/devices',
-                    data=UPDATE_BODY,
-                    headers={"Content-Type": "application/json"}
-                )
-            except requests.ConnectionError:
-                pass
-
-            # Schedule the ping 60 seconds later
-            self._update_thread = Timer(60, self.update_registration)
-            self._update_thread.start()
-        finally:
-            return
+            self.catalog.post("devices", {**UPDATE_BODY, "IP": self.broker, "P": self.port})
+        except CatalogUnavailable as error:
+            print(f"[{time.ctime()}] WARNING registration not updated, catalog unreachable ({error})")
 
     def send_temperature(self):
         """
@@ -148,17 +132,14 @@ class Thermometer:
                     {
                         "n": "temperature",
                         "v": randrange(20, 30, step=1) + 0.3,
-                        "u": "Cel"
+                        "u": "Cel",
+                        "t": time.time()
                     }
                 )
             )
             print(
                 f"[{time.ctime()}] TELEMETRY sent on topic: temperature/fake_thermometer/{FAKE_DEVICE_ID}"
             )
-
-            # Schedule to send temperature again after three seconds
-            self._temperature_thread = Timer(3, self.send_temperature)
-            self._temperature_thread.start()
         finally:
             return
 
@@ -183,4 +164,10 @@ def start_simulation():
 
 
 if __name__ == "__main__":
+    settings = load_settings()
+    CATALOG_IP_PORT.update(settings["catalog"])
+    FAKE_DEVICE_BROKER_PORT.update(
+        addr=settings["device_broker"]["ip"], port=settings["device_broker"]["port"]
+    )
+    profile_from_env()
     start_simulation()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Test the windows of the temperature statistics
+
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+
+    Copyright 2020 Angelo Cutaia
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+from typing import Optional
+import unittest
+
+# Internals
+from aggregation.windows import EventTimeAggregator, WindowedAggregator
+
+# -------------------------------------------------------------------------
+
+
+class TestEventTimeAggregator(unittest.TestCase):
+    """
+    Test the windows closed by the watermark, the late readings and the idle keys
+    """
+
+    def setUp(self):
+        """
+        Tumbling windows of 10 seconds, 2 seconds of disorder and 20 of lateness
+        """
+        self.windows = EventTimeAggregator(10, 10, (50,), max_delay=2, lateness=20)
+
+    def add(self, value: float, timestamp: float, arrival: Optional[float] = None):
+        """
+        Add a reading of the device
+
+        :param value: value of the reading
+        :param timestamp: event time
+        :param arrival: time of reception, default the event time
+        """
+        self.windows.add("device", value, timestamp, timestamp if arrival is None else arrival)
+
+    def results(self, now: float) -> list:
+        """
+        End, count and mean of the windows emitted
+
+        :param now: current time
+        """
+        return [(end, result["count"], result["mean"]) for _, end, result in self.windows.advance(now)]
+
+    def test_watermark(self):
+        """
+        Test that a window is emitted only when the watermark passes its end,
+        so a reading out of order by less than max_delay is still in it
+        """
+        self.add(20, 1)
+        self.add(22, 11)
+        self.assertEqual(self.results(11), [])
+        self.add(24, 9, arrival=11.5)
+        self.add(26, 12)
+        self.assertEqual(self.results(12), [(10, 2, 22)])
+        self.assertEqual(self.windows.counters, {"late": 0, "dropped": 0})
+
+    def test_late_reading(self):
+        """
+        Test that a window already emitted is emitted again with a late reading,
+        and a reading older than the lateness is dropped
+        """
+        self.add(20, 1)
+        self.add(22, 12)
+        self.assertEqual(self.results(12), [(10, 1, 20)])
+        self.add(30, 5, arrival=13)
+        self.assertEqual(self.results(13), [(10, 2, 25)])
+        self.assertEqual(self.windows.counters["late"], 1)
+
+        self.add(22, 35)
+        self.results(35)
+        self.add(30, 3, arrival=35)
+        self.assertEqual(self.results(35), [])
+        self.assertEqual(self.windows.counters["dropped"], 1)
+
+    def test_idle_key(self):
+        """
+        Test that the watermark of a key that stops sending advances with the clock
+        """
+        self.add(20, 1)
+        self.assertEqual(self.results(13.9), [])
+        self.assertEqual(self.results(14), [(10, 1, 20)])
+        self.assertEqual(self.results(100), [])
+
+
+class TestWindowedAggregator(unittest.TestCase):
+    """
+    Test the sliding windows by time of reception
+    """
+
+    def test_sliding(self):
+        """
+        Test that every result covers the last two panes, and that an idle key is dropped
+        """
+        windows = WindowedAggregator(20, 10, (50,))
+        windows.add("device", 10, 1)
+        windows.add("device", 20, 11)
+        results = [(end, result["count"], result["mean"]) for _, end, result in windows.advance(30)]
+        self.assertEqual(results, [(10, 1, 10), (20, 2, 15), (30, 1, 20)])
+        self.assertEqual(windows.advance(100), [])
+        windows.add("device", 30, 101)
+        self.assertEqual([end for _, end, _ in windows.advance(110)], [110])
@@ -39,11 +39,14 @@ class Catalog:
     Class that handles the catalog
     """
 
-    def __init__(self):
+    def __init__(self, broker: str = Broker.__ip__, broker_port: int = Broker.__port__):
         """
         Setup catalog root
+
+        :param broker: Address of the broker used by the catalog
+        :param broker_port: Port of the broker
         """
-        self.broker = Broker()  # "/broker"
+        self.broker = Broker(broker, broker_port)  # "/broker"
         self.devices = Device()  # "/devices"
         self.users = User()  # "/users"
         self.services = Service()  # "/services"
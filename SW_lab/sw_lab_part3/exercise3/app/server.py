@@ -27,9 +27,10 @@ import cherrypy
 from .catalog.root import Catalog
 from .catalog.database import DataBase
 from .catalog.mqtt.mqttcherrypy import MqttPlugin, save_device
+from .utils import Metrics
 
 # Setting
-from .catalog.settings import CATALOG_CONFIG, NO_AUTORELOAD
+from .catalog.settings import CATALOG_CONFIG, METRICS_CONFIG, NO_AUTORELOAD
 
 # -----------------------------------------------------------------------------
 
@@ -42,25 +43,39 @@ def setup():
     periodic_task.start()
 
 
-def start():
+def start(
+    host: str = "0.0.0.0",
+    port: int = 8080,
+    broker: str = "test.mosquitto.org",
+    broker_port: int = 1883,
+    db: str = DataBase.__db__
+):
     """
     Start the REST server
+
+    :param host: Address on which the server listens
+    :param port: Port on which the server listens
+    :param broker: MQTT broker used by the catalog and advertised on /catalog/broker
+    :param broker_port: Port of the MQTT broker
+    :param db: Path of the database
     """
+    DataBase.__db__ = db
 
     # Mount the Endpoints
-    cherrypy.tree.mount(Catalog(), "/catalog", CATALOG_CONFIG)
+    cherrypy.tree.mount(Catalog(broker, broker_port), "/catalog", CATALOG_CONFIG)
+    cherrypy.tree.mount(Metrics(), "/metrics", METRICS_CONFIG)
 
     # Update Server Config
     cherrypy.config.update(NO_AUTORELOAD)
-    cherrypy.config.update({"server.socket_host": "0.0.0.0"})
-    cherrypy.config.update({"server.socket_port": 8080})
+    cherrypy.config.update({"server.socket_host": host})
+    cherrypy.config.update({"server.socket_port": port})
     cherrypy.config.update({"request.show_tracebacks": False})
 
     # Start the Server
     cherrypy.engine.subscribe("start", setup())
     cherrypy.engine.subscribe("stop", periodic_task.cancel)
     MqttPlugin(
-        cherrypy.engine, "test.mosquitto.org", 1883, "catalog/devices"
+        cherrypy.engine, broker, broker_port, "catalog/devices"
     ).subscribe()
     cherrypy.engine.subscribe("catalog/devices", save_device)
     cherrypy.engine.signals.subscribe()
@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+"""
+Catalog benchmark
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+# Third Party
+from paho.mqtt.client import Client
+import requests
+
+# -----------------------------------------------------------------------------
+
+#############
+# CONSTANTS #
+#############
+
+DEVICE_PREFIX = "Bench"
+
+CATALOG_DEVICE_TOPIC = "catalog/devices"
+
+PERCENTILES = (50, 95, 99)
+
+# -----------------------------------------------------------------------------
+
+############
+# RECORDER #
+############
+
+
+def summary(values: List[float]) -> dict:
+    """
+    Summarize a list of latencies
+
+    :param values: latencies in milliseconds
+    :return: count, percentiles and max
+    """
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    result = {"count": len(values)}
+    for percentile in PERCENTILES:
+        result[f"p{percentile}"] = round(values[min(len(values) - 1, len(values) * percentile // 100)], 3)
+    result["max"] = round(values[-1], 3)
+    return result
+
+
+class Recorder:
+    """Thread safe collector of latencies and errors"""
+
+    def __init__(self):
+        """
+        Instantiate the recorder
+        """
+        self.latencies: List[float] = []
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def add(self, latency: float, error: bool = False):
+        """
+        Store a sample
+
+        :param latency: Latency in milliseconds
+        :param error: True if the operation failed
+        """
+        with self._lock:
+            self.latencies.append(latency)
+            if error:
+                self.errors += 1
+
+    def report(self, duration: float) -> dict:
+        """
+        Report of the collected samples
+
+        :param duration: Duration of the benchmark in seconds
+        :return: throughput, errors and latency percentiles
+        """
+        with self._lock:
+            return {
+                "requests": len(self.latencies),
+                "errors": self.errors,
+                "throughput": round(len(self.latencies) / duration, 3),
+                "latency_ms": summary(self.latencies),
+            }
+
+
+def paced(rate: float, stop: threading.Event):
+    """
+    Generate ticks at a fixed rate without accumulating drift
+
+    :param rate: ticks per second
+    :param stop: event that stops the generation
+    """
+    interval = 1 / rate
+    next_tick = time.monotonic()
+    while not stop.is_set():
+        yield
+        next_tick += interval
+        delay = next_tick - time.monotonic()
+        if delay > 0:
+            stop.wait(delay)
+
+
+def device_body(device_id: str, broker: str, port: int, protocol: str) -> str:
+    """
+    Registration body of a simulated device
+
+    :param device_id: Unique identifier of the device
+    :param broker: MQTT broker of the device
+    :param port: Port of the broker
+    :param protocol: MQTT or REST
+    :return: JSON accepted by the catalog
+    """
+    return json.dumps(
+        {
+            "ID": device_id,
+            "PROT": protocol,
+            "IP": broker if protocol == "MQTT" else "127.0.0.1",
+            "P": port if protocol == "MQTT" else 8000,
+            "ED": {"S": ["bench/temperature"], "A": ["bench/led"]},
+            "AR": ["Temp", "Led"]
+        }
+    )
+
+
+# -----------------------------------------------------------------------------
+
+###########
+# DEVICES #
+###########
+
+
+class RestDevices:
+    """Simulate devices that register themselves through POST /catalog/devices"""
+
+    def __init__(self, catalog: str, devices: int, rate: float, workers: int, timeout: float):
+        """
+        Instantiate the devices
+
+        :param catalog: Base url of the catalog
+        :param devices: Number of devices
+        :param rate: Registrations per second of all the devices
+        :param workers: Number of concurrent connections
+        :param timeout: Timeout of every request
+        """
+        self.url = f"{catalog}/catalog/devices"
+        self.bodies = [
+            device_body(f"{DEVICE_PREFIX}REST{index}", "", 0, "REST") for index in range(devices)
+        ]
+        self.ids = [f"{DEVICE_PREFIX}REST{index}" for index in range(devices)]
+        self.rate = rate
+        self.workers = workers
+        self.timeout = timeout
+        self.recorder = Recorder()
+        self.first_sent: Dict[str, float] = {}
+        self._local = threading.local()
+
+    def _session(self) -> requests.Session:
+        """
+        One session for every worker, so connections are reused
+        """
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _register(self, index: int, scheduled: float):
+        """
+        Register a device
+
+        :param index: Index of the device
+        :param scheduled: Time in which the registration was scheduled, the latency is measured from
+                          it so the time spent waiting for a free connection isn't hidden
+        """
+        self.first_sent.setdefault(self.ids[index], scheduled)
+        try:
+            result = self._session().post(
+                self.url,
+                data=self.bodies[index],
+                headers={"Content-Type": "application/json"},
+                timeout=self.timeout
+            )
+            error = result.status_code != 200
+        except requests.RequestException:
+            error = True
+        self.recorder.add((time.monotonic() - scheduled) * 1000, error)
+
+    def run(self, stop: threading.Event):
+        """
+        Register the devices round robin until stopped
+
+        :param stop: event that stops the simulation
+        """
+        if not self.bodies or self.rate <= 0:
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            index = 0
+            for _ in paced(self.rate, stop):
+                executor.submit(self._register, index, time.monotonic())
+                index = (index + 1) % len(self.bodies)
+
+
+class MqttDevices:
+    """Simulate devices that register themselves publishing on catalog/devices"""
+
+    def __init__(self, broker: str, port: int, devices: int, rate: float):
+        """
+        Instantiate the devices
+
+        :param broker: MQTT broker used by the catalog
+        :param port: Port of the broker
+        :param devices: Number of devices
+        :param rate: Registrations per second of all the devices
+        """
+        self.bodies = [
+            device_body(f"{DEVICE_PREFIX}MQTT{index}", broker, port, "MQTT") for index in range(devices)
+        ]
+        self.ids = [f"{DEVICE_PREFIX}MQTT{index}" for index in range(devices)]
+        self.rate = rate
+        self.client = Client(client_id=f"{DEVICE_PREFIX}{os.getpid()}")
+        self.broker = broker
+        self.port = port
+        self.published = 0
+        self.first_sent: Dict[str, float] = {}
+
+    def run(self, stop: threading.Event):
+        """
+        Publish the registrations round robin until stopped
+
+        :param stop: event that stops the simulation
+        """
+        if not self.bodies or self.rate <= 0:
+            return
+        self.client.connect(host=self.broker, port=self.port)
+        self.client.loop_start()
+        try:
+            index = 0
+            for _ in paced(self.rate, stop):
+                self.first_sent.setdefault(self.ids[index], time.monotonic())
+                self.client.publish(CATALOG_DEVICE_TOPIC, payload=self.bodies[index])
+                self.published += 1
+                index = (index + 1) % len(self.bodies)
+        finally:
+            self.client.loop_stop()
+            self.client.disconnect()
+
+
+# -----------------------------------------------------------------------------
+
+############
+# SERVICES #
+############
+
+
+class ServicePollers:
+    """Simulate services that poll GET /catalog/devices/all"""
+
+    def __init__(self, catalog: str, services: int, interval: float, timeout: float):
+        """
+        Instantiate the pollers
+
+        :param catalog: Base url of the catalog
+        :param services: Number of services
+        :param interval: Seconds between two polls of the same service
+        :param timeout: Timeout of every request
+        """
+        self.url = f"{catalog}/catalog/devices/all"
+        self.services = services
+        self.interval = interval
+        self.timeout = timeout
+        self.recorder = Recorder()
+        self.first_seen: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _poll(self, stop: threading.Event):
+        """
+        Poll the catalog until stopped
+
+        :param stop: event that stops the simulation
+        """
+        session = requests.Session()
+        for _ in paced(1 / self.interval, stop):
+            start = time.monotonic()
+            try:
+                result = session.get(self.url, timeout=self.timeout)
+                # 404 means that no device is registered yet
+                error = result.status_code not in (200, 404)
+                devices = result.json() if result.status_code == 200 else []
+            except (requests.RequestException, ValueError):
+                error = True
+                devices = []
+            now = time.monotonic()
+            self.recorder.add((now - start) * 1000, error)
+
+            with self._lock:
+                for device in devices:
+                    if device["deviceID"].startswith(DEVICE_PREFIX):
+                        self.first_seen.setdefault(device["deviceID"], now)
+
+    def run(self, stop: threading.Event) -> List[threading.Thread]:
+        """
+        Start all the pollers
+
+        :param stop: event that stops the simulation
+        :return: the threads of the pollers
+        """
+        threads = [
+            threading.Thread(target=self._poll, args=(stop,), name=f"Service{index}", daemon=True)
+            for index in range(self.services)
+        ]
+        for thread in threads:
+            thread.start()
+        return threads
+
+
+# -----------------------------------------------------------------------------
+
+##########
+# SQLITE #
+##########
+
+
+class LockProbe:
+    """
+    Measure the contention on the catalog database trying periodically
+    to acquire the write lock, exactly like the catalog does on every insert
+    """
+
+    def __init__(self, database: str, interval: float):
+        """
+        Instantiate the probe
+
+        :param database: Path of the catalog database
+        :param interval: Seconds between two probes
+        """
+        self.database = database
+        self.interval = interval
+        self.busy = 0
+        self.timeouts = 0
+        self.waits: List[float] = []
+
+    def _lock(self, timeout: float):
+        """
+        Acquire and release the write lock of the database
+
+        :param timeout: Seconds to wait for the lock
+        :raise sqlite3.OperationalError: the lock wasn't acquired in time
+        """
+        with closing(sqlite3.connect(self.database, timeout=timeout)) as con:
+            con.execute("BEGIN IMMEDIATE;")
+            con.rollback()
+
+    def run(self, stop: threading.Event):
+        """
+        Probe the database until stopped
+
+        :param stop: event that stops the simulation
+        """
+        if not os.path.exists(self.database):
+            return
+        for _ in paced(1 / self.interval, stop):
+            start = time.monotonic()
+            try:
+                self._lock(0)
+            except sqlite3.OperationalError:
+                # The lock is held by the catalog, wait for it
+                self.busy += 1
+                try:
+                    self._lock(5)
+                except sqlite3.OperationalError:
+                    self.timeouts += 1
+            self.waits.append((time.monotonic() - start) * 1000)
+
+    def report(self) -> dict:
+        """
+        Report of the contention
+
+        :return: number of probes, busy probes, probes that gave up and time waited for the lock
+        """
+        return {
+            "probes": len(self.waits),
+            "busy": self.busy,
+            "timeouts": self.timeouts,
+            "busy_ratio": round(self.busy / len(self.waits), 4) if self.waits else None,
+            "wait_ms": summary(self.waits),
+        }
+
+
+# -----------------------------------------------------------------------------
+
+#############
+# BENCHMARK #
+#############
+
+
+def visibility(first_sent: Dict[str, float], first_seen: Dict[str, float]) -> dict:
+    """
+    Time needed for a registration to be visible on GET /catalog/devices/all
+
+    :param first_sent: first registration of every device
+    :param first_seen: first time every device was seen by a service
+    :return: registered devices and latency percentiles
+    """
+    latencies = [
+        (first_seen[device] - sent) * 1000
+        for device, sent in first_sent.items()
+        if device in first_seen
+    ]
+    return {"expected": len(first_sent), "registered": len(latencies), "latency_ms": summary(latencies)}
+
+
+def run(args: argparse.Namespace) -> dict:
+    """
+    Run the benchmark
+
+    :param args: command line arguments
+    :return: machine readable report
+    """
+    stop = threading.Event()
+    rest = RestDevices(args.catalog, args.rest_devices, args.rest_rate, args.workers, args.timeout)
+    mqtt = MqttDevices(args.broker, args.port, args.mqtt_devices, args.mqtt_rate)
+    pollers = ServicePollers(args.catalog, args.services, args.poll_interval, args.timeout)
+    probe = LockProbe(args.db, args.probe_interval)
+
+    threads = [
+        threading.Thread(target=rest.run, args=(stop,), name="RestDevices", daemon=True),
+        threading.Thread(target=mqtt.run, args=(stop,), name="MqttDevices", daemon=True),
+        threading.Thread(target=probe.run, args=(stop,), name="LockProbe", daemon=True),
+    ]
+    print(f"[{time.ctime()}] BENCHMARK started for {args.duration} seconds", file=sys.stderr)
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    threads.extend(pollers.run(stop))
+
+    try:
+        stop.wait(args.duration)
+    except KeyboardInterrupt:
+        pass
+    stop.set()
+    for thread in threads:
+        thread.join()
+    duration = time.monotonic() - start
+    print(f"[{time.ctime()}] BENCHMARK finished", file=sys.stderr)
+
+    return {
+        "timestamp": int(time.time()),
+        "duration": round(duration, 3),
+        "config": vars(args),
+        "rest_registration": rest.recorder.report(duration),
+        "mqtt_registration": {
+            "published": mqtt.published,
+            "throughput": round(mqtt.published / duration, 3),
+        },
+        "registration_visibility": {
+            "REST": visibility(rest.first_sent, pollers.first_seen),
+            "MQTT": visibility(mqtt.first_sent, pollers.first_seen),
+        },
+        "polling": pollers.recorder.report(duration),
+        "sqlite": probe.report(),
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse the command line
+
+    :param argv: arguments to parse
+    :return: parsed arguments
+    """
+    parser = argparse.ArgumentParser(description="Load generator and benchmark for the catalog")
+    parser.add_argument("--catalog", default="http://127.0.0.1:8080", help="base url of the catalog")
+    parser.add_argument("--broker", default="127.0.0.1", help="MQTT broker used by the catalog")
+    parser.add_argument("--port", type=int, default=1883, help="port of the MQTT broker")
+    parser.add_argument("--rest-devices", type=int, default=1000, help="devices registering via REST")
+    parser.add_argument("--rest-rate", type=float, default=100, help="REST registrations per second")
+    parser.add_argument("--mqtt-devices", type=int, default=1000, help="devices registering via MQTT")
+    parser.add_argument("--mqtt-rate", type=float, default=100, help="MQTT registrations per second")
+    parser.add_argument("--services", type=int, default=10, help="services polling /catalog/devices/all")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between two polls")
+    parser.add_argument("--workers", type=int, default=32, help="concurrent REST connections")
+    parser.add_argument("--timeout", type=float, default=10.0, help="timeout of every request")
+    parser.add_argument("--duration", type=float, default=60.0, help="duration of the benchmark")
+    parser.add_argument("--db", default="catalog.db", help="database of the catalog")
+    parser.add_argument("--probe-interval", type=float, default=0.05, help="seconds between two lock probes")
+    parser.add_argument("--output", help="file in which store the report, default stdout")
+    parser.add_argument("--history", help="JSON lines file to which append the report")
+    return parser.parse_args(argv)
+
+
+def main():
+    """
+    Run the benchmark and store the report
+    """
+    args = parse_args()
+    report = run(args)
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.history:
+        with open(args.history, "a") as fp:
+            fp.write(json.dumps(report) + "\n")
+
+
+# -----------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    main()
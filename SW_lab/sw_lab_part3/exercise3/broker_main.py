@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Local MQTT broker entry point
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import argparse
+import json
+import threading
+import time
+
+# Internals
+from mqtt_broker.broker import Broker
+
+# -----------------------------------------------------------------------------
+
+
+def main():
+    """
+    Run the embedded broker until interrupted, periodically printing the per topic statistics
+    """
+    parser = argparse.ArgumentParser(description="Local MQTT 3.1.1 broker for tests and benchmarks")
+    parser.add_argument("--host", default="127.0.0.1", help="address to bind")
+    parser.add_argument("--port", type=int, default=1883, help="port to bind")
+    parser.add_argument("--stats-interval", type=float, default=10, help="seconds between two statistics prints")
+    parser.add_argument("--stats-output", help="file in which store the statistics at exit")
+    args = parser.parse_args()
+
+    try:
+        broker = Broker(args.host, args.port).start()
+    except OSError as error:
+        parser.exit(1, f"[{time.ctime()}] ERROR broker not started: {error}\n")
+    print(f"[{time.ctime()}] BROKER listening on {args.host}:{broker.port}")
+
+    stop = threading.Event()
+    try:
+        while not stop.wait(args.stats_interval):
+            for topic, stats in sorted(broker.stats.snapshot().items()):
+                print(f"[{time.ctime()}] {topic}: {stats['messages']} messages, {stats['rate']} msg/s")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.stop()
+        if args.stats_output:
+            with open(args.stats_output, "w") as fp:
+                json.dump(broker.stats.snapshot(), fp, indent=4)
+        print(f"[{time.ctime()}] EXIT")
+
+
+# -----------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    main()
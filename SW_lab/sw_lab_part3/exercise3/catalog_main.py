@@ -22,6 +22,22 @@ App entry point
 # REST Server
 from app import server
 
+# Configuration
+from configuration.loader import load_settings
+
+# Profiler
+from profiler.endpoint import mount_profiler
+from profiler.sampler import profile_from_env
+
 
 if __name__ == "__main__":
-    server.start()
+    settings = load_settings()
+    profile_from_env()
+    mount_profiler()
+    server.start(
+        host=settings["server"]["host"],
+        port=settings["server"]["port"],
+        broker=settings["broker"]["ip"],
+        broker_port=settings["broker"]["port"],
+        db=settings["server"]["db"]
+    )
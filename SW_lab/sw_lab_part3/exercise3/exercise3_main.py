@@ -16,18 +16,22 @@ Exercise3 sw_lab3
     limitations under the License.
 """
 # Standard Library
-from collections import defaultdict
-from functools import partial
 import json
-from random import randrange
-import sys
+import math
 import time
-from typing import Any, Dict, List, DefaultDict
-from threading import Timer, Lock
+from typing import Any, Dict, Optional, Tuple
+from threading import Lock
 
 # Third Party
 from paho.mqtt.client import Client, MQTTMessage
-import requests
+
+# Internals
+from configuration.loader import discover_broker, load_settings, register_defaults
+from profiler.sampler import profile_from_env
+from rules.engine import RangeRule, RuleEngine, Transition
+from runtime.http import catalog_client
+from runtime.scheduler import Task
+from runtime.service import CatalogService
 
 # -----------------------------------------------------------------------------
 
@@ -40,23 +44,34 @@ ARDUINO_UNIQUE_ID = "YUN"
 CATALOG_IP_PORT = {"ip": "0.0.0.0", "port": 8080}
 
 SERVICE_BROKER_PORT = {"ip": "test.mosquitto.org", "port": 1883}
-SERVICE_INFO = json.dumps(
-    {
-        "serviceID": "Exercise3/LabSw3",
-        "description": "Turn on LED for devices whose temperature is not in expected range of good functioning. "
-                       "Publish alarm status for each device",
-        "end_points": {
-            "MQTT": {
-                "broker": SERVICE_BROKER_PORT,
-                "subscribe": ["labsw3/arduino/alarm"]
-            }
+SERVICE_INFO = {
+    "serviceID": "Exercise3/LabSw3",
+    "description": "Turn on LED for devices whose temperature is not in expected range of good functioning. "
+                   "Publish alarm status for each device",
+    "end_points": {
+        "MQTT": {
+            "broker": SERVICE_BROKER_PORT,
+            "subscribe": ["labsw3/arduino/alarm"],
+            "publish": ["labsw3/arduino/thresholds"]
         }
     }
-)
+}
 RANGE = {
     "min": 0,
     "max": 30
 }
+# The alarm is raised outside RANGE and cleared once the temperature is back inside it
+# by at least hysteresis degrees. A state is held for at least hold_time seconds and,
+# if keep_alive is not 0, republished every keep_alive seconds even without transitions.
+# thresholds is the JSON file with the per-device thresholds, RANGE is used when empty.
+# If batch is not 0, readings are evaluated every batch seconds by the rule engine
+ALARM_POLICY = {
+    "hysteresis": 1.0,
+    "hold_time": 10.0,
+    "keep_alive": 0.0,
+    "thresholds": "",
+    "batch": 0.0
+}
 
 # -----------------------------------------------------------------------------
 
@@ -77,414 +92,361 @@ def find_arduino(data: dict) -> bool:
     return False
 
 
-class Service:
+def load_thresholds(path: str) -> dict:
+    """
+    Load the threshold table, in the form:
+    {
+        "default": {"min": 0, "max": 30},
+        "devices": {
+            "deviceID": {"min": 5, "max": 25, "resources": {"temperature topic": {"max": 22}}}
+        }
+    }
+    Every level overrides the limits of the previous one
+    :param path: JSON file, if empty only RANGE is used
+    :raise ValueError: the file gives invalid limits
+    """
+    table = {"default": dict(RANGE), "devices": {}}
+    if path:
+        with open(path) as fp:
+            table = merge_thresholds(table, json.load(fp))
+    return table
+
+
+def merge_thresholds(table: dict, update: dict) -> dict:
+    """
+    Merge an update into a copy of the threshold table. A device set to null
+    goes back to the default limits
+    :param table: threshold table, left unchanged
+    :param update: update in the same form of the table
+    :return: the merged table
+    :raise ValueError: the merged table has limits that are not numbers, or a min not below the max
+    """
+    merged = {"default": dict(table["default"]), "devices": dict(table["devices"])}
+    merged["default"].update(update.get("default", {}))
+    for device, profile in update.get("devices", {}).items():
+        if profile is None:
+            merged["devices"].pop(device, None)
+        else:
+            merged["devices"][device] = profile
+    check_thresholds(merged)
+    return merged
+
+
+def check_thresholds(table: dict):
+    """
+    Check the limits resolved at every level of the threshold table
+    :param table: threshold table
+    :raise ValueError: limits that are not numbers, or a min not below the max
+    """
+    def check(level: str, limits: dict):
+        for key in ("min", "max"):
+            value = limits.get(key)
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+                raise ValueError(f"{level} {key} is not a number: {value!r}")
+        if limits["min"] >= limits["max"]:
+            raise ValueError(f"{level} min {limits['min']} is not below max {limits['max']}")
+
+    check("default", table["default"])
+    for device, profile in table["devices"].items():
+        limits = dict(table["default"])
+        limits.update({key: profile[key] for key in ("min", "max") if key in profile})
+        check(device, limits)
+        for topic, resource in profile.get("resources", {}).items():
+            check(f"{device} {topic}", {**limits, **resource})
+
+
+class Service(CatalogService):
     """
     Service that publish informations about whether or not the devices are in expected range
     of good functioning
     """
 
-    _mqtt_client: Dict[str, Client] = {}
-    _device_list: Dict[str, dict] = {}
-    _broker: DefaultDict[str, set] = defaultdict(set)
-    _broker_port: Dict[str, int] = {}
-    _topic: DefaultDict[str, set] = defaultdict(set)
-    _update_thread: Timer = None
+    client_prefix = "AlarmService"
     alarm_topic = "labsw3/arduino/alarm"
+    threshold_topic = "labsw3/arduino/thresholds"
 
     def __init__(self):
         """
         Instantiate the service
         """
-        self.service = Client(client_id=f"AlarmService{randrange(1, 100000)}")
-        self.service.on_message = partial(self.my_on_message, led=self.service, service=self.service)
+        super().__init__(CATALOG_IP_PORT, SERVICE_BROKER_PORT, SERVICE_INFO)
+        self.service.message_callback_add(self.threshold_topic, self.on_thresholds)
         self.lock = Lock()
-        self.device_lock = Lock()
+        # Topic -> (device, led topics, (min, max)). Never modified in place: writers build a new
+        # dict under device_lock and swap it, so my_on_message can read it without locking
+        self._routes: Dict[str, Tuple[str, frozenset, Tuple[float, float]]] = {}
+        self._alarm_state: Dict[str, dict] = {}
+        self._thresholds = load_thresholds(ALARM_POLICY["thresholds"])
+        self.engine: Optional[RuleEngine] = None
+        self._engine_task: Optional[Task] = None
+        if ALARM_POLICY["batch"]:
+            self.engine = RuleEngine(
+                [
+                    RangeRule(
+                        "range",
+                        RANGE["min"],
+                        RANGE["max"],
+                        ALARM_POLICY["hysteresis"],
+                        limits=self._topic_limits
+                    )
+                ],
+                hold_time=ALARM_POLICY["hold_time"],
+                keep_alive=ALARM_POLICY["keep_alive"]
+            )
+        self.counters = {"transitions": 0, "keep_alive": 0, "suppressed": 0}
 
-    def _update(self, device_list: List[dict]):
+    def find(self, entry: dict) -> bool:
         """
-        Update reserved dicts
-        :param device_list: device list to add
+        Follow the arduino offering temperature and led
+        :param entry: device of the catalog
         """
-        for arduino in device_list:
-            device = arduino["deviceID"]
-            broker = arduino["end_points"]["MQTT"]["ip"]
-            port = arduino["end_points"]["MQTT"]["port"]
-            topics = {
-                topic
-                for topic in arduino["end_points"]["MQTT"]["end_points"]["subscribe"]
-                if "temp" in topic
-            }
-            led_topics = {
-                topic
-                for topic in arduino["end_points"]["MQTT"]["end_points"]["publish"]
-                if "led" in topic
-            }
-
-            self._device_list[device] = {
-                "ip": broker,
-                "temperature_topics": topics,
-                "led_topics": led_topics
-            }
-
-            self._broker_port[broker] = port
+        return find_arduino(entry)
 
-            self._broker[broker].update({device})
-            self._topic[broker].update(topics)
-
-            print(f"[{time.ctime()}] DEVICE {device} CONNECTED")
-
-    def setup(self, first_time: bool = True):
+    def describe(self, entry: dict) -> dict:
         """
-        Setup the service
+        Temperature and led topics of an arduino
+        :param entry: device of the catalog
         """
-        try:
-            print(f"[{time.ctime()}] EXTRACT info about all the devices registered")
-            result: requests.Response = requests.get(
-                url=f"http://{CATALOG_IP_PORT['ip']}:{CATALOG_IP_PORT['port']}/catalog/devices/all"
-            )
-            while result.status_code != 200:
-                print(
-                    f"[{time.ctime()}] WARNING no device registered found, retrying after 30 seconds"
-                )
-                time.sleep(30)
-                result: requests.Response = requests.get(
-                    url=f"http://{CATALOG_IP_PORT['ip']}:{CATALOG_IP_PORT['port']}"
-                    f"/catalog/devices/all"
-                )
-            print(f"[{time.ctime()}] DEVICES found")
-            data = json.loads(result.content.decode())
+        mqtt = entry["end_points"]["MQTT"]
+        return {
+            "ip": mqtt["ip"],
+            "port": mqtt["port"],
+            "topics": {topic for topic in mqtt["end_points"]["subscribe"] if "temp" in topic},
+            "led_topics": frozenset(topic for topic in mqtt["end_points"]["publish"] if "led" in topic)
+        }
 
-            print(
-                f"[{time.ctime()}] EXTRACT from the devices list info about ArduinoYUN"
-            )
-            device_list = [device for device in data if find_arduino(device)]
-            if len(device_list) == 0:
-                print(f"[{time.ctime()}] No ArduinoYUN found... retrying in 10 seconds")
-                time.sleep(10)
-                self.setup(first_time)
-                return
-        except KeyboardInterrupt:
-            print(f"[{time.ctime()}] EXIT")
-            if first_time:
-                sys.exit()
-            return
+    def added(self, records: Dict[str, dict]):
+        """
+        Route the temperatures of the new devices
+        :param records: new devices
+        """
+        routes = dict(self._routes)
+        for device, record in records.items():
+            for topic in record["topics"]:
+                routes[topic] = (device, record["led_topics"], self._limits(device, topic))
+        self._routes = routes
 
-        if first_time:
-            # Connect the service
-            self.service.connect(
-                host=SERVICE_BROKER_PORT["ip"], port=SERVICE_BROKER_PORT["port"]
-            )
-            print(
-                f"[{time.ctime()}] SERVICE CONNECTED to "
-                f"broker: {SERVICE_BROKER_PORT['ip']} "
-                f"on port: port={SERVICE_BROKER_PORT['port']}"
-            )
+    def removed(self, records: Dict[str, dict]):
+        """
+        Forget the routes and the alarm state of the devices removed
+        :param records: devices removed
+        """
+        routes = dict(self._routes)
+        for device, record in records.items():
+            for topic in record["topics"]:
+                routes.pop(topic, None)
+                if self.engine is not None:
+                    self.engine.forget(topic)
+            self._alarm_state.pop(device, None)
+        self._routes = routes
+
+    def connecting(self):
+        """
+        Listen to the updates of the thresholds
+        """
+        self.connections.subscribe(self.broker["ip"], self.broker["port"], [self.threshold_topic])
 
-        # Update registered devices and subscribe to all the topics
-        with self.device_lock:
-            self._update(device_list)
-            self.subscribe(device_list)
-
-        # Register inside the catalog
-        print(f"[{time.ctime()}] PING the Catalog on : {CATALOG_IP_PORT['ip']}")
-        requests.post(
-            f'http://{CATALOG_IP_PORT["ip"]}:{CATALOG_IP_PORT["port"]}/catalog/services',
-            data=SERVICE_INFO,
-            headers={"Content-Type": "application/json"}
+    def registered(self):
+        """
+        Report how many alarm status have been published
+        """
+        counters = self.counters if self.engine is None else self.engine.counters
+        print(
+            f"[{time.ctime()}] ALARM publishes: {counters['transitions']} transitions, "
+            f"{counters['keep_alive']} keep-alive, {counters['suppressed']} suppressed"
         )
 
-    def start(self):
+    def started(self):
         """
-        Start the service.
+        Evaluate the readings in micro-batches
         """
-        # Setup the service
-        self.setup()
+        if self.engine is not None:
+            self._engine_task = self.scheduler.call_every(ALARM_POLICY["batch"], self._evaluate_batches)
 
-        # Start all the external mqtt_clients
-        for broker in self._mqtt_client:
-            self._mqtt_client[broker].loop_start()
-
-        # Schedule the update of the registration
-        self._update_thread = Timer(60, self.update_registration)
-        self._update_thread.start()
-
-        try:
-            # Run the service forever
-            self.service.loop_forever()
-        except KeyboardInterrupt:
-            self.stop()
+    def stopping(self):
+        """
+        Stop the evaluation of the micro-batches
+        """
+        if self._engine_task is not None:
+            self._engine_task.cancel()
 
-    def my_on_message(self, client: Client, userdata: Any, msg: MQTTMessage, led: Client = None, service: Client = None):
+    def my_on_message(self, client: Client, userdata: Any, msg: MQTTMessage):
         """
         Check if the temperature is good. In case of bad values,
         turn on a led and send the alarm
-        :param client: MQTT client
+        :param client: MQTT client, used to control the led
         :param userdata: They could be any type
         :param msg: MQTT message
-        :param led: Led Client
-        :param service: Service Client
         """
-        def _device_led():
-            """
-            Find the arduino that generates the temperature telemetry
-            and the topic to control the led
-            """
-            with self.device_lock:
-                for device in self._device_list:
-                    if msg.topic in self._device_list[device]["temperature_topics"]:
-                        return device, self._device_list[device]["led_topics"]
+        # Find the arduino that generates the temperature telemetry
+        # and the topics to control the led
+        route = self._routes.get(msg.topic)
+        if route is None:
+            return
+        arduino, led_topics, limits = route
 
         data = json.loads(msg.payload.decode())
-        arduino, led_topics = _device_led()
+        if self.engine is not None:
+            self.engine.submit(msg.topic, data["v"])
+            return
 
         with self.lock:
-            if RANGE["min"] < data["v"] < RANGE["max"]:
-                for topic in led_topics:
-                    led.publish(
-                        topic,
-                        payload=json.dumps(
-                            {
-                                "n": "led",
-                                "v": 0,
-                                "u": None
-                            }
-                        )
-                    )
-                print(
-                    f"[{time.ctime()}] PUBLISHING Alarm status on topic: {self.alarm_topic}"
-                )
-                service.publish(
-                    self.alarm_topic,
-                    payload=json.dumps(
-                        {
-                            "device": arduino,
-                            "alarm": False
-                        }
-                    )
-                )
-            else:
-                for topic in led_topics:
-                    led.publish(
-                        topic,
-                        payload=json.dumps(
-                            {
-                                "n": "led",
-                                "v": 1,
-                                "u": None
-                            }
-                        )
-                    )
-                print(
-                    f"[{time.ctime()}] PUBLISHING Alarm status on topic: {self.alarm_topic}"
-                )
-                service.publish(
-                    self.alarm_topic,
-                    payload=json.dumps(
-                        {
-                            "device": arduino,
-                            "alarm": True
-                        }
-                    )
-                )
+            alarm = self._transition(arduino, data["v"], limits)
+            if alarm is None:
+                return
+            self._publish_alarm(arduino, led_topics, alarm, client)
 
-    def update_registration(self):
+    def _publish_alarm(self, arduino: str, led_topics: frozenset, alarm: bool, led: Client):
         """
-        Update service registration to the catalog
+        Publish the led command and the alarm status of a device
+        :param arduino: device
+        :param led_topics: topics to control the led
+        :param alarm: alarm status
+        :param led: Led Client
         """
-        print(f"[{time.ctime()}] EXTRACT info about all the devices registered")
-        result: requests.Response = requests.get(
-            url=f"http://{CATALOG_IP_PORT['ip']}:{CATALOG_IP_PORT['port']}/catalog/devices/all"
+        for topic in led_topics:
+            led.publish(
+                topic,
+                payload=json.dumps(
+                    {
+                        "n": "led",
+                        "v": int(alarm),
+                        "u": None
+                    }
+                )
+            )
+        print(
+            f"[{time.ctime()}] PUBLISHING Alarm status on topic: {self.alarm_topic}"
         )
-
-        # No device found
-        if result.status_code != 200:
-            self.reset()
-            return
-
-        data = json.loads(result.content.decode())
-        device_list = [device for device in data if find_arduino(device)]
-        if len(device_list) == 0:
-            self.reset()
-            return
-
-        # New Devices Found
-        new_devices = {arduino["deviceID"] for arduino in device_list}
-        # Old devices list
-        old_devices = set(self._device_list.keys())
-
-        # Check if there are updates to do
-        if old_devices == new_devices:
-            # No update, ping the catalog
-            print(f"[{time.ctime()}] PING the Catalog on : {CATALOG_IP_PORT['ip']}")
-            requests.post(
-                f'http://{CATALOG_IP_PORT["ip"]}:{CATALOG_IP_PORT["port"]}/catalog/services',
-                data=SERVICE_INFO,
-                headers={"Content-Type": "application/json"}
+        self.service.publish(
+            self.alarm_topic,
+            payload=json.dumps(
+                {
+                    "device": arduino,
+                    "alarm": alarm
+                }
             )
-            self._update_thread = Timer(60, self.update_registration)
-            self._update_thread.start()
-            return
-
-        with self.device_lock:
-            # Delete inactive devices
-            delete_list = {
-                arduino: self._device_list[arduino]
-                for arduino in self._device_list
-                if arduino not in new_devices
-            }
-            # Unsubscribe from devices
-            self.unsubscribe(delete_list)
-
-            # Update registered devices and subscribe
-            new_devices = [
-                arduino
-                for arduino in device_list
-                if arduino["deviceID"] not in old_devices
-            ]
-
-            self._update(new_devices)
-            self.subscribe(new_devices)
-
-        self._update_thread = Timer(60, self.update_registration)
-        self._update_thread.start()
+        )
 
-    def reset(self):
+    def _transition(self, device: str, value: float, limits: Tuple[float, float]) -> Optional[bool]:
         """
-        Reset the service
+        Update the alarm state of a device and decide if it has to be published,
+        following ALARM_POLICY
+        :param device: device that generated the telemetry
+        :param value: temperature
+        :param limits: (min, max) of the device
+        :return: alarm status to publish, None if nothing has to be published
         """
-        with self.device_lock:
-            self._clear()
-        self.setup(first_time=False)
-        # Start all the external mqtt_clients
-        for broker in self._mqtt_client:
-            self._mqtt_client[broker].loop_start()
-        self._update_thread = Timer(60, self.update_registration)
-        self._update_thread.start()
-
-    def unsubscribe(self, device_list: dict):
-        """
-        Unsubscribe from devices
-        :param device_list: device list
-        """
-        for arduino in device_list:
-            print(f"[{time.ctime()}] DEVICE {arduino} DISCONNECTED")
-            broker = device_list[arduino]["ip"]
-            topics = device_list[arduino]["temperature_topics"]
-
-            if broker == SERVICE_BROKER_PORT["ip"]:
-                for topic in topics:
-                    self.service.unsubscribe(topic)
-                    print(f"[{time.ctime()}] UNSUBSCRIBED from : {topic}")
-
-            else:
-                for topic in topics:
-                    self._mqtt_client[broker].unsubscribe(topic)
-                    print(f"[{time.ctime()}] UNSUBSCRIBED from : {topic}")
-
-            # Update topics
-            self._topic[broker] = self._topic[broker].difference(topics)
-
-            # Disconnect from external broker
-            if len(self._topic[broker]) == 0:
-                if broker != SERVICE_BROKER_PORT["ip"]:
-                    self._mqtt_client[broker].disconnect()
-                    self._mqtt_client[broker].loop_stop()
-                    print(f"[{time.ctime()}] DISCONNECTED from broker: {broker}")
-                    del self._mqtt_client[broker]
-
-                # Clean
-                del self._topic[broker]
-                del self._broker_port[broker]
-
-            # Delete device
-            del self._device_list[arduino]
-            self._broker[broker].discard(arduino)
-
-    def subscribe(self, device_list: List[dict]):
-        """
-        Subscribe to all the devices registered
-        :param device_list: list of device
-        """
-        for arduino in device_list:
-            broker = arduino["end_points"]["MQTT"]["ip"]
-            topics = {
-                topic
-                for topic in arduino["end_points"]["MQTT"]["end_points"]["subscribe"]
-                if "temp" in topic
-            }
-            # Subscribe to topics
-            if broker == SERVICE_BROKER_PORT["ip"]:
-                for topic in topics:
-                    self.service.subscribe(topic)
-                    print(f"[{time.ctime()}] SUBSCRIBED to : {topic}")
-
-            # Connect to external brokers
-            else:
-                if broker in self._mqtt_client:
-                    # Connection already made
-                    for topic in topics:
-                        self._mqtt_client[broker].subscribe(topic)
-                        print(f"[{time.ctime()}] SUBSCRIBED to : {topic}")
-                else:
-                    # Connect to the broker
-                    self._mqtt_client[broker] = Client(
-                        f"TemperatureMeanService{randrange(1, 1000000)}"
-                    )
-                    self._mqtt_client[broker].on_message = partial(
-                        self.my_on_message, led=self._mqtt_client[broker], service=self.service
-                    )
-                    self._mqtt_client[broker].connect(
-                        host=broker, port=self._broker_port[broker]
-                    )
-
-                    for topic in topics:
-                        self._mqtt_client[broker].subscribe(topic)
-                        print(f"[{time.ctime()}] SUBSCRIBED to : {topic}")
-
-    def _clear(self):
+        now = time.monotonic()
+        low, high = limits
+        in_range = low < value < high
+        state = self._alarm_state.get(device)
+
+        # First reading of the device
+        if state is None:
+            self._alarm_state[device] = {"alarm": not in_range, "changed": now, "published": now}
+            self.counters["transitions"] += 1
+            return not in_range
+
+        if state["alarm"]:
+            hysteresis = ALARM_POLICY["hysteresis"]
+            alarm = not (low + hysteresis < value < high - hysteresis)
+        else:
+            alarm = not in_range
+
+        if alarm != state["alarm"] and now - state["changed"] >= ALARM_POLICY["hold_time"]:
+            state.update(alarm=alarm, changed=now, published=now)
+            self.counters["transitions"] += 1
+            return alarm
+
+        if ALARM_POLICY["keep_alive"] and now - state["published"] >= ALARM_POLICY["keep_alive"]:
+            state["published"] = now
+            self.counters["keep_alive"] += 1
+            return state["alarm"]
+
+        self.counters["suppressed"] += 1
+        return None
+
+    def _limits(self, device: str, topic: str) -> Tuple[float, float]:
         """
-        Clear all the data stored
+        Resolve the limits of a resource from the threshold table
+        :param device: device
+        :param topic: temperature topic of the device
         """
-        # Unsubscribe from all topics
-        self.unsubscribe(self._device_list.copy())
+        limits = dict(self._thresholds["default"])
+        profile = self._thresholds["devices"].get(device, {})
+        limits.update({key: profile[key] for key in ("min", "max") if key in profile})
+        limits.update(profile.get("resources", {}).get(topic, {}))
+        return limits["min"], limits["max"]
 
-        # Disconnect from all the external brokers
-        for broker in self._mqtt_client:
-            self._mqtt_client[broker].disconnect()
-            self._mqtt_client[broker].loop_stop()
-            print(f"[{time.ctime()}] DISCONNECTED from broker: {broker}")
-
-        # Clear
-        self._mqtt_client.clear()
-        self._device_list.clear()
-        self._broker.clear()
-        self._broker_port.clear()
-        self._topic.clear()
-
-    def stop(self):
+    def _topic_limits(self, topic: str) -> Tuple[float, float]:
         """
-        Stop the service
+        Limits of a temperature topic, used by the rule engine
+        :param topic: temperature topic
         """
-        # Stop the schedule
-        self._update_thread.cancel()
+        route = self._routes.get(topic)
+        if route is None:
+            return self._thresholds["default"]["min"], self._thresholds["default"]["max"]
+        return route[2]
 
-        # Wait for the threads to finish
-        if self._update_thread.is_alive():
-            self._update_thread.join()
+    def _evaluate_batches(self):
+        """
+        Evaluate the readings collected by the rule engine and publish the transitions,
+        run every ALARM_POLICY["batch"] seconds
+        """
+        for transition in self.engine.flush():
+            self._publish_transition(transition)
 
-        # Disconnect the clients
-        print(f"[{time.ctime()}] SHUTTING DOWN")
-        for client in self._mqtt_client:
-            self._mqtt_client[client].disconnect()
-            self._mqtt_client[client].loop_stop()
-        # Disconnect the service
-        self.service.disconnect()
-        print(f"[{time.ctime()}] EXIT")
+    def _publish_transition(self, transition: Transition):
+        """
+        Publish a transition returned by the rule engine
+        :param transition: transition of a temperature topic
+        """
+        route = self._routes.get(transition.device)
+        if route is None:
+            return
+        arduino, led_topics, _ = route
+        with self.device_lock:
+            record = self._device_list.get(arduino)
+        if record is None:
+            return
+        led = self.connections.client(record["ip"])
+        with self.lock:
+            self._publish_alarm(arduino, led_topics, transition.active, led)
 
+    def on_thresholds(self, client: Client, userdata: Any, msg: MQTTMessage):
+        """
+        Apply an update of the threshold table received on the control topic
+        :param client: MQTT client
+        :param userdata: They could be any type
+        :param msg: MQTT message
+        """
+        try:
+            update = json.loads(msg.payload.decode())
+            # Validated on a copy, an invalid update leaves the current table in place
+            thresholds = merge_thresholds(self._thresholds, update)
+            with self.device_lock:
+                self._thresholds = thresholds
+                self._routes = {
+                    topic: (device, led_topics, self._limits(device, topic))
+                    for topic, (device, led_topics, _) in self._routes.items()
+                }
+            if self.engine is not None:
+                self.engine.refresh()
+        except (ValueError, KeyError, TypeError, AttributeError) as error:
+            print(f"[{time.ctime()}] WARNING invalid thresholds update: {error}")
+            return
+        print(f"[{time.ctime()}] THRESHOLDS updated")
 
 # -----------------------------------------------------------------------------------------------------------
 
 
 if __name__ == "__main__":
+    register_defaults("alarm", ALARM_POLICY)
+    settings = load_settings()
+    CATALOG_IP_PORT.update(settings["catalog"])
+    ALARM_POLICY.update(settings["alarm"])
+    SERVICE_BROKER_PORT.update(discover_broker(CATALOG_IP_PORT, session=catalog_client(CATALOG_IP_PORT).session))
+    profile_from_env()
     service = Service()
     service.start()
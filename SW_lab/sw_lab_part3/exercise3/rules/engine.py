@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+"""
+Vectorised rule engine
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+from collections import namedtuple
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Third Party
+import numpy as np
+
+# ---------------------------------------------------------------
+
+INITIAL_CAPACITY = 1024
+"""Devices for which the state arrays are allocated, they double when full"""
+
+Transition = namedtuple("Transition", ["device", "rule", "active", "value"])
+"""State of a rule for a device that has to be published"""
+
+# ---------------------------------------------------------------
+
+
+def _grow(array: np.ndarray, capacity: int, fill) -> np.ndarray:
+    """
+    Return a copy of the array with the new capacity, the new elements are set to fill
+
+    :param array: array to grow
+    :param capacity: new capacity
+    :param fill: value of the new elements
+    """
+    grown = np.full(capacity, fill, dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class Batch:
+    """
+    Micro-batch of readings sorted by device. The readings of the same device
+    keep their arrival order, so every device is a contiguous group starting at starts
+    """
+
+    __slots__ = (
+        "index", "value", "time", "prev_value", "prev_time", "has_prev",
+        "devices", "starts", "counts", "last", "now"
+    )
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+
+# ---------------------------------------------------------------
+
+#########
+# RULES #
+#########
+
+
+class Rule:
+    """
+    A rule evaluates a whole batch at once and returns, for the devices it looked at,
+    whether it is active. Per-device parameters are kept in arrays indexed like the engine state
+    """
+
+    needs_readings = True
+    """If False the rule is evaluated even when no reading arrived"""
+
+    def __init__(self, name: str):
+        """
+        :param name: name of the rule, reported in the transitions
+        """
+        self.name = name
+
+    def resize(self, capacity: int):
+        """
+        Grow the per-device arrays
+
+        :param capacity: new capacity
+        """
+
+    def register(self, index: int, device: str):
+        """
+        Set the parameters of a device
+
+        :param index: index of the device
+        :param device: device
+        """
+
+    def forget(self, index: int):
+        """
+        Reset the state of a removed device
+
+        :param index: index of the device
+        """
+
+    def evaluate(self, batch: Batch, active: np.ndarray, engine: "RuleEngine") -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Evaluate the rule
+
+        :param batch: readings to evaluate
+        :param active: current state of the rule for every device
+        :param engine: engine that owns the rule
+        :return: indexes of the devices evaluated and the new state of the rule for them
+        """
+        raise NotImplementedError
+
+
+class RangeRule(Rule):
+    """
+    Active when the last reading of a device is outside (low, high), as when every message
+    is evaluated on arrival. Once active, the reading must be back inside the range by hysteresis to clear it
+    """
+
+    def __init__(
+        self,
+        name: str,
+        low: float,
+        high: float,
+        hysteresis: float = 0.0,
+        limits: Optional[Callable[[str], Tuple[float, float]]] = None
+    ):
+        """
+        :param name: name of the rule
+        :param low: default lower limit
+        :param high: default upper limit
+        :param hysteresis: margin needed to clear the rule
+        :param limits: function returning the (low, high) limits of a device, if None the defaults are used
+        """
+        super().__init__(name)
+        self.default = (low, high)
+        self.hysteresis = hysteresis
+        self.limits = limits
+        self.low = np.empty(0)
+        self.high = np.empty(0)
+
+    def resize(self, capacity: int):
+        self.low = _grow(self.low, capacity, self.default[0])
+        self.high = _grow(self.high, capacity, self.default[1])
+
+    def register(self, index: int, device: str):
+        if self.limits is not None:
+            self.low[index], self.high[index] = self.limits(device)
+
+    def evaluate(self, batch: Batch, active: np.ndarray, engine: "RuleEngine") -> Tuple[np.ndarray, np.ndarray]:
+        devices = batch.devices
+        value = batch.value[batch.last]
+        margin = np.where(active[devices], self.hysteresis, 0.0)
+        return devices, (value <= self.low[devices] + margin) | (value >= self.high[devices] - margin)
+
+
+class RateOfChangeRule(Rule):
+    """
+    Active when the value changes faster than max_rate units per second
+    between two consecutive readings of the same device
+    """
+
+    def __init__(self, name: str, max_rate: float):
+        """
+        :param name: name of the rule
+        :param max_rate: maximum change per second
+        """
+        super().__init__(name)
+        self.max_rate = max_rate
+
+    def evaluate(self, batch: Batch, active: np.ndarray, engine: "RuleEngine") -> Tuple[np.ndarray, np.ndarray]:
+        elapsed = batch.time - batch.prev_time
+        valid = batch.has_prev & (elapsed > 0)
+        change = np.abs(batch.value - batch.prev_value)
+        fast = valid & (change > self.max_rate * np.where(valid, elapsed, 0.0))
+        return batch.devices, np.logical_or.reduceat(fast, batch.starts)
+
+
+class MovingAverageRule(Rule):
+    """
+    Active when the exponential moving average of a device is outside (low, high)
+    """
+
+    def __init__(self, name: str, alpha: float, low: float, high: float):
+        """
+        :param name: name of the rule
+        :param alpha: weight of the newest reading, between 0 and 1
+        :param low: lower limit
+        :param high: upper limit
+        """
+        super().__init__(name)
+        self.alpha = alpha
+        self.low = low
+        self.high = high
+        self.average = np.empty(0)
+
+    def resize(self, capacity: int):
+        self.average = _grow(self.average, capacity, np.nan)
+
+    def forget(self, index: int):
+        self.average[index] = np.nan
+
+    def evaluate(self, batch: Batch, active: np.ndarray, engine: "RuleEngine") -> Tuple[np.ndarray, np.ndarray]:
+        decay = 1 - self.alpha
+        # Position of every reading inside the group of its device
+        position = np.arange(len(batch)) - np.repeat(batch.starts, batch.counts)
+        weights = self.alpha * decay ** (np.repeat(batch.counts, batch.counts) - 1 - position)
+
+        previous = self.average[batch.devices]
+        previous = np.where(np.isnan(previous), batch.value[batch.starts], previous)
+        average = decay ** batch.counts * previous + np.add.reduceat(weights * batch.value, batch.starts)
+        self.average[batch.devices] = average
+        return batch.devices, (average <= self.low) | (average >= self.high)
+
+
+class MissingDataRule(Rule):
+    """
+    Active when a device hasn't sent readings for more than timeout seconds
+    """
+
+    needs_readings = False
+
+    def __init__(self, name: str, timeout: float):
+        """
+        :param name: name of the rule
+        :param timeout: seconds without readings after which the rule is active
+        """
+        super().__init__(name)
+        self.timeout = timeout
+
+    def evaluate(self, batch: Batch, active: np.ndarray, engine: "RuleEngine") -> Tuple[np.ndarray, np.ndarray]:
+        devices = np.flatnonzero(engine.seen[:engine.size])
+        return devices, batch.now - engine.last_time[devices] > self.timeout
+
+
+# ---------------------------------------------------------------
+
+##########
+# ENGINE #
+##########
+
+
+class RuleEngine:
+    """
+    Collect readings from any thread and evaluate all the rules on micro-batches.
+    Only state transitions (and optional keep-alive) are returned by flush
+    """
+
+    def __init__(
+        self,
+        rules: List[Rule],
+        hold_time: float = 0.0,
+        keep_alive: float = 0.0,
+        capacity: int = INITIAL_CAPACITY
+    ):
+        """
+        :param rules: rules to evaluate
+        :param hold_time: minimum seconds between two transitions of a rule for a device
+        :param keep_alive: seconds after which an unchanged state is returned again, 0 disabled
+        :param capacity: initial number of devices
+        """
+        self.rules = rules
+        self.hold_time = hold_time
+        self.keep_alive = keep_alive
+        self.counters = {"readings": 0, "batches": 0, "transitions": 0, "keep_alive": 0, "suppressed": 0}
+        self.size = 0
+
+        self._lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._index: Dict[str, int] = {}
+        self._devices: List[str] = []
+        self._pending_index: List[int] = []
+        self._pending_value: List[float] = []
+        self._pending_time: List[float] = []
+
+        self.last_value = np.empty(0)
+        self.last_time = np.empty(0)
+        self.seen = np.empty(0, dtype=bool)
+        self._active = [np.empty(0, dtype=bool) for _ in rules]
+        self._changed = [np.empty(0) for _ in rules]
+        self._published = [np.empty(0) for _ in rules]
+        self._resize(capacity)
+
+    def _resize(self, capacity: int):
+        """
+        Grow the state arrays
+
+        :param capacity: new capacity
+        """
+        self.last_value = _grow(self.last_value, capacity, np.nan)
+        self.last_time = _grow(self.last_time, capacity, np.nan)
+        self.seen = _grow(self.seen, capacity, False)
+        self._active = [_grow(array, capacity, False) for array in self._active]
+        self._changed = [_grow(array, capacity, -np.inf) for array in self._changed]
+        self._published = [_grow(array, capacity, -np.inf) for array in self._published]
+        for rule in self.rules:
+            rule.resize(capacity)
+
+    def _register(self, device: str) -> int:
+        """
+        Assign an index to a new device
+
+        :param device: device
+        :return: index of the device
+        """
+        with self._state_lock:
+            index = self.size
+            if index == len(self.seen):
+                self._resize(2 * len(self.seen))
+            for rule in self.rules:
+                rule.register(index, device)
+            self._devices.append(device)
+            self._index[device] = index
+            self.size += 1
+        return index
+
+    def submit(self, device: str, value: float, timestamp: Optional[float] = None):
+        """
+        Add a reading to the next batch
+
+        :param device: device, or resource, that generated the reading
+        :param value: value of the reading
+        :param timestamp: time of the reading, default now
+        """
+        with self._lock:
+            index = self._index.get(device)
+            if index is None:
+                index = self._register(device)
+            self._pending_index.append(index)
+            self._pending_value.append(value)
+            self._pending_time.append(time.time() if timestamp is None else timestamp)
+
+    def forget(self, device: str):
+        """
+        Reset the state of a device that is not monitored anymore
+
+        :param device: device
+        """
+        with self._lock, self._state_lock:
+            index = self._index.get(device)
+            if index is None:
+                return
+            self.seen[index] = False
+            self.last_value[index] = self.last_time[index] = np.nan
+            for state in self._active:
+                state[index] = False
+            for timestamps in self._changed + self._published:
+                timestamps[index] = -np.inf
+            for rule in self.rules:
+                rule.forget(index)
+
+    def refresh(self):
+        """
+        Reload the parameters of all the devices, e.g. after a change of the limits
+        """
+        with self._state_lock:
+            for index, device in enumerate(self._devices):
+                for rule in self.rules:
+                    rule.register(index, device)
+
+    def _batch(self, index: List[int], value: List[float], timestamps: List[float], now: float) -> Batch:
+        """
+        Build a batch sorted by device
+
+        :param index: indexes of the devices
+        :param value: values of the readings
+        :param timestamps: time of the readings
+        :param now: time of the evaluation
+        """
+        batch = Batch()
+        batch.now = now
+        index = np.asarray(index, dtype=np.intp)
+        order = np.argsort(index, kind="stable")
+        batch.index = index[order]
+        batch.value = np.asarray(value, dtype=float)[order]
+        batch.time = np.asarray(timestamps, dtype=float)[order]
+
+        first = np.ones(len(batch.index), dtype=bool)
+        first[1:] = batch.index[1:] != batch.index[:-1]
+        batch.starts = np.flatnonzero(first)
+        batch.counts = np.diff(np.append(batch.starts, len(batch.index)))
+        batch.last = batch.starts + batch.counts - 1
+        batch.devices = batch.index[batch.starts]
+
+        # Previous reading: the one before in the batch or the last one of the device
+        batch.prev_value = np.roll(batch.value, 1)
+        batch.prev_time = np.roll(batch.time, 1)
+        batch.has_prev = ~first
+        batch.prev_value[batch.starts] = self.last_value[batch.devices]
+        batch.prev_time[batch.starts] = self.last_time[batch.devices]
+        batch.has_prev[batch.starts] = self.seen[batch.devices]
+        return batch
+
+    def _publishable(self, rule: int, devices: np.ndarray, state: np.ndarray, now: float) -> np.ndarray:
+        """
+        Apply hold time and keep-alive to the new state of a rule
+
+        :param rule: index of the rule
+        :param devices: devices evaluated
+        :param state: new state of the rule for them
+        :param now: time of the evaluation
+        :return: devices whose state has to be published
+        """
+        active = self._active[rule]
+        changed = self._changed[rule]
+        published = self._published[rule]
+
+        transition = (state != active[devices]) & (now - changed[devices] >= self.hold_time)
+        first = published[devices] == -np.inf
+        if self.keep_alive:
+            alive = ~transition & ~first & (now - published[devices] >= self.keep_alive)
+        else:
+            alive = np.zeros(len(devices), dtype=bool)
+
+        active[devices[transition]] = state[transition]
+        changed[devices[transition]] = now
+        publish = devices[transition | alive | first]
+        published[publish] = now
+
+        self.counters["transitions"] += int(np.count_nonzero(transition | first))
+        self.counters["keep_alive"] += int(np.count_nonzero(alive))
+        if self.rules[rule].needs_readings:
+            self.counters["suppressed"] += len(devices) - len(publish)
+        return publish
+
+    def flush(self, now: Optional[float] = None) -> List[Transition]:
+        """
+        Evaluate the readings collected since the last flush
+
+        :param now: time of the evaluation, default now
+        :return: transitions to publish
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            index, value, timestamps = self._pending_index, self._pending_value, self._pending_time
+            self._pending_index, self._pending_value, self._pending_time = [], [], []
+
+        transitions = []
+        with self._state_lock:
+            batch = self._batch(index, value, timestamps, now)
+            self.last_value[batch.devices] = batch.value[batch.last]
+            self.last_time[batch.devices] = batch.time[batch.last]
+            self.seen[batch.devices] = True
+            self.counters["readings"] += len(batch)
+            self.counters["batches"] += 1
+
+            for position, rule in enumerate(self.rules):
+                if rule.needs_readings and len(batch) == 0:
+                    continue
+                devices, state = rule.evaluate(batch, self._active[position], self)
+                publish = self._publishable(position, devices, state, now)
+                transitions.extend(
+                    Transition(self._devices[device], rule.name, active, last)
+                    for device, active, last in zip(
+                        publish.tolist(),
+                        self._active[position][publish].tolist(),
+                        self.last_value[publish].tolist()
+                    )
+                )
+        return transitions
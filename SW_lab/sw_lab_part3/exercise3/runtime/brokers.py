@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+MQTT connection manager
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+from collections import Counter
+from random import randrange
+import socket
+from threading import Lock
+import time
+from typing import Callable, Dict, Iterable, Set
+
+# Third Party
+from paho.mqtt.client import Client
+
+# ---------------------------------------------------------------
+
+
+class Connections:
+    """
+    MQTT connections of a service: the client of the service broker plus one client
+    for every other broker, shared by all the topics on that broker, opened with
+    the first subscription and closed when its last topic is unsubscribed.
+    Connections are asynchronous: subscriptions are counted per topic, sent at once
+    to the brokers connected and sent by the others when they (re)connect
+    """
+
+    def __init__(self, service: Client, broker: dict, on_message: Callable, prefix: str):
+        """
+        Instantiate the manager
+
+        :param service: client connected to the service broker
+        :param broker: address of the service broker {"ip": .., "port": ..}, read at every call
+        :param on_message: callback of the messages received by the other clients
+        :param prefix: prefix of the client id of the other clients
+        """
+        self.service = service
+        self.broker = broker
+        self.on_message = on_message
+        self.prefix = prefix
+        self._clients: Dict[str, Client] = {}
+        self._topics: Dict[str, Counter] = {}
+        self._connected: Set[str] = set()
+        # _lock serialises subscriptions and unsubscriptions, _state_lock only guards the counters
+        # and is never held while calling the clients, since on_connect runs inside their network loop
+        self._lock = Lock()
+        self._state_lock = Lock()
+        service.on_connect = self._on_connect_callback(broker["ip"], service)
+        service.on_disconnect = self._on_disconnect_callback(broker["ip"])
+
+    def client(self, broker: str) -> Client:
+        """
+        Client connected to a broker
+
+        :param broker: ip of the broker
+        :return: the client of the broker, the service client for the service broker
+        """
+        if broker == self.broker["ip"]:
+            return self.service
+        return self._clients.get(broker, self.service)
+
+    def subscribe(self, broker: str, port: int, topics: Iterable[str]):
+        """
+        Subscribe to topics of a broker, connecting to it if needed
+
+        :param broker: ip of the broker
+        :param port: port of the broker
+        :param topics: topics to subscribe to
+        """
+        with self._lock:
+            client = self.client(broker)
+            if broker != self.broker["ip"] and broker not in self._clients:
+                client = Client(f"{self.prefix}{randrange(1, 1000000)}")
+                client.on_message = self.on_message
+                client.on_connect = self._on_connect_callback(broker, client)
+                client.on_disconnect = self._on_disconnect_callback(broker)
+                client.connect_async(host=broker, port=port)
+                client.loop_start()
+                self._clients[broker] = client
+                print(f"[{time.ctime()}] CONNECTING to broker: {broker} on port: {port}")
+
+            with self._state_lock:
+                counter = self._topics.setdefault(broker, Counter())
+                new_topics = [topic for topic in topics if counter[topic] == 0]
+                counter.update(topics)
+                if broker not in self._connected:
+                    # Sent by on_connect
+                    return
+            for topic in new_topics:
+                client.subscribe(topic)
+                print(f"[{time.ctime()}] SUBSCRIBED to : {topic}")
+
+    def unsubscribe(self, broker: str, topics: Iterable[str]):
+        """
+        Unsubscribe from topics of a broker, disconnecting from it after the last one
+
+        :param broker: ip of the broker
+        :param topics: topics to unsubscribe from
+        """
+        with self._lock:
+            client = self.client(broker)
+            with self._state_lock:
+                counter = self._topics.get(broker, Counter())
+                old_topics = []
+                for topic in topics:
+                    if counter[topic] <= 1:
+                        counter.pop(topic, None)
+                        old_topics.append(topic)
+                    else:
+                        counter[topic] -= 1
+                if not counter:
+                    self._topics.pop(broker, None)
+            for topic in old_topics:
+                client.unsubscribe(topic)
+                print(f"[{time.ctime()}] UNSUBSCRIBED from : {topic}")
+
+            if not counter and broker in self._clients:
+                self._disconnect(broker)
+
+    def move(self, broker: dict):
+        """
+        Move the service client to another service broker, its topics are subscribed on the new
+        one as soon as it's connected. The entries on the old broker have to be unsubscribed before,
+        since all the topics of the old broker follow the service client
+
+        :param broker: address of the new service broker {"ip": .., "port": ..}
+        """
+        with self._lock:
+            old = self.broker["ip"]
+            if broker["ip"] in self._clients:
+                self._disconnect(broker["ip"])
+            with self._state_lock:
+                topics = self._topics.pop(old, Counter())
+                topics.update(self._topics.pop(broker["ip"], Counter()))
+                if topics:
+                    self._topics[broker["ip"]] = topics
+                self._connected.discard(old)
+            # Updated in place, the registration of the service advertises the new broker too
+            self.broker.update(broker)
+            self.service.on_connect = self._on_connect_callback(broker["ip"], self.service)
+            self.service.on_disconnect = self._on_disconnect_callback(broker["ip"])
+            # The network loop connects to the new broker at its next attempt...
+            self.service.connect_async(host=broker["ip"], port=broker["port"])
+            sock = self.service.socket()
+        print(f"[{time.ctime()}] MOVING to broker: {broker['ip']} on port: {broker['port']}")
+        if sock is not None:
+            # ...that follows the connection to the old one, closed here
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def clear(self):
+        """
+        Disconnect from all the brokers but the service one
+        """
+        with self._lock:
+            for broker in list(self._clients):
+                self._disconnect(broker)
+            with self._state_lock:
+                self._topics = {
+                    broker: counter for broker, counter in self._topics.items() if broker == self.broker["ip"]
+                }
+
+    def _disconnect(self, broker: str):
+        """
+        Disconnect the client of a broker
+
+        :param broker: ip of the broker
+        """
+        client = self._clients.pop(broker)
+        client.disconnect()
+        client.loop_stop()
+        with self._state_lock:
+            self._connected.discard(broker)
+        print(f"[{time.ctime()}] DISCONNECTED from broker: {broker}")
+
+    def _on_connect_callback(self, broker: str, client: Client) -> Callable:
+        """
+        Build the callback that sends the subscriptions of a client when it (re)connects
+
+        :param broker: ip of the broker
+        :param client: client of the broker
+        """
+
+        def on_connect(mqtt_client: Client, userdata, flags: dict, rc: int):
+            if rc != 0:
+                print(f"[{time.ctime()}] WARNING connection to broker: {broker} refused, code {rc}")
+                return
+            with self._state_lock:
+                self._connected.add(broker)
+                topics = list(self._topics.get(broker, ()))
+            for topic in topics:
+                client.subscribe(topic)
+            print(f"[{time.ctime()}] CONNECTED to broker: {broker}, {len(topics)} subscriptions sent")
+
+        return on_connect
+
+    def _on_disconnect_callback(self, broker: str) -> Callable:
+        """
+        Build the callback that marks a broker as disconnected, until the client reconnects
+
+        :param broker: ip of the broker
+        """
+
+        def on_disconnect(mqtt_client: Client, userdata, rc: int):
+            with self._state_lock:
+                self._connected.discard(broker)
+            if rc != 0:
+                print(f"[{time.ctime()}] WARNING connection lost with broker: {broker}, reconnecting")
+
+        return on_disconnect
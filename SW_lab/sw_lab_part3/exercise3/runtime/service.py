@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Base of the services driven by the catalog
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+from random import randrange
+from threading import Lock
+import time
+from typing import Any, Dict, List, Optional
+
+# Third Party
+from paho.mqtt.client import Client, MQTTMessage
+
+# Internals
+from .brokers import Connections
+from .http import Backoff, CatalogUnavailable, catalog_client
+from .scheduler import Scheduler, Task
+
+# ---------------------------------------------------------------
+
+UPDATE_INTERVAL = 60
+"""Seconds between two updates of the registration"""
+
+
+class CatalogService:
+    """
+    Service that follows the entries (devices or other services) registered in the catalog:
+    it discovers them in background, subscribes to their topics, keeps the list updated and
+    pings the catalog to stay registered. Subclasses only choose the entries to follow
+    and handle the messages, through the hooks:
+        find(entry): True if the entry has to be followed
+        describe(entry): broker, port and topics of an entry, plus what the subclass needs
+        my_on_message(client, userdata, msg): message received from a followed entry
+        added(records), removed(records): entries just followed or forgotten, under device_lock
+        connecting(): the service client is connecting
+        registered(): the registration has been updated
+        started(), stopping(): start and stop of the service
+    """
+
+    resource = "devices"
+    """Catalog collection of the entries, devices or services"""
+
+    key = "deviceID"
+    """Field that identifies an entry"""
+
+    kind = "DEVICE"
+    """Name of an entry in the logs"""
+
+    label = "ArduinoYUN"
+    """Name of the entries followed in the logs"""
+
+    client_prefix = "Service"
+    """Prefix of the MQTT client ids"""
+
+    def __init__(self, catalog: dict, broker: dict, info: dict, client_id: Optional[str] = None):
+        """
+        Instantiate the service
+
+        :param catalog: address of the catalog {"ip": .., "port": ..}
+        :param broker: address of the service broker {"ip": .., "port": ..}
+        :param info: registration of the service in the catalog
+        :param client_id: client id on the service broker, random if not given
+        """
+        self.broker = broker
+        self.info = info
+        self.catalog = catalog_client(catalog)
+        self.scheduler = Scheduler()
+        self.service = Client(client_id=client_id or f"{self.client_prefix}{randrange(1, 100000)}")
+        self.service.on_message = self.my_on_message
+        self.connections = Connections(self.service, broker, self.my_on_message, self.client_prefix)
+        self.device_lock = Lock()
+        self._device_list: Dict[str, dict] = {}
+        self._update_task: Optional[Task] = None
+        self._backoff = Backoff(jitter=0.5)
+
+    # Hooks
+
+    def find(self, entry: dict) -> bool:
+        """
+        Check if an entry of the catalog has to be followed
+
+        :param entry: entry of the catalog
+        """
+        raise NotImplementedError
+
+    def describe(self, entry: dict) -> dict:
+        """
+        Describe a device followed: broker, port and the topics to subscribe to
+
+        :param entry: entry of the catalog
+        :return: dict {"ip": .., "port": .., "topics": set of topics}
+        """
+        mqtt = entry["end_points"]["MQTT"]
+        return {"ip": mqtt["ip"], "port": mqtt["port"], "topics": set(mqtt["end_points"]["subscribe"])}
+
+    def my_on_message(self, client: Client, userdata: Any, msg: MQTTMessage):
+        """
+        Handle a message received from an entry followed
+
+        :param client: MQTT client that received the message
+        :param userdata: They could be any type
+        :param msg: MQTT message
+        """
+        raise NotImplementedError
+
+    def added(self, records: Dict[str, dict]):
+        """
+        Entries just followed, called holding device_lock
+
+        :param records: dict {id: description}
+        """
+
+    def removed(self, records: Dict[str, dict]):
+        """
+        Entries no longer followed, called holding device_lock
+
+        :param records: dict {id: description}
+        """
+
+    def connecting(self):
+        """
+        The service client is connecting to the service broker, subscriptions made
+        through the connections are sent as soon as it is connected
+        """
+
+    def registered(self):
+        """
+        The entries and the registration in the catalog have been updated
+        """
+
+    def started(self):
+        """
+        The service is started
+        """
+
+    def stopping(self):
+        """
+        The service is stopping
+        """
+
+    # Lifecycle
+
+    def start(self):
+        """
+        Start the service: connect to the broker and handle the messages at once,
+        while the entries to follow are discovered in background and attached
+        as soon as they appear in the catalog
+        """
+        # Connect the service, the connection is completed by the network loop
+        self.service.connect_async(host=self.broker["ip"], port=self.broker["port"])
+        print(
+            f"[{time.ctime()}] SERVICE CONNECTING to "
+            f"broker: {self.broker['ip']} "
+            f"on port: port={self.broker['port']}"
+        )
+        self.connecting()
+
+        # Discover the entries and update the registration in background, on the blocking
+        # worker of the scheduler so that its ticks never wait for the catalog
+        self.scheduler.start()
+        self._update_task = self.scheduler.call_later(0, self.update_registration, blocking=True)
+        self.started()
+
+        try:
+            # Run the service forever
+            self.service.loop_forever(retry_first_connection=True)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def ping(self):
+        """
+        Register the service inside the catalog
+        """
+        print(f"[{time.ctime()}] PING the Catalog on : {self.catalog.catalog['ip']}")
+        try:
+            self.catalog.post("services", self.info)
+        except CatalogUnavailable as error:
+            print(f"[{time.ctime()}] WARNING registration not updated, catalog unreachable ({error})")
+
+    def update_registration(self):
+        """
+        Update the entries followed, the broker and the registration of the service in the catalog.
+        Until some entry is found, or while the catalog is unreachable, the catalog is asked
+        again with an exponential backoff, otherwise every UPDATE_INTERVAL seconds
+        """
+        print(f"[{time.ctime()}] EXTRACT info about all the {self.resource} registered")
+        try:
+            data = self.catalog.get(f"{self.resource}/all")
+        except CatalogUnavailable as error:
+            # Keep following the entries known until the catalog is back
+            delay = self._backoff.next()
+            print(
+                f"[{time.ctime()}] WARNING catalog unreachable ({error}), keeping the "
+                f"{len(self._device_list)} {self.resource} followed, retrying after {delay:.1f} seconds"
+            )
+            print(f"[{time.ctime()}] CATALOG {self.catalog.report()}")
+            self.scheduler.reschedule(self._update_task, delay)
+            return
+        entries = {} if data is None else {entry[self.key]: entry for entry in data if self.find(entry)}
+        self.check_broker()
+
+        with self.device_lock:
+            # Forget the inactive entries
+            self.unsubscribe(
+                {key: self._device_list[key] for key in self._device_list if key not in entries}
+            )
+            # Follow the new ones
+            self.subscribe(
+                self._update([entry for key, entry in entries.items() if key not in self._device_list])
+            )
+
+        self.ping()
+        self.registered()
+        print(f"[{time.ctime()}] CATALOG {self.catalog.report()}")
+
+        if entries:
+            self._backoff.reset()
+            delay = UPDATE_INTERVAL
+        else:
+            delay = self._backoff.next()
+            print(f"[{time.ctime()}] No {self.label} found... retrying in {delay:.1f} seconds")
+        self.scheduler.reschedule(self._update_task, delay)
+
+    def check_broker(self):
+        """
+        Follow the broker advertised by the catalog: if the service is connected to another one,
+        e.g. because the discovery at startup fell back on the configured broker, the entries are
+        forgotten and the service client is moved, the entries are then followed again on it
+        """
+        try:
+            broker = self.catalog.get("broker")
+            broker = {"ip": broker["ip"], "port": int(broker["port"])}
+        except (CatalogUnavailable, KeyError, TypeError, ValueError):
+            return
+        if broker == {"ip": self.broker["ip"], "port": int(self.broker["port"])}:
+            return
+        print(
+            f"[{time.ctime()}] WARNING the catalog advertises the broker {broker['ip']}:{broker['port']}, "
+            f"moving the service from {self.broker['ip']}:{self.broker['port']}"
+        )
+        with self.device_lock:
+            self.unsubscribe(dict(self._device_list))
+            self.connections.move(broker)
+
+    def stop(self):
+        """
+        Stop the service
+        """
+        # Stop the schedule, the update of the registration can't reschedule itself anymore
+        if self._update_task is not None:
+            self._update_task.cancel()
+        self.scheduler.stop()
+        self.stopping()
+
+        # Disconnect the clients
+        print(f"[{time.ctime()}] SHUTTING DOWN")
+        self.connections.clear()
+        self.catalog.close()
+        # Disconnect the service
+        self.service.disconnect()
+        print(f"[{time.ctime()}] EXIT")
+
+    # Entries
+
+    def _update(self, entries: List[dict]) -> Dict[str, dict]:
+        """
+        Follow new entries
+
+        :param entries: entries of the catalog
+        :return: dict {id: description} of the entries
+        """
+        records = {}
+        for entry in entries:
+            key = entry[self.key]
+            records[key] = self._device_list[key] = self.describe(entry)
+            print(f"[{time.ctime()}] {self.kind} {key} CONNECTED")
+        self.added(records)
+        return records
+
+    def subscribe(self, records: Dict[str, dict]):
+        """
+        Subscribe to the topics of the entries
+
+        :param records: dict {id: description}
+        """
+        for record in records.values():
+            self.connections.subscribe(record["ip"], record["port"], record["topics"])
+
+    def unsubscribe(self, records: Dict[str, dict]):
+        """
+        Forget entries and unsubscribe from their topics
+
+        :param records: dict {id: description}
+        """
+        for key, record in records.items():
+            print(f"[{time.ctime()}] {self.kind} {key} DISCONNECTED")
+            self.connections.unsubscribe(record["ip"], record["topics"])
+            del self._device_list[key]
+        self.removed(records)
+
+    def _clear(self):
+        """
+        Clear all the data stored
+        """
+        self.unsubscribe(dict(self._device_list))
+        self.connections.clear()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Test the layered configuration
+
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+
+    Copyright 2020 Angelo Cutaia
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+from copy import deepcopy
+import os
+import unittest
+from unittest import mock
+
+# Internals
+from configuration import loader
+
+# -------------------------------------------------------------------------
+
+
+class TestLoader(unittest.TestCase):
+    """
+    Test the sections registered by the services and the values of the wrong type
+    """
+
+    def setUp(self):
+        """
+        Load the configuration again in every test, restoring the one in use at the end
+        """
+        defaults, settings = deepcopy(loader.DEFAULTS), deepcopy(loader.settings)
+        loaded = loader._loaded
+        loader._loaded = False
+
+        def restore():
+            loader.DEFAULTS.clear()
+            loader.DEFAULTS.update(defaults)
+            loader.settings.clear()
+            loader.settings.update(settings)
+            loader._loaded = loaded
+
+        self.addCleanup(restore)
+
+    def test_sections(self):
+        """
+        Test that a service section is present only when registered, and its values are converted
+        """
+        self.assertNotIn("alarm", loader.DEFAULTS)
+        loader.register_defaults("alarm", {"hysteresis": 1.0, "thresholds": ""})
+        with mock.patch.dict(os.environ, {"IOT_ALARM_HYSTERESIS": "2"}):
+            settings = loader.load_settings(["--set", "alarm.thresholds=thresholds.json"])
+        self.assertEqual(settings["alarm"], {"hysteresis": 2.0, "thresholds": "thresholds.json"})
+
+    def test_wrong_type(self):
+        """
+        Test that a value that isn't of the type of its default is an error of the arguments
+        """
+        with mock.patch("sys.stderr"), self.assertRaises(SystemExit) as context:
+            loader.load_settings(["--set", "http.retries=1.5"])
+        self.assertEqual(context.exception.code, 2)
+
+        with mock.patch.dict(os.environ, {"IOT_BROKER_PORT": "mosquitto"}), mock.patch("sys.stderr"), \
+                self.assertRaises(SystemExit):
+            loader.load_settings([])
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Test the rule engine
+
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+
+    Copyright 2020 Angelo Cutaia
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import unittest
+
+# Internals
+from rules.engine import RangeRule, RuleEngine
+
+# -------------------------------------------------------------------------
+
+
+class TestRangeRule(unittest.TestCase):
+    """
+    Test that a micro-batch raises the same alarms as the evaluation of every message on arrival
+    """
+
+    def setUp(self):
+        """
+        Engine with a range (0, 30) and 1 degree of hysteresis, without hold time
+        """
+        self.engine = RuleEngine([RangeRule("range", 0, 30, hysteresis=1.0)])
+
+    def flush(self, *values: float) -> list:
+        """
+        Evaluate a batch of readings of the same device
+
+        :param values: readings in arrival order
+        :return: state published for every transition
+        """
+        for value in values:
+            self.engine.submit("device", value)
+        return [transition.active for transition in self.engine.flush()]
+
+    def test_last_reading(self):
+        """
+        Test that only the last reading of a device decides its state
+        """
+        self.assertEqual(self.flush(35, 25), [False])
+        self.assertEqual(self.flush(25, 35), [True])
+
+    def test_hysteresis(self):
+        """
+        Test that an alarm is cleared only by a reading inside the range by the hysteresis
+        """
+        self.assertEqual(self.flush(35), [True])
+        self.assertEqual(self.flush(20, 29.5), [])
+        self.assertEqual(self.flush(35, 28.5), [False])
+
+    def test_devices(self):
+        """
+        Test that the readings of every device are evaluated apart
+        """
+        for device, value in (("a", 35), ("b", 25), ("a", 25), ("b", 35)):
+            self.engine.submit(device, value)
+        transitions = {transition.device: transition.active for transition in self.engine.flush()}
+        self.assertEqual(transitions, {"a": False, "b": True})
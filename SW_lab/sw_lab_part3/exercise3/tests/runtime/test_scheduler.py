@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Test the scheduler
+
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+
+    Copyright 2020 Angelo Cutaia
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+from threading import Event, Lock
+import time
+import unittest
+
+# Internals
+from runtime.scheduler import Scheduler
+
+# -------------------------------------------------------------------------
+
+
+class TestScheduler(unittest.TestCase):
+    """
+    Test the runs of the tasks, and that the blocking ones don't delay the ticks
+    """
+
+    def setUp(self):
+        """
+        Start a scheduler for every test
+        """
+        self.scheduler = Scheduler("TestScheduler")
+        self.scheduler.start()
+
+    def tearDown(self):
+        """
+        Stop the scheduler
+        """
+        self.scheduler.stop()
+
+    def test_call_later(self):
+        """
+        Test that a task runs once, and a cancelled one never
+        """
+        done = Event()
+        cancelled = Event()
+        self.scheduler.call_later(0.01, done.set)
+        self.scheduler.call_later(0.01, cancelled.set).cancel()
+        self.assertTrue(done.wait(1))
+        time.sleep(0.05)
+        self.assertFalse(cancelled.is_set())
+
+    def test_blocking_task_doesnt_delay_ticks(self):
+        """
+        Test that the ticks go on while a blocking task waits, like a request to a catalog that doesn't answer
+        """
+        ticks = []
+        release = Event()
+        self.scheduler.call_every(0.01, lambda: ticks.append(time.monotonic()))
+        self.scheduler.call_later(0, release.wait, 2, blocking=True)
+        time.sleep(0.3)
+        running = len(ticks)
+        release.set()
+        self.assertGreaterEqual(running, 10)
+
+    def test_blocking_task_doesnt_overlap(self):
+        """
+        Test that a periodic blocking task slower than its interval never runs twice at the same time
+        """
+        lock = Lock()
+        overlaps = []
+        runs = []
+
+        def slow():
+            if not lock.acquire(blocking=False):
+                overlaps.append(time.monotonic())
+                return
+            time.sleep(0.03)
+            runs.append(time.monotonic())
+            lock.release()
+
+        self.scheduler.call_every(0.005, slow, delay=0, blocking=True)
+        time.sleep(0.2)
+        self.assertGreaterEqual(len(runs), 2)
+        self.assertEqual(overlaps, [])
+
+    def test_stop_doesnt_wait_blocking_task(self):
+        """
+        Test that stop returns at once even if a blocking task is waiting, and that it can't reschedule itself
+        """
+        started = Event()
+        runs = []
+
+        def blocked():
+            runs.append(time.monotonic())
+            started.set()
+            time.sleep(0.3)
+            self.scheduler.reschedule(task, 0)
+
+        task = self.scheduler.call_later(0, blocked, blocking=True)
+        self.assertTrue(started.wait(1))
+        start = time.monotonic()
+        self.scheduler.stop()
+        self.assertLess(time.monotonic() - start, 0.2)
+        time.sleep(0.5)
+        self.assertEqual(len(runs), 1)
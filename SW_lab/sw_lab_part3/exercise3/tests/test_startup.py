@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Test the startup of the service
+
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+
+    Copyright 2020 Angelo Cutaia
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import json
+import os
+import tempfile
+from threading import Thread
+import time
+import unittest
+
+# Third Party
+from paho.mqtt.client import Client
+
+# Internals
+from configuration.loader import settings
+import exercise3_main as service_main
+from mqtt_broker.broker import running_broker
+from startup_benchmark_main import TELEMETRY_TOPIC, Probe, bench, free_port, register_device, start_catalog
+
+# -------------------------------------------------------------------------
+
+TIMEOUT = 30
+"""Seconds to wait for the catalog and for the first message"""
+
+
+class TestStartup(unittest.TestCase):
+    """
+    Test the time from the startup of the service, broker discovery included, to the connection
+    and to the first message handled, with a local broker and the catalog in a subprocess
+    """
+
+    def test_catalog_up(self):
+        """
+        Test the startup with the catalog already running
+        """
+        result = bench(None, TIMEOUT)
+        self.assertLess(result["connected_ms"], 1000)
+        self.assertIsNotNone(result["first_message_ms"])
+
+    def test_catalog_stalled(self):
+        """
+        Test that a catalog accepting the connections without answering doesn't block the startup
+        """
+        result = bench(1.0, TIMEOUT, stalled=True)
+        self.assertLess(result["discovery_ms"], 1000)
+        self.assertLess(result["connected_ms"], 1000)
+        self.assertIsNotNone(result["first_message_ms"])
+
+    def test_broker_advertised_later(self):
+        """
+        Test that a service started on the configured broker, because the discovery failed,
+        moves to the broker advertised by the catalog and handles the messages sent there
+        """
+        with running_broker() as configured, running_broker() as advertised, \
+                tempfile.TemporaryDirectory() as folder:
+            port = free_port()
+            catalog = start_catalog(port, advertised.port, os.path.join(folder, "catalog.db"))
+            device = Client("TestStartupDevice")
+            try:
+                register_device(port, advertised.port, TIMEOUT)
+                device.connect("127.0.0.1", advertised.port)
+                device.loop_start()
+                service_main.CATALOG_IP_PORT.update({"ip": "127.0.0.1", "port": port})
+                service_main.SERVICE_BROKER_PORT.update({"ip": "127.0.0.1", "port": configured.port})
+                settings["broker"].update(service_main.SERVICE_BROKER_PORT)
+
+                service = Probe()
+                Thread(target=service.start, name="Service", daemon=True).start()
+                deadline = time.monotonic() + TIMEOUT
+                while not service.message_handled.is_set() and time.monotonic() < deadline:
+                    device.publish(TELEMETRY_TOPIC, payload=json.dumps({"n": "temperature", "v": 25.3, "u": "Cel"}))
+                    service.message_handled.wait(0.05)
+                service.stop()
+            finally:
+                device.disconnect()
+                device.loop_stop()
+                catalog.terminate()
+                catalog.wait()
+
+        self.assertTrue(service.message_handled.is_set())
+        self.assertEqual(service_main.SERVICE_BROKER_PORT["port"], advertised.port)
@@ -16,20 +16,23 @@ Exercise4 sw_lab3
     limitations under the License.
 """
 # Standard Library
-from collections import defaultdict
-from functools import partial
 import json
-from random import randrange
-import sys
+from threading import Lock
 import time
-from typing import Any, Dict, List, DefaultDict
-from threading import Timer, Lock
+from typing import Any, Dict, List, Optional
 
 # Third Party
 from paho.mqtt.client import Client, MQTTMessage
-import requests
 
 # Internals
+from configuration.loader import discover_broker, load_settings, register_defaults
+from profiler.sampler import profile_from_env
+from runtime.http import catalog_client
+from runtime.scheduler import Task
+from runtime.service import CatalogService
+from smart_home.fleet import Command, FleetController
+from smart_home.outbox import CommandOutbox
+from smart_home.presence import WHEEL_RESOLUTION, TimerWheel
 from smart_home.smart_home import SmartHome
 
 # -----------------------------------------------------------------------------
@@ -43,19 +46,25 @@ ARDUINO_UNIQUE_ID = "YUN"
 CATALOG_IP_PORT = {"ip": "0.0.0.0", "port": 8080}
 
 SERVICE_BROKER_PORT = {"ip": "test.mosquitto.org", "port": 1883}
-SERVICE_INFO = json.dumps(
-    {
-        "serviceID": "Exercise4/LabSw3",
-        "description": "Show all the smart homes connected to the service on service topic."
-                       "Manage all smart homes.",
-        "end_points": {
-            "MQTT": {
-                "broker": SERVICE_BROKER_PORT,
-                "subscribe": ["labsw3/arduino/smarthome"],
-            }
-        },
-    }
-)
+SERVICE_INFO = {
+    "serviceID": "Exercise4/LabSw3",
+    "description": "Show all the smart homes connected to the service on service topic."
+                   "Manage all smart homes.",
+    "end_points": {
+        "MQTT": {
+            "broker": SERVICE_BROKER_PORT,
+            "subscribe": ["labsw3/arduino/smarthome"],
+        }
+    },
+}
+
+# If fleet is not 0, all the homes are controlled by the fleet controller every fleet seconds.
+# If coalesce is not 0, the commands of the devices with a commands topic are sent every
+# coalesce seconds, as a single SenML pack per device
+SMART_HOME_POLICY = {
+    "fleet": 0.0,
+    "coalesce": 0.5
+}
 
 
 # -----------------------------------------------------------------------------
@@ -85,384 +94,202 @@ def find_arduino(data: dict) -> bool:
     return False
 
 
-class Service:
+class Service(CatalogService):
     """Service that manages Smart Homes Devices"""
 
-    _mqtt_client: Dict[str, Client] = {}
-    _device_list: Dict[str, dict] = {}
-    _broker: DefaultDict[str, set] = defaultdict(set)
-    _broker_port: Dict[str, int] = {}
-    _topic: DefaultDict[str, set] = defaultdict(set)
-    _update_thread: Timer = None
+    client_prefix = "SmartHomeService"
     smart_home_list_topic = "labsw3/arduino/smarthome"
 
     def __init__(self):
         """
         Instantiate the service
         """
-        self.service = Client(client_id=f"SmartHomeService{randrange(1, 100000)}")
-        self.service.on_message = partial(self.my_on_message, publisher=self.service)
-        self.lock = Lock()
-        self.device_lock = Lock()
-
-    def _update(self, device_list: List[dict]):
+        super().__init__(CATALOG_IP_PORT, SERVICE_BROKER_PORT, SERVICE_INFO)
+        # Topic -> SmartHome and the publisher of its commands (None to use the client of the message),
+        # or device with the fleet controller. Never modified in place: writers
+        # build a new dict under device_lock and swap it, so my_on_message can read it without locking
+        self._routes: Dict[str, Any] = {}
+        self.fleet: Optional[FleetController] = None
+        self._fleet_task: Optional[Task] = None
+        if SMART_HOME_POLICY["fleet"]:
+            self.fleet = FleetController()
+        # Presence timeouts of the SmartHomes, the homes are only touched holding the lock
+        self.wheel = TimerWheel()
+        self._home_lock = Lock()
+        self._presence_task: Optional[Task] = None
+        # Commands of the devices that accept SenML packs
+        self.outbox: Optional[CommandOutbox] = None
+        self._outbox_task: Optional[Task] = None
+        if SMART_HOME_POLICY["coalesce"]:
+            self.outbox = CommandOutbox()
+
+    def find(self, entry: dict) -> bool:
         """
-        Update reserved dicts
-        :param device_list: device list to add
+        Follow the arduino offering all the resources of a smart home
+        :param entry: device of the catalog
         """
-        for arduino in device_list:
-            device = arduino["deviceID"]
-            broker = arduino["end_points"]["MQTT"]["ip"]
-            port = arduino["end_points"]["MQTT"]["port"]
-            topics = {
-                topic
-                for topic in arduino["end_points"]["MQTT"]["end_points"]["subscribe"]
-            }
-            led_topics = {
-                topic
-                for topic in arduino["end_points"]["MQTT"]["end_points"]["publish"]
-                if "led" in topic
-            }
-            fan_topics = {
-                topic
-                for topic in arduino["end_points"]["MQTT"]["end_points"]["publish"]
-                if "FAN" in topic
-            }
-            lcd_topics = {
-                topic
-                for topic in arduino["end_points"]["MQTT"]["end_points"]["publish"]
-                if "lcd" in topic
-            }
-
-            self._device_list[device] = {
-                "ip": broker,
-                "topics": topics,
-                "smart_home": SmartHome(led_topics, fan_topics, lcd_topics)
-            }
-
-            self._broker_port[broker] = port
-
-            self._broker[broker].update({device})
-            self._topic[broker].update(topics)
-
-            print(f"[{time.ctime()}] DEVICE {device} CONNECTED")
-
-    def setup(self, first_time: bool = True):
+        return find_arduino(entry)
+
+    def describe(self, entry: dict) -> dict:
         """
-        Setup the service
+        Topics of an arduino and the SmartHome that controls it
+        :param entry: device of the catalog
         """
-        try:
-            print(f"[{time.ctime()}] EXTRACT info about all the devices registered")
-            result: requests.Response = requests.get(
-                url=f"http://{CATALOG_IP_PORT['ip']}:{CATALOG_IP_PORT['port']}/catalog/devices/all"
-            )
-            while result.status_code != 200:
-                print(
-                    f"[{time.ctime()}] WARNING no device registered found, retrying after 30 seconds"
-                )
-                time.sleep(30)
-                result: requests.Response = requests.get(
-                    url=f"http://{CATALOG_IP_PORT['ip']}:{CATALOG_IP_PORT['port']}"
-                    f"/catalog/devices/all"
-                )
-            print(f"[{time.ctime()}] DEVICES found")
-            data = json.loads(result.content.decode())
-
-            print(
-                f"[{time.ctime()}] EXTRACT from the devices list info about ArduinoYUN"
-            )
-            device_list = [device for device in data if find_arduino(device)]
-            if len(device_list) == 0:
-                print(f"[{time.ctime()}] No ArduinoYUN found... retrying in 10 seconds")
-                time.sleep(10)
-                self.setup(first_time)
-                return
-        except KeyboardInterrupt:
-            print(f"[{time.ctime()}] EXIT")
-            if first_time:
-                sys.exit()
-            return
-
-        if first_time:
-            # Connect the service
-            self.service.connect(
-                host=SERVICE_BROKER_PORT["ip"], port=SERVICE_BROKER_PORT["port"]
-            )
-            print(
-                f"[{time.ctime()}] SERVICE CONNECTED to "
-                f"broker: {SERVICE_BROKER_PORT['ip']} "
-                f"on port: port={SERVICE_BROKER_PORT['port']}"
-            )
-
-        # Update registered devices and subscribe to all the topics
-        with self.device_lock:
-            self._update(device_list)
-            self.subscribe(device_list)
-
-        # Register inside the catalog
-        print(f"[{time.ctime()}] PING the Catalog on : {CATALOG_IP_PORT['ip']}")
-        requests.post(
-            f'http://{CATALOG_IP_PORT["ip"]}:{CATALOG_IP_PORT["port"]}/catalog/services',
-            data=SERVICE_INFO,
-            headers={"Content-Type": "application/json"}
+        mqtt = entry["end_points"]["MQTT"]
+        publish = mqtt["end_points"]["publish"]
+        topics = (
+            {topic for topic in publish if "led" in topic},
+            {topic for topic in publish if "FAN" in topic},
+            {topic for topic in publish if "lcd" in topic}
         )
-
-    def start(self):
+        # Devices with a commands topic receive all the commands in one pack
+        pack_topics = {topic for topic in publish if "commands" in topic} if self.outbox is not None else set()
+        if self.fleet is not None:
+            self.fleet.add(entry["deviceID"], *topics)
+        return {
+            "ip": mqtt["ip"],
+            "port": mqtt["port"],
+            "topics": set(mqtt["end_points"]["subscribe"]),
+            "pack_topics": pack_topics,
+            "publisher": self.outbox.publisher(entry["deviceID"]) if pack_topics else None,
+            "smart_home": None if self.fleet is not None else SmartHome(*topics, wheel=self.wheel)
+        }
+
+    def added(self, records: Dict[str, dict]):
         """
-        Start the service.
+        Route the messages of the new devices to their SmartHome
+        :param records: new devices
         """
-        # Setup the service
-        self.setup()
+        routes = dict(self._routes)
+        for device, record in records.items():
+            for topic in record["topics"]:
+                routes[topic] = device if self.fleet is not None else (record["smart_home"], record["publisher"])
+        self._routes = routes
 
-        # Start all the external mqtt_clients
-        for broker in self._mqtt_client:
-            self._mqtt_client[broker].loop_start()
-
-        # Publish the device list for the first time
-        self.service.publish(
-            self.smart_home_list_topic,
-            payload=json.dumps([arduino for arduino in self._device_list]),
-        )
+    def removed(self, records: Dict[str, dict]):
+        """
+        Forget the routes of the devices removed
+        :param records: devices removed
+        """
+        routes = dict(self._routes)
+        for device, record in records.items():
+            for topic in record["topics"]:
+                routes.pop(topic, None)
+            if self.fleet is not None:
+                self.fleet.forget(device)
+            else:
+                with self._home_lock:
+                    self.wheel.cancel(record["smart_home"])
+            if record["publisher"] is not None:
+                self.outbox.forget(device)
+        self._routes = routes
 
-        # Schedule the update of the registration
-        self._update_thread = Timer(60, self.update_registration)
-        self._update_thread.start()
+    def registered(self):
+        """
+        Publish the device list
+        """
+        with self.device_lock:
+            devices = list(self._device_list)
+        self.service.publish(self.smart_home_list_topic, payload=json.dumps(devices))
 
-        try:
-            # Run the service forever
-            self.service.loop_forever()
-        except KeyboardInterrupt:
-            self.stop()
+    def started(self):
+        """
+        Control the homes with the fleet controller, or follow the presence timeouts of the SmartHomes
+        """
+        if self.fleet is not None:
+            self._fleet_task = self.scheduler.call_every(SMART_HOME_POLICY["fleet"], self._control_fleet)
+        else:
+            self._presence_task = self.scheduler.call_every(WHEEL_RESOLUTION, self._expire_presence)
+            if self.outbox is not None:
+                self._outbox_task = self.scheduler.call_every(SMART_HOME_POLICY["coalesce"], self._send_packs)
+
+    def stopping(self):
+        """
+        Stop the fleet controller, the presence timeouts and the outbox
+        """
+        for task in (self._fleet_task, self._presence_task, self._outbox_task):
+            if task is not None:
+                task.cancel()
 
-    def my_on_message(
-        self, client: Client, userdata: Any, msg: MQTTMessage, publisher: Client = None
-    ):
+    def my_on_message(self, client: Client, userdata: Any, msg: MQTTMessage):
         """
         Redirect message
-        :param client: MQTT client
+        :param client: MQTT client, used to control the SmartHome
         :param userdata: They could be any type
         :param msg: MQTT message
-        :param publisher: SmartHome Client
         """
-
-        def _device() -> SmartHome:
-            """
-            Find the SmartHome that generated this message
-            """
-            with self.device_lock:
-                for device in self._device_list:
-                    if msg.topic in self._device_list[device]["topics"]:
-                        return self._device_list[device]["smart_home"]
-
+        route = self._routes.get(msg.topic)
+        if route is None:
+            return
         data = json.loads(msg.payload.decode())
-        smart_home = _device()
-        smart_home.parse_message(data, publisher)
-
-    def update_registration(self):
+        if self.fleet is not None:
+            self.fleet.submit(route, data)
+        else:
+            smart_home, publisher = route
+            with self._home_lock:
+                smart_home.parse_message(data, publisher or client)
+
+    def _expire_presence(self):
         """
-        Update service registration to the catalog
+        Refresh the SmartHomes whose presence timeout is passed, so that they change set-point
+        even if no temperature arrives. Run every WHEEL_RESOLUTION seconds
         """
-        print(f"[{time.ctime()}] EXTRACT info about all the devices registered")
-        result: requests.Response = requests.get(
-            url=f"http://{CATALOG_IP_PORT['ip']}:{CATALOG_IP_PORT['port']}/catalog/devices/all"
-        )
-
-        # No device found
-        if result.status_code != 200:
-            self.reset()
-            return
+        with self._home_lock:
+            now = time.time()
+            for smart_home in self.wheel.advance(now):
+                smart_home.refresh(now)
 
-        data = json.loads(result.content.decode())
-        device_list = [device for device in data if find_arduino(device)]
-        if len(device_list) == 0:
-            self.reset()
-            return
-
-        # New Devices Found
-        new_devices = {arduino["deviceID"] for arduino in device_list}
-        # Old devices list
-        old_devices = set(self._device_list.keys())
-
-        # Check if there are updates to do
-        if old_devices == new_devices:
-            # No update, ping the catalog
-            print(f"[{time.ctime()}] PING the Catalog on : {CATALOG_IP_PORT['ip']}")
-            requests.post(
-                f'http://{CATALOG_IP_PORT["ip"]}:{CATALOG_IP_PORT["port"]}/catalog/services',
-                data=SERVICE_INFO,
-                headers={"Content-Type": "application/json"}
-            )
-            self.service.publish(
-                self.smart_home_list_topic,
-                payload=json.dumps([arduino for arduino in self._device_list]),
-            )
-            self._update_thread = Timer(60, self.update_registration)
-            self._update_thread.start()
-            return
-
-        with self.device_lock:
-            # Delete inactive devices
-            delete_list = {
-                arduino: self._device_list[arduino]
-                for arduino in self._device_list
-                if arduino not in new_devices
-            }
-            # Unsubscribe from devices
-            self.unsubscribe(delete_list)
-
-            # Update registered devices and subscribe
-            new_devices = [
-                arduino
-                for arduino in device_list
-                if arduino["deviceID"] not in old_devices
-            ]
-
-            self._update(new_devices)
-            self.subscribe(new_devices)
-            self.service.publish(
-                self.smart_home_list_topic,
-                payload=json.dumps([arduino for arduino in self._device_list]),
-            )
-
-        self._update_thread = Timer(60, self.update_registration)
-        self._update_thread.start()
-
-    def reset(self):
-        """
-        Reset the service
-        """
-        with self.device_lock:
-            self._clear()
-        self.setup(first_time=False)
-        # Start all the external mqtt_clients
-        for broker in self._mqtt_client:
-            self._mqtt_client[broker].loop_start()
-        self._update_thread = Timer(60, self.update_registration)
-        self._update_thread.start()
-
-    def unsubscribe(self, device_list: dict):
+    def _control_fleet(self):
         """
-        Unsubscribe from devices
-        :param device_list: device list
+        Command the homes that sent a temperature, run every SMART_HOME_POLICY["fleet"] seconds
         """
-        for arduino in device_list:
-            print(f"[{time.ctime()}] DEVICE {arduino} DISCONNECTED")
-            broker = device_list[arduino]["ip"]
-            topics = device_list[arduino]["topics"]
+        self._publish_commands(self.fleet.flush())
+        if self.outbox is not None:
+            self._send_packs()
 
-            if broker == SERVICE_BROKER_PORT["ip"]:
-                for topic in topics:
-                    self.service.unsubscribe(topic)
-                    print(f"[{time.ctime()}] UNSUBSCRIBED from : {topic}")
-
-            else:
-                for topic in topics:
-                    self._mqtt_client[broker].unsubscribe(topic)
-                    print(f"[{time.ctime()}] UNSUBSCRIBED from : {topic}")
-
-            # Update topics
-            self._topic[broker] = self._topic[broker].difference(topics)
-
-            # Disconnect from external broker
-            if len(self._topic[broker]) == 0:
-                if broker != SERVICE_BROKER_PORT["ip"]:
-                    self._mqtt_client[broker].disconnect()
-                    self._mqtt_client[broker].loop_stop()
-                    print(f"[{time.ctime()}] DISCONNECTED from broker: {broker}")
-                    del self._mqtt_client[broker]
-
-                # Clean
-                del self._topic[broker]
-                del self._broker_port[broker]
-
-            # Delete device
-            del self._device_list[arduino]
-            self._broker[broker].discard(arduino)
-
-    def subscribe(self, device_list: List[dict]):
+    def _publish_commands(self, commands: List[Command]):
         """
-        Subscribe to all the devices registered
-        :param device_list: list of device
+        Publish the commands of the fleet controller on the broker of their device,
+        the ones of the devices that accept packs are queued in the outbox
+        :param commands: home, topic and payload of the commands
         """
-        for arduino in device_list:
-            broker = arduino["end_points"]["MQTT"]["ip"]
-            topics = {
-                topic
-                for topic in arduino["end_points"]["MQTT"]["end_points"]["subscribe"]
-            }
-            # Subscribe to topics
-            if broker == SERVICE_BROKER_PORT["ip"]:
-                for topic in topics:
-                    self.service.subscribe(topic)
-                    print(f"[{time.ctime()}] SUBSCRIBED to : {topic}")
-
-            # Connect to external brokers
+        with self.device_lock:
+            records = [self._device_list.get(device) for device, _, _ in commands]
+        for record, (device, topic, payload) in zip(records, commands):
+            if record is None:
+                continue
+            if record["publisher"] is not None:
+                self.outbox.post(device, topic, payload)
             else:
-                if broker in self._mqtt_client:
-                    # Connection already made
-                    for topic in topics:
-                        self._mqtt_client[broker].subscribe(topic)
-                        print(f"[{time.ctime()}] SUBSCRIBED to : {topic}")
-                else:
-                    # Connect to the broker
-                    self._mqtt_client[broker] = Client(
-                        f"SmartHomeService{randrange(1, 1000000)}"
-                    )
-                    self._mqtt_client[broker].on_message = partial(
-                        self.my_on_message, publisher=self._mqtt_client[broker]
-                    )
-                    self._mqtt_client[broker].connect(
-                        host=broker, port=self._broker_port[broker]
-                    )
-
-                    for topic in topics:
-                        self._mqtt_client[broker].subscribe(topic)
-                        print(f"[{time.ctime()}] SUBSCRIBED to : {topic}")
-
-    def _clear(self):
-        """
-        Clear all the data stored
-        """
-        # Unsubscribe from all topics
-        self.unsubscribe(self._device_list.copy())
-
-        # Disconnect from all the external brokers
-        for broker in self._mqtt_client:
-            self._mqtt_client[broker].disconnect()
-            self._mqtt_client[broker].loop_stop()
-            print(f"[{time.ctime()}] DISCONNECTED from broker: {broker}")
-
-        # Clear
-        self._mqtt_client.clear()
-        self._device_list.clear()
-        self._broker.clear()
-        self._broker_port.clear()
-        self._topic.clear()
-
-    def stop(self):
+                self.connections.client(record["ip"]).publish(topic, payload=payload)
+
+    def _send_packs(self):
         """
-        Stop the service
+        Publish the commands coalesced in the outbox, a SenML pack per device on its commands topic.
+        Run every SMART_HOME_POLICY["coalesce"] seconds, or after every step of the fleet controller
         """
-        # Stop the schedule
-        self._update_thread.cancel()
-
-        # Wait for the threads to finish
-        if self._update_thread.is_alive():
-            self._update_thread.join()
-
-        # Disconnect the clients
-        print(f"[{time.ctime()}] SHUTTING DOWN")
-        for client in self._mqtt_client:
-            self._mqtt_client[client].disconnect()
-            self._mqtt_client[client].loop_stop()
-        # Disconnect the service
-        self.service.disconnect()
-        print(f"[{time.ctime()}] EXIT")
+        packs = self.outbox.drain()
+        if not packs:
+            return
+        with self.device_lock:
+            records = [self._device_list.get(device) for device, _ in packs]
+        for record, (_, payload) in zip(records, packs):
+            if record is None:
+                continue
+            client = self.connections.client(record["ip"])
+            for topic in record["pack_topics"]:
+                client.publish(topic, payload=payload)
 
 
 # -----------------------------------------------------------------------------------------------------------
 
 
 if __name__ == "__main__":
+    register_defaults("smart_home", SMART_HOME_POLICY)
+    settings = load_settings()
+    CATALOG_IP_PORT.update(settings["catalog"])
+    SMART_HOME_POLICY.update(settings["smart_home"])
+    SERVICE_BROKER_PORT.update(discover_broker(CATALOG_IP_PORT, session=catalog_client(CATALOG_IP_PORT).session))
+    profile_from_env()
     service = Service()
     service.start()
@@ -17,13 +17,17 @@ Fake Smart home device
 # Standard library
 import json
 from random import randrange
-from threading import Timer
 import time
 from typing import Any
 
 # Third party
 from paho.mqtt.client import Client, MQTTMessage
-import requests
+
+# Internals
+from configuration.loader import load_settings
+from profiler.sampler import profile_from_env
+from runtime.http import CatalogUnavailable, catalog_client
+from runtime.scheduler import Task, shared_scheduler
 
 
 # ------------------------------------------------------------------------------------------
@@ -40,23 +44,20 @@ CATALOG_IP_PORT = {"ip": "0.0.0.0", "port": 8080}
 
 FAKE_DEVICE_BROKER_PORT = {"addr": "broker.hivemq.com", "port": 1883}
 
-UPDATE_BODY = json.dumps(
-    {
-        "ID": FAKE_DEVICE_ID,
-        "PROT": "MQTT",
-        "IP": FAKE_DEVICE_BROKER_PORT["addr"],
-        "P": FAKE_DEVICE_BROKER_PORT["port"],
-        "ED": {
-            "S": [
-                "fake_smart_home/temperature",
-                "fake_smart_home/PIR",
-                "fake_smart_home/noise"
-            ],
-            "A": ["fake_smart_home/FAN", "fake_smart_home/led", "fake_smart_home/lcd"],
-        },
-        "AR": ["Temp", "Led", "FAN", "PIR", "noise", "SM", "Lcd"],
-    }
-)
+# IP and P are added at registration time, using the broker in use
+UPDATE_BODY = {
+    "ID": FAKE_DEVICE_ID,
+    "PROT": "MQTT",
+    "ED": {
+        "S": [
+            "fake_smart_home/temperature",
+            "fake_smart_home/PIR",
+            "fake_smart_home/noise"
+        ],
+        "A": ["fake_smart_home/FAN", "fake_smart_home/led", "fake_smart_home/lcd", "fake_smart_home/commands"],
+    },
+    "AR": ["Temp", "Led", "FAN", "PIR", "noise", "SM", "Lcd"],
+}
 
 # -------------------------------------------------------------------------------------------------------
 
@@ -68,8 +69,8 @@ UPDATE_BODY = json.dumps(
 class Arduino:
     """Simulate a YUN fake device"""
 
-    _update_thread: Timer = None
-    _smart_home_thread: Timer = None
+    _update_task: Task = None
+    _smart_home_task: Task = None
 
     def __init__(self, broker: str, port: int):
         """
@@ -80,11 +81,13 @@ class Arduino:
         self.broker = broker
         self.port = port
         self.client = Client(client_id=f"FakeSmartHome{randrange(1, 100000)}")
+        self.catalog = catalog_client(CATALOG_IP_PORT)
         self.client.on_message = self.my_on_message
 
     def my_on_message(self, client: Client, userdata: Any, msg: MQTTMessage):
         """
-        Commands for the Smart Home
+        Commands for the Smart Home, a single SenML record on the topic of an actuator
+        or a SenML pack with the commands of all the actuators on the commands topic
 
         :param client: MQTT client
         :param userdata: They could be any type
@@ -92,13 +95,14 @@ class Arduino:
         """
 
         data = json.loads(msg.payload.decode())
-        if data["n"] == "FAN":
-            print(f"FAN INTENSITY: {data['v']}")
-        elif data["n"] == "led":
-            print(f"LED INTENSITY: {data['v']}")
+        for record in data if isinstance(data, list) else [data]:
+            if record["n"] == "FAN":
+                print(f"FAN INTENSITY: {record['v']}")
+            elif record["n"] == "led":
+                print(f"LED INTENSITY: {record['v']}")
 
-        elif data["n"] == "lcd":
-            print(f"LCD MONITOR: {data['v']}")
+            elif record["n"] == "lcd":
+                print(f"LCD MONITOR: {record['v']}")
 
     def start(self):
         """
@@ -112,15 +116,15 @@ class Arduino:
         for topic in {
             f"fake_smart_home/FAN/{FAKE_DEVICE_ID}",
             f"fake_smart_home/led/{FAKE_DEVICE_ID}",
-            f"fake_smart_home/lcd/{FAKE_DEVICE_ID}"
+            f"fake_smart_home/lcd/{FAKE_DEVICE_ID}",
+            f"fake_smart_home/commands/{FAKE_DEVICE_ID}"
         }:
             self.client.subscribe(topic)
             print(f"[{time.ctime()}] SUBSCRIBED to TOPIC: {topic}")
-        self._smart_home_thread = Timer(1, self.send_values)
-        self._smart_home_thread.start()
-
-        self.update_registration()
-        # Schedule the publish of the calculated temperature
+        # Schedule the telemetry and the ping of the catalog on the scheduler of the process
+        scheduler = shared_scheduler()
+        self._smart_home_task = scheduler.call_every(10, self.send_values, delay=1, jitter=0.1)
+        self._update_task = scheduler.call_every(60, self.update_registration, delay=0, jitter=0.1, blocking=True)
 
         try:
             # Run MQTT Client forever
@@ -135,14 +139,8 @@ class Arduino:
         Stop the fake device
         """
         # Stop the schedule
-        self._update_thread.cancel()
-        self._smart_home_thread.cancel()
-
-        # Wait for the threads to finish
-        if self._update_thread.is_alive():
-            self._update_thread.join()
-        if self._smart_home_thread.is_alive():
-            self._smart_home_thread.join()
+        self._update_task.cancel()
+        self._smart_home_task.cancel()
 
         # Disconnect the client
         self.client.disconnect()
@@ -153,23 +151,12 @@ class Arduino:
 
     def update_registration(self):
         """
-        Ping the catalog on topic catalog/devices
+        Ping the catalog on topic catalog/devices, every 60 seconds
         """
         try:
-            try:
-                requests.post(
-                    f'http://{CATALOG_IP_PORT["ip"]}:{CATALOG_IP_PORT["port"]}/catalog/devices',
-                    data=UPDATE_BODY,
-                    headers={"Content-Type": "application/json"},
-                )
-            except requests.ConnectionError:
-                pass
-
-            # Schedule the ping 60 seconds later
-            self._update_thread = Timer(60, self.update_registration)
-            self._update_thread.start()
-        finally:
-            return
+            self.catalog.post("devices", {**UPDATE_BODY, "IP": self.broker, "P": self.port})
+        except CatalogUnavailable as error:
+            print(f"[{time.ctime()}] WARNING registration not updated, catalog unreachable ({error})")
 
     def send_values(self):
         """
@@ -216,10 +203,6 @@ class Arduino:
             print(
                 f"[{time.ctime()}] TELEMETRY sent on topic: fake_smart_home/noise/{FAKE_DEVICE_ID}"
             )
-
-            # Schedule to send temperature again after 10 seconds
-            self._smart_home_thread = Timer(10, self.send_values)
-            self._smart_home_thread.start()
         finally:
             return
 
@@ -242,4 +225,10 @@ def start_simulation():
 
 
 if __name__ == "__main__":
+    settings = load_settings()
+    CATALOG_IP_PORT.update(settings["catalog"])
+    FAKE_DEVICE_BROKER_PORT.update(
+        addr=settings["device_broker"]["ip"], port=settings["device_broker"]["port"]
+    )
+    profile_from_env()
     start_simulation()
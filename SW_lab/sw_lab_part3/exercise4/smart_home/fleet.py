@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Fleet of smart homes sw_lab3
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+# Third Party
+import numpy as np
+
+# Internals
+from .presence import RateDetector, TimerWheel
+from .smart_home import (
+    FAN_PAYLOADS,
+    LED_PAYLOADS,
+    MAX_PWM_FAN_AND_LED,
+    MIN,
+    NOISE_EVENTS,
+    SET_POINT_NO_PEOPLE,
+    SET_POINT_PEOPLE,
+    SOUND_INTERVAL,
+    TEMPERATURE_INTERVAL,
+    TIMEOUT_PIR,
+    TIMEOUT_SOUND,
+    WELCOME_PAYLOAD,
+    lcd_payload
+)
+
+# ---------------------------------------------------------------
+
+INITIAL_CAPACITY = 1024
+"""Homes for which the state arrays are allocated, they double when full"""
+
+NO_COMMAND = -1
+"""PWM of an actuator never commanded"""
+
+Command = Tuple[str, str, str]
+"""Home, topic and payload of a command to publish"""
+
+# ---------------------------------------------------------------
+
+
+def _grow(array: np.ndarray, capacity: int, fill) -> np.ndarray:
+    """
+    Return a copy of the array with the new capacity, the new elements are set to fill
+
+    :param array: array to grow, the first axis is the home
+    :param capacity: new capacity
+    :param fill: value of the new elements
+    """
+    grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class FleetController:
+    """
+    Control thousands of smart homes from one process. The state of all the homes is
+    kept in arrays indexed by home: messages only update the state of their home and queue
+    the temperatures, while flush computes the led and fan PWM of every home that received a temperature
+    or whose presence changed since the previous flush in one vectorised step and returns only
+    the commands that changed. The presence timeouts are followed on a timer wheel advanced by flush.
+    The rules are the ones of SmartHome
+    """
+
+    def __init__(self, capacity: int = INITIAL_CAPACITY):
+        """
+        Instantiate the controller
+
+        :param capacity: initial number of homes
+        """
+        self.size = 0
+        self.counters = {"readings": 0, "flushes": 0, "commands": 0, "unchanged": 0}
+        self._lock = threading.Lock()
+        self._index: Dict[str, int] = {}
+        self._homes: List[Optional[str]] = []
+        self._free: List[int] = []
+        self._led_topics: List[Set[str]] = []
+        self._fan_topics: List[Set[str]] = []
+        self._lcd_topics: List[Set[str]] = []
+        # Read at every message, kept in lists since reading single elements of an array is slower
+        self._time_temperature: List[float] = []
+        self._welcomed: List[bool] = []
+        # Temperatures accepted since the last flush
+        self._pending_index: List[int] = []
+        self._pending_value: List[float] = []
+        # Homes where people arrived since the last flush
+        self._touched: List[int] = []
+        # Commands that don't depend on the PWM, in arrival order
+        self._pending: List[Command] = []
+
+        self.set_point_1 = np.empty((0, 4))
+        self.set_point_0 = np.empty((0, 4))
+        self.temperature = np.empty(0)
+        self.time_pir = np.empty(0)
+        self.time_noise = np.empty(0)
+        self.pir_flag = np.empty(0, dtype=bool)
+        self.noise_flag = np.empty(0, dtype=bool)
+        self.led = np.empty(0, dtype=np.int16)
+        self.fan = np.empty(0, dtype=np.int16)
+        # Noise bursts, only of the homes that sent some noise
+        self._noise_detectors: Dict[int, RateDetector] = {}
+        # Next expiry of the presence flags, by home index
+        self._wheel = TimerWheel()
+        self._resize(capacity)
+
+    def _resize(self, capacity: int):
+        """
+        Grow the state arrays
+
+        :param capacity: new capacity
+        """
+        self.set_point_1 = _grow(self.set_point_1, capacity, np.nan)
+        self.set_point_0 = _grow(self.set_point_0, capacity, np.nan)
+        self.temperature = _grow(self.temperature, capacity, 0.0)
+        self.time_pir = _grow(self.time_pir, capacity, 0.0)
+        self.time_noise = _grow(self.time_noise, capacity, 0.0)
+        self.pir_flag = _grow(self.pir_flag, capacity, False)
+        self.noise_flag = _grow(self.noise_flag, capacity, False)
+        self.led = _grow(self.led, capacity, NO_COMMAND)
+        self.fan = _grow(self.fan, capacity, NO_COMMAND)
+
+    def add(self, home: str, led_topics: Set[str], fan_topics: Set[str], lcd_topics: Set[str],
+            now: Optional[float] = None):
+        """
+        Start controlling a home
+
+        :param home: identifier of the home
+        :param led_topics: Topics to control the led
+        :param fan_topics: Topic to control the fan
+        :param lcd_topics: Topics to control the lcd
+        :param now: time at which the home is added, default time.time()
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            index = self._index.get(home)
+            if index is None:
+                if self._free:
+                    index = self._free.pop()
+                else:
+                    index = self.size
+                    if index == len(self.led):
+                        self._resize(2 * len(self.led))
+                    self.size += 1
+                    self._homes.append(None)
+                    self._led_topics.append(set())
+                    self._fan_topics.append(set())
+                    self._lcd_topics.append(set())
+                    self._time_temperature.append(now)
+                    self._welcomed.append(False)
+                self._index[home] = index
+                self._homes[index] = home
+            self._led_topics[index] = led_topics
+            self._fan_topics[index] = fan_topics
+            self._lcd_topics[index] = lcd_topics
+            self.set_point_1[index] = SET_POINT_PEOPLE
+            self.set_point_0[index] = SET_POINT_NO_PEOPLE
+            self.temperature[index] = 0.0
+            self._time_temperature[index] = self.time_pir[index] = self.time_noise[index] = now
+            self._welcomed[index] = False
+            self.pir_flag[index] = self.noise_flag[index] = False
+            self.led[index] = self.fan[index] = NO_COMMAND
+            self._noise_detectors.pop(index, None)
+            self._wheel.cancel(index)
+
+    def forget(self, home: str):
+        """
+        Stop controlling a home, its slot is reused by the next home added
+
+        :param home: identifier of the home
+        """
+        with self._lock:
+            index = self._index.pop(home, None)
+            if index is None:
+                return
+            self._homes[index] = None
+            self._noise_detectors.pop(index, None)
+            self._wheel.cancel(index)
+            self._free.append(index)
+            if index in self._touched:
+                self._touched = [position for position in self._touched if position != index]
+            if index in self._pending_index:
+                pending = [
+                    (position, value)
+                    for position, value in zip(self._pending_index, self._pending_value)
+                    if position != index
+                ]
+                self._pending_index = [position for position, _ in pending]
+                self._pending_value = [value for _, value in pending]
+
+    def submit(self, home: str, message: dict, now: Optional[float] = None):
+        """
+        Update the state of a home with a message, the led and the fan are commanded by flush
+
+        :param home: identifier of the home
+        :param message: SenML record received from the home
+        :param now: time of the message, default time.time()
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            index = self._index.get(home)
+            if index is None:
+                return
+            if not self._welcomed[index]:
+                self._welcomed[index] = True
+                self._pending.extend((home, topic, WELCOME_PAYLOAD) for topic in self._lcd_topics[index])
+
+            name = message["n"]
+            if name == "temperature":
+                if now - self._time_temperature[index] < TEMPERATURE_INTERVAL:
+                    return
+                self._time_temperature[index] = now
+                self._pending_index.append(index)
+                self._pending_value.append(message["v"])
+                payload = lcd_payload(message["v"], message["u"])
+                self._pending.extend((home, topic, payload) for topic in self._lcd_topics[index])
+
+            elif name == "PIR" and message["v"] == 1:
+                self.time_pir[index] = now
+                if not (self.pir_flag[index] or self.noise_flag[index]):
+                    self.pir_flag[index] = True
+                    self._touched.append(index)
+                    self._schedule(index)
+                self.pir_flag[index] = True
+
+            elif name == "noise" and message["v"] == 1:
+                detector = self._noise_detectors.get(index)
+                if detector is None:
+                    detector = self._noise_detectors[index] = RateDetector(NOISE_EVENTS, SOUND_INTERVAL)
+                if detector.hit(now):
+                    self.time_noise[index] = now
+                    if not (self.pir_flag[index] or self.noise_flag[index]):
+                        self.noise_flag[index] = True
+                        self._touched.append(index)
+                        self._schedule(index)
+                    self.noise_flag[index] = True
+
+            elif name == "sp1":
+                self.set_point_1[index] = message["v"]
+            elif name == "sp0":
+                self.set_point_0[index] = message["v"]
+
+    def _schedule(self, index: int):
+        """
+        Schedule on the wheel the time at which a home is left without people, as SmartHome does
+
+        :param index: index of the home
+        """
+        deadlines = []
+        if self.pir_flag[index]:
+            deadlines.append(self.time_pir[index] + TIMEOUT_PIR)
+        if self.noise_flag[index]:
+            deadlines.append(self.time_noise[index] + TIMEOUT_SOUND)
+        if deadlines:
+            self._wheel.schedule(index, float(max(deadlines)))
+        else:
+            self._wheel.cancel(index)
+
+    def flush(self, now: Optional[float] = None) -> List[Command]:
+        """
+        Compute the led and fan PWM of the homes that received a temperature, or whose
+        presence changed, since the previous flush
+
+        :param now: time of the evaluation, default time.time()
+        :return: commands to publish, the lcd ones first
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            commands, self._pending = self._pending, []
+            index, value = self._pending_index, self._pending_value
+            self._pending_index, self._pending_value = [], []
+            touched, self._touched = self._touched, []
+            self.counters["flushes"] += 1
+            self.counters["readings"] += len(index)
+
+            # Flags expire after their timeout
+            expired = self._wheel.advance(now)
+            if expired:
+                self.pir_flag[expired] &= now - self.time_pir[expired] < TIMEOUT_PIR
+                self.noise_flag[expired] &= now - self.time_noise[expired] < TIMEOUT_SOUND
+                for position in expired:
+                    self._schedule(position)
+                # Only the homes left empty change set-point
+                expired = np.asarray(expired, dtype=np.intp)
+                touched.extend(expired[~(self.pir_flag[expired] | self.noise_flag[expired])].tolist())
+
+            # Homes without a temperature are commanded only if they have been commanded before
+            homes = np.asarray(touched, dtype=np.intp)
+            homes = homes[self.led[homes] != NO_COMMAND]
+            if index:
+                # Last temperature of every home
+                updated, last = np.unique(np.asarray(index[::-1], dtype=np.intp), return_index=True)
+                self.temperature[updated] = np.asarray(value[::-1], dtype=float)[last]
+                homes = np.concatenate((homes, updated))
+            if not len(homes):
+                self.counters["commands"] += len(commands)
+                return commands
+            homes = np.unique(homes)
+
+            people = self.pir_flag[homes] | self.noise_flag[homes]
+            set_point = np.where(people[:, None], self.set_point_1[homes], self.set_point_0[homes])
+            temperature = self.temperature[homes]
+            fan_min, fan_max, led_min, led_max = set_point.T
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                led_ramp = MAX_PWM_FAN_AND_LED - (temperature - led_min) / (led_max - led_min) * MAX_PWM_FAN_AND_LED
+                fan_ramp = (temperature - fan_min) / (fan_max - fan_min) * MAX_PWM_FAN_AND_LED
+            led = np.where(
+                (led_min < temperature) & (temperature < led_max),
+                led_ramp,
+                np.where(temperature <= led_min, MAX_PWM_FAN_AND_LED, MIN)
+            ).astype(np.int16)
+            fan = np.where(
+                (fan_min < temperature) & (temperature < fan_max),
+                fan_ramp,
+                np.where(temperature <= fan_min, MIN, MAX_PWM_FAN_AND_LED)
+            ).astype(np.int16)
+
+            led_changed = led != self.led[homes]
+            fan_changed = fan != self.fan[homes]
+            self.led[homes] = led
+            self.fan[homes] = fan
+            self.counters["unchanged"] += int(2 * len(homes) - np.count_nonzero(led_changed) - np.count_nonzero(fan_changed))
+
+            for index, value in zip(homes[led_changed].tolist(), led[led_changed].tolist()):
+                commands.extend((self._homes[index], topic, LED_PAYLOADS[value]) for topic in self._led_topics[index])
+            for index, value in zip(homes[fan_changed].tolist(), fan[fan_changed].tolist()):
+                commands.extend((self._homes[index], topic, FAN_PAYLOADS[value]) for topic in self._fan_topics[index])
+            self.counters["commands"] += len(commands)
+        return commands
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Command outbox sw_lab3
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import threading
+from typing import Dict, List, Tuple
+
+# ---------------------------------------------------------------
+
+Pack = Tuple[str, str]
+"""Device and payload of a SenML pack to publish"""
+
+# ---------------------------------------------------------------
+
+
+class DevicePublisher:
+    """
+    Stand-in for the MQTT client given to a SmartHome: the commands published
+    are queued in the outbox of the service instead of being sent
+    """
+
+    __slots__ = ("outbox", "device")
+
+    def __init__(self, outbox: "CommandOutbox", device: str):
+        """
+        Instantiate the publisher
+
+        :param outbox: outbox in which queue the commands
+        :param device: device commanded
+        """
+        self.outbox = outbox
+        self.device = device
+
+    def publish(self, topic: str, payload: str = None):
+        """
+        Queue a command
+
+        :param topic: topic of the actuator
+        :param payload: SenML record of the command
+        """
+        self.outbox.post(self.device, topic, payload)
+
+
+class CommandOutbox:
+    """
+    Output stage that coalesces the commands of the devices: the commands posted are
+    kept per device and per actuator topic, a command replaces the previous one of the same
+    actuator, and drain returns one SenML pack per device with the last value of every actuator
+    """
+
+    def __init__(self):
+        """
+        Instantiate the outbox
+        """
+        self.counters = {"posted": 0, "superseded": 0, "packs": 0}
+        self._lock = threading.Lock()
+        # Device -> actuator topic -> SenML record, in the order of the first command
+        self._queued: Dict[str, Dict[str, str]] = {}
+
+    def publisher(self, device: str) -> DevicePublisher:
+        """
+        Publisher that queues the commands of a device
+
+        :param device: device commanded
+        """
+        return DevicePublisher(self, device)
+
+    def post(self, device: str, topic: str, record: str):
+        """
+        Queue a command, replacing the one of the same actuator not sent yet
+
+        :param device: device commanded
+        :param topic: topic of the actuator
+        :param record: SenML record of the command
+        """
+        with self._lock:
+            queue = self._queued.get(device)
+            if queue is None:
+                queue = self._queued[device] = {}
+            elif topic in queue:
+                self.counters["superseded"] += 1
+            queue[topic] = record
+            self.counters["posted"] += 1
+
+    def forget(self, device: str):
+        """
+        Drop the commands of a device not sent yet
+
+        :param device: device no longer commanded
+        """
+        with self._lock:
+            self._queued.pop(device, None)
+
+    def drain(self) -> List[Pack]:
+        """
+        Take the commands queued
+
+        :return: a SenML pack for every device commanded. The pack has no base name,
+            as the single records, since it is sent on the commands topic of the device
+        """
+        with self._lock:
+            queued, self._queued = self._queued, {}
+            self.counters["packs"] += len(queued)
+        # The records are already encoded
+        return [(device, "[" + ",".join(queue.values()) + "]") for device, queue in queued.items()]
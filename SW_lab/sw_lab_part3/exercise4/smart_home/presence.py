@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Presence detection sw_lab3
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+from array import array
+from typing import Dict, Hashable, List, Optional
+
+# ---------------------------------------------------------------
+
+WHEEL_RESOLUTION = 1.0
+"""Seconds covered by a slot of the timer wheel"""
+
+WHEEL_SLOTS = 4096
+"""Slots of the timer wheel, one round covers more than the longest presence timeout"""
+
+# ---------------------------------------------------------------
+
+
+class RateDetector:
+    """
+    Sliding count of events over an interval. The timestamps of the last events are kept
+    in a fixed ring, so the memory doesn't depend on the rate of the events
+    """
+
+    __slots__ = ("events", "interval", "_ring", "_head", "_count")
+
+    def __init__(self, events: int, interval: float):
+        """
+        Instantiate the detector
+
+        :param events: events to keep, the burst is detected on the next one
+        :param interval: seconds in which the events have to happen
+        """
+        self.events = events
+        self.interval = interval
+        self._ring = array("d", bytes(8 * events))
+        self._head = 0
+        self._count = 0
+
+    def hit(self, now: float) -> bool:
+        """
+        Record an event
+
+        :param now: time of the event
+        :return: True if the previous events all happened in the interval before this one
+        """
+        head = self._head
+        if self._count < self.events:
+            self._count += 1
+            burst = False
+        else:
+            burst = now - self._ring[head] < self.interval
+        self._ring[head] = now
+        head += 1
+        self._head = head if head < self.events else 0
+        return burst
+
+    def count(self, now: float) -> int:
+        """
+        Events recorded in the interval before now
+
+        :param now: end of the interval
+        """
+        return sum(1 for position in range(self._count) if now - self._ring[position] < self.interval)
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: every key has one deadline, stored in the slot of its tick.
+    Scheduling and cancelling cost a dict operation and advance only looks at the slots
+    of the ticks passed since the previous call, so thousands of timeouts can be followed
+    by advancing the wheel periodically. The wheel is not thread safe, its owner
+    has to serialise the calls
+    """
+
+    def __init__(self, resolution: float = WHEEL_RESOLUTION, slots: int = WHEEL_SLOTS):
+        """
+        Instantiate the wheel
+
+        :param resolution: seconds covered by a slot
+        :param slots: number of slots
+        """
+        self.resolution = resolution
+        self._slots: List[Optional[Dict[Hashable, float]]] = [None] * slots
+        self._where: Dict[Hashable, int] = {}
+        # Last tick whose slot has been completely expired
+        self._done: Optional[int] = None
+
+    def __len__(self) -> int:
+        """
+        Number of timers scheduled
+        """
+        return len(self._where)
+
+    def schedule(self, key: Hashable, deadline: float):
+        """
+        Schedule a timer, replacing the previous one of the same key
+
+        :param key: key returned by advance when the timer expires
+        :param deadline: time at which the timer expires
+        """
+        tick = int(deadline // self.resolution)
+        if self._done is not None and tick <= self._done:
+            tick = self._done + 1
+        slot = tick % len(self._slots)
+        previous = self._where.get(key)
+        if previous is not None and previous != slot:
+            del self._slots[previous][key]
+        bucket = self._slots[slot]
+        if bucket is None:
+            bucket = self._slots[slot] = {}
+        bucket[key] = deadline
+        self._where[key] = slot
+
+    def cancel(self, key: Hashable):
+        """
+        Cancel the timer of a key, if any
+
+        :param key: key of the timer
+        """
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            del self._slots[slot][key]
+
+    def advance(self, now: float) -> List[Hashable]:
+        """
+        Expire the timers whose deadline is passed
+
+        :param now: current time
+        :return: keys of the timers expired, they are no longer scheduled
+        """
+        current = int(now // self.resolution)
+        if self._done is None or current - self._done > len(self._slots):
+            slots = range(len(self._slots))
+        else:
+            slots = [tick % len(self._slots) for tick in range(self._done + 1, current + 1)]
+        # The slot of the current tick can still hold timers, it is looked at again next time
+        self._done = current - 1 if self._done is None else max(self._done, current - 1)
+
+        expired = []
+        for slot in slots:
+            bucket = self._slots[slot]
+            if not bucket:
+                continue
+            due = [key for key, deadline in bucket.items() if deadline <= now]
+            for key in due:
+                del bucket[key]
+                del self._where[key]
+            expired.extend(due)
+        return expired
@@ -16,14 +16,16 @@ SmartHome sw_lab3
     limitations under the License.
 """
 # Standard Library
-from collections import deque
 import json
 import time
-from typing import Set
+from typing import Optional, Sequence, Set
 
 # Third Party
 from paho.mqtt.client import Client
 
+# Internals
+from .presence import RateDetector, TimerWheel
+
 # ---------------------------------------------------------------
 
 MAX_PWM_FAN_AND_LED = 255
@@ -31,20 +33,84 @@ MIN = 0
 TIMEOUT_PIR = 30 * 60
 TIMEOUT_SOUND = 60 * 60
 SOUND_INTERVAL = 10 * 60
+TEMPERATURE_INTERVAL = 30
+NOISE_EVENTS = 49
 
+SET_POINT_PEOPLE = (22.0, 25.0, 16.0, 20.0)
+"""Default set-point to use when people detected: fan min and max, led min and max"""
 
-class SmartHome:
-    set_point_min_max_1 = [22.0, 25.0, 16.0, 20.0]
-    """Default set-point to use when people detected"""
+SET_POINT_NO_PEOPLE = (24.0, 28.0, 14.0, 18.0)
+"""Default set-point to use when people not detected: fan min and max, led min and max"""
+
+LED_PAYLOADS = [json.dumps({"n": "led", "v": value, "u": None}) for value in range(MAX_PWM_FAN_AND_LED + 1)]
+"""Commands of the led, encoded once for every PWM value"""
+
+FAN_PAYLOADS = [json.dumps({"n": "FAN", "v": value, "u": None}) for value in range(MAX_PWM_FAN_AND_LED + 1)]
+"""Commands of the fan, encoded once for every PWM value"""
+
+WELCOME_PAYLOAD = json.dumps({"n": "lcd", "v": "Smart Home Welcome", "u": None})
+
+
+def lcd_payload(value: float, unit: str) -> str:
+    """
+    Command of the lcd showing a temperature, only the text is encoded at every call
+
+    :param value: temperature
+    :param unit: unit of the temperature
+    """
+    return '{"n": "lcd", "v": ' + json.dumps(f"Smart Home {value} {unit}") + ', "u": null}'
+
+
+def led_pwm(temperature: float, set_point: Sequence[float]) -> int:
+    """
+    PWM of the led (heater): full power under the led min, off over the led max
+
+    :param temperature: temperature of the home
+    :param set_point: set-point in use
+    """
+    if set_point[2] < temperature < set_point[3]:
+        return int(
+            MAX_PWM_FAN_AND_LED
+            - (temperature - set_point[2]) / (set_point[3] - set_point[2]) * MAX_PWM_FAN_AND_LED
+        )
+    if temperature <= set_point[2]:
+        return MAX_PWM_FAN_AND_LED
+    return MIN
+
+
+def fan_pwm(temperature: float, set_point: Sequence[float]) -> int:
+    """
+    PWM of the fan (air conditioning): off under the fan min, full power over the fan max
 
-    set_point_min_max_0 = [24.0, 28.0, 14.0, 18.0]
-    """Default set-point to use when people not detected"""
+    :param temperature: temperature of the home
+    :param set_point: set-point in use
+    """
+    if set_point[0] < temperature < set_point[1]:
+        return int((temperature - set_point[0]) / (set_point[1] - set_point[0]) * MAX_PWM_FAN_AND_LED)
+    if temperature <= set_point[0]:
+        return MIN
+    return MAX_PWM_FAN_AND_LED
 
-    set_point = []
-    """Set - point in use"""
+
+class SmartHome:
+    """
+    State of a smart home. The state is kept in slots, so that thousands of homes
+    take little memory, and the led and the fan are commanded only when their PWM changes.
+    Given a timer wheel, the home schedules the expiry of its presence flags on it, so that
+    the owner of the wheel can call refresh and change the set-point on time even if no
+    temperature arrives
+    """
+
+    __slots__ = (
+        "time_temperature", "time_pir", "time_noise", "noise_detector", "noise_flag", "pir_flag",
+        "temperature", "led_topics", "fan_topics", "lcd_topics", "first_time",
+        "set_point_min_max_1", "set_point_min_max_0", "set_point", "people", "led", "fan",
+        "wheel", "publisher"
+    )
 
     def __init__(
-        self, led_topics: Set[str], fan_topics: Set[str], lcd_topics: Set[str]
+        self, led_topics: Set[str], fan_topics: Set[str], lcd_topics: Set[str],
+        wheel: Optional[TimerWheel] = None
     ):
         """
         Instantiate a Smart Home
@@ -52,11 +118,14 @@ class SmartHome:
         :param led_topics: Topics to control the led
         :param fan_topics: Topic to control the fan
         :param lcd_topics: Topics to control the lcd
+        :param wheel: timer wheel on which the presence timeouts are scheduled, if any
         """
-        self.time_temperature = time.time()
-        self.time_pir = time.time()
-        self.time_noise = time.time()
-        self.noise_timestamps = deque(maxlen=49)
+        now = time.time()
+        self.time_temperature = now
+        self.time_pir = now
+        self.time_noise = now
+        # Created with the first noise event
+        self.noise_detector: Optional[RateDetector] = None
         self.noise_flag = False
         self.pir_flag = False
         self.temperature = 0
@@ -64,150 +133,151 @@ class SmartHome:
         self.fan_topics = fan_topics
         self.lcd_topics = lcd_topics
         self.first_time = False
+        # Set-points of this home, replaced by the sp1 and sp0 messages. Tuples, so the
+        # defaults can be shared by all the homes
+        self.set_point_min_max_1 = SET_POINT_PEOPLE
+        self.set_point_min_max_0 = SET_POINT_NO_PEOPLE
+        self.set_point = self.set_point_min_max_0
+        self.people = False
+        # PWM last published, None before the first command
+        self.led: Optional[int] = None
+        self.fan: Optional[int] = None
+        self.wheel = wheel
+        # Client of the last message, used to command the home when a flag expires
+        self.publisher: Optional[Client] = None
 
-    def parse_message(self, message: dict, publisher: Client):
+    def parse_message(self, message: dict, publisher: Client, now: Optional[float] = None):
         """
         Parse the message received to control the smart home
-        
-        :param message: Data to parse 
+
+        :param message: Data to parse
         :param publisher: MQTT client used to communicate
-        :return: 
-        """ ""
+        :param now: time of the message, default time.time()
+        """
+        self.publisher = publisher
         if not self.first_time:
             self.first_time = True
             for topic in self.lcd_topics:
-                publisher.publish(
-                    topic,
-                    payload=json.dumps(
-                        {"n": "lcd", "v": "Smart Home Welcome", "u": None}
-                    )
-                )
+                publisher.publish(topic, payload=WELCOME_PAYLOAD)
 
-        now = time.time()
-        if (now - self.time_pir) >= TIMEOUT_PIR and self.pir_flag:
+        if now is None:
+            now = time.time()
+        if self.pir_flag and now - self.time_pir >= TIMEOUT_PIR:
             self.pir_flag = False
-
-        if (now - self.time_noise) >= TIMEOUT_SOUND and self.noise_flag:
+        if self.noise_flag and now - self.time_noise >= TIMEOUT_SOUND:
             self.noise_flag = False
 
-        if message["n"] == "temperature":
-            if now - self.time_temperature < 30:
-                return
-
-            self.time_temperature = now
-            if self.noise_flag or self.pir_flag:
-                self.set_point = self.set_point_min_max_1
-            else:
-                self.set_point = self.set_point_min_max_0
+        name = message["n"]
+        if name == "temperature":
+            if now - self.time_temperature >= TEMPERATURE_INTERVAL:
+                self.time_temperature = now
+                self.people = self.noise_flag or self.pir_flag
+                self.set_point = self.set_point_min_max_1 if self.people else self.set_point_min_max_0
 
-            self.temperature = message["v"]
-            for topic in self.lcd_topics:
-                publisher.publish(
-                    topic,
-                    payload=json.dumps(
-                        {
-                            "n": "lcd",
-                            "v": f"Smart Home {message['v']} {message['u']}",
-                            "u": None
-                        }
-                    )
-                )
-            self.manage_red_led(publisher)
-            self.manage_fan(publisher)
-            return
+                self.temperature = message["v"]
+                payload = lcd_payload(message["v"], message["u"])
+                for topic in self.lcd_topics:
+                    publisher.publish(topic, payload=payload)
+                self.manage_red_led(publisher)
+                self.manage_fan(publisher)
 
-        elif message["n"] == "PIR" and message["v"] == 1:
+        elif name == "PIR" and message["v"] == 1:
             self.time_pir = now
+            if not (self.pir_flag or self.noise_flag):
+                self.pir_flag = True
+                self._schedule()
             self.pir_flag = True
 
-        elif message["n"] == "noise" and message["v"] == 1:
-            if len(self.noise_timestamps) == 49:
-                if (time.time() - self.noise_timestamps[0]) < SOUND_INTERVAL:
+        elif name == "noise" and message["v"] == 1:
+            if self.noise_detector is None:
+                self.noise_detector = RateDetector(NOISE_EVENTS, SOUND_INTERVAL)
+            if self.noise_detector.hit(now):
+                self.time_noise = now
+                if not (self.pir_flag or self.noise_flag):
                     self.noise_flag = True
-            self.noise_timestamps.append(time.time())
+                    self._schedule()
+                self.noise_flag = True
+
+        elif name == "sp1":
+            self.set_point_min_max_1 = tuple(message["v"])
+        elif name == "sp0":
+            self.set_point_min_max_0 = tuple(message["v"])
+
+        if (self.noise_flag or self.pir_flag) != self.people:
+            self._apply_presence(publisher)
+
+    def refresh(self, now: Optional[float] = None):
+        """
+        Expire the presence flags whose timeout is passed and command the home with the
+        new set-point, called by the owner of the wheel when the timer of the home expires
+
+        :param now: current time, default time.time()
+        """
+        now = time.time() if now is None else now
+        if self.pir_flag and now - self.time_pir >= TIMEOUT_PIR:
+            self.pir_flag = False
+        if self.noise_flag and now - self.time_noise >= TIMEOUT_SOUND:
+            self.noise_flag = False
+        self._schedule()
+        if self.publisher is not None:
+            self._apply_presence(self.publisher)
+
+    def _schedule(self):
+        """
+        Schedule on the wheel the time at which the home is left without people. The timer
+        is set only when people arrive: new PIR and noise events move the real deadline
+        forward, and refresh schedules the timer again if it expires too early
+        """
+        if self.wheel is None:
             return
+        deadlines = []
+        if self.pir_flag:
+            deadlines.append(self.time_pir + TIMEOUT_PIR)
+        if self.noise_flag:
+            deadlines.append(self.time_noise + TIMEOUT_SOUND)
+        if deadlines:
+            self.wheel.schedule(self, max(deadlines))
+        else:
+            self.wheel.cancel(self)
 
-        elif message["n"] == "sp1":
-            self.set_point_min_max_1 = message["v"]
-        elif message["n"] == "sp0":
-            self.set_point_min_max_0 = message["v"]
+    def _apply_presence(self, publisher: Client):
+        """
+        Switch the set-point when people arrive or leave, commanding the led and the
+        fan with the last temperature if the home has already been commanded
+
+        :param publisher: MQTT client
+        """
+        people = self.noise_flag or self.pir_flag
+        if people == self.people:
+            return
+        self.people = people
+        self.set_point = self.set_point_min_max_1 if people else self.set_point_min_max_0
+        if self.led is not None:
+            self.manage_red_led(publisher)
+            self.manage_fan(publisher)
 
     def manage_red_led(self, publisher: Client):
         """
-        Control the led (heater)
+        Control the led (heater), publishing only if its PWM changes
 
         :param publisher: MQTT client
-        :return:
         """
-        if self.set_point[2] < self.temperature < self.set_point[3]:
-            for topic in self.led_topics:
-                publisher.publish(
-                    topic,
-                    payload=json.dumps(
-                        {
-                            "n": "led",
-                            "v": int(
-                                MAX_PWM_FAN_AND_LED
-                                - (
-                                    (self.temperature - self.set_point[2])
-                                    / (self.set_point[3] - self.set_point[2])
-                                    * MAX_PWM_FAN_AND_LED
-                                )
-                            ),
-                            "u": None
-                        }
-                    )
-                )
-
-        elif self.temperature <= self.set_point[2]:
-            for topic in self.led_topics:
-                publisher.publish(
-                    topic,
-                    payload=json.dumps(
-                        {"n": "led", "v": MAX_PWM_FAN_AND_LED, "u": None}
-                    )
-                )
-
-        else:
-            for topic in self.led_topics:
-                publisher.publish(
-                    topic, payload=json.dumps({"n": "led", "v": MIN, "u": None})
-                )
+        value = led_pwm(self.temperature, self.set_point)
+        if value == self.led:
+            return
+        self.led = value
+        for topic in self.led_topics:
+            publisher.publish(topic, payload=LED_PAYLOADS[value])
 
     def manage_fan(self, publisher: Client):
         """
-        Control the fan (Air Conditioning)
+        Control the fan (Air Conditioning), publishing only if its PWM changes
 
         :param publisher: MQTT client
-        :return:
         """
-        if self.set_point[0] < self.temperature < self.set_point[1]:
-            for topic in self.fan_topics:
-                publisher.publish(
-                    topic,
-                    payload=json.dumps(
-                        {
-                            "n": "FAN",
-                            "v": int(
-                                (self.temperature - self.set_point[0])
-                                / (self.set_point[1] - self.set_point[0])
-                                * MAX_PWM_FAN_AND_LED
-                            ),
-                            "u": None
-                        }
-                    )
-                )
-        elif self.temperature <= self.set_point[0]:
-            for topic in self.fan_topics:
-                publisher.publish(
-                    topic, payload=json.dumps({"n": "FAN", "v": MIN, "u": None})
-                )
-
-        else:
-            for topic in self.fan_topics:
-                publisher.publish(
-                    topic,
-                    payload=json.dumps(
-                        {"n": "FAN", "v": MAX_PWM_FAN_AND_LED, "u": None}
-                    )
-                )
+        value = fan_pwm(self.temperature, self.set_point)
+        if value == self.fan:
+            return
+        self.fan = value
+        for topic in self.fan_topics:
+            publisher.publish(topic, payload=FAN_PAYLOADS[value])
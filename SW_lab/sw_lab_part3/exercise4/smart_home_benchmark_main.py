@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Smart home benchmark
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import argparse
+import json
+from random import Random
+import time
+import tracemalloc
+from typing import List, Optional
+
+# Internals
+from smart_home.fleet import FleetController
+from smart_home.outbox import CommandOutbox
+from smart_home.presence import WHEEL_RESOLUTION, TimerWheel
+from smart_home.smart_home import NOISE_EVENTS, TEMPERATURE_INTERVAL, TIMEOUT_PIR, TIMEOUT_SOUND, SmartHome
+
+# -----------------------------------------------------------------------------
+
+###########
+# HELPERS #
+###########
+
+
+class FakeClient:
+    """
+    Stand-in for the paho client that only counts the publishes and their bytes
+    """
+
+    def __init__(self):
+        """
+        Instantiate the client
+        """
+        self.published = 0
+        self.bytes = 0
+
+    def publish(self, topic: str, payload: str = None):
+        """
+        Count the publish
+        :param topic: topic
+        :param payload: payload
+        """
+        self.published += 1
+        self.bytes += len(topic) + len(payload)
+
+
+def fake_home(index: int, wheel: Optional[TimerWheel] = None) -> SmartHome:
+    """
+    Build the SmartHome of a device with one led, one fan and one lcd
+    :param index: index of the device
+    :param wheel: timer wheel of the presence timeouts
+    """
+    return SmartHome({f"bench/{index}/led"}, {f"bench/{index}/FAN"}, {f"bench/{index}/lcd"}, wheel)
+
+# -----------------------------------------------------------------------------
+
+#############
+# BENCHMARK #
+#############
+
+
+def fake_fleet(homes: int) -> FleetController:
+    """
+    Build a fleet controller of homes with one led, one fan and one lcd
+    :param homes: number of smart homes
+    """
+    fleet = FleetController()
+    for index in range(homes):
+        fleet.add(str(index), {f"bench/{index}/led"}, {f"bench/{index}/FAN"}, {f"bench/{index}/lcd"})
+    return fleet
+
+
+def bench(homes: int, rounds: int, seed: int, controller: bool = False, coalesce: bool = False) -> dict:
+    """
+    Measure memory and per-reading cost of the smart homes
+    :param homes: number of smart homes
+    :param rounds: temperature readings sent to every home
+    :param seed: seed of the random generator
+    :param controller: control the homes with the fleet controller
+    :param coalesce: send the commands of every home as one SenML pack per round
+    """
+    rng = Random(seed)
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    if controller:
+        fleet = fake_fleet(homes)
+    else:
+        fleet = [fake_home(index) for index in range(homes)]
+    memory = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+
+    # Slowly changing temperatures, one reading every TEMPERATURE_INTERVAL seconds per home
+    temperatures = [rng.uniform(12, 30) for _ in range(homes)]
+    client = FakeClient()
+    outbox = CommandOutbox()
+    publishers = [outbox.publisher(str(index)) if coalesce else client for index in range(homes)]
+    now = time.time()
+    elapsed = flushed = 0.0
+    for _ in range(rounds):
+        now += TEMPERATURE_INTERVAL
+        messages = []
+        for index in range(homes):
+            temperatures[index] += rng.uniform(-0.2, 0.2)
+            messages.append({"n": "temperature", "v": round(temperatures[index], 1), "u": "Cel"})
+        begin = time.perf_counter()
+        if controller:
+            for index, message in enumerate(messages):
+                fleet.submit(str(index), message, now)
+        else:
+            for home, publisher, message in zip(fleet, publishers, messages):
+                home.parse_message(message, publisher, now)
+        elapsed += time.perf_counter() - begin
+
+        # The fleet controller commands all the homes at once, the outbox sends the packs
+        begin = time.perf_counter()
+        if controller:
+            for device, topic, payload in fleet.flush(now):
+                publishers[int(device)].publish(topic, payload)
+        if coalesce:
+            for device, payload in outbox.drain():
+                client.publish(f"bench/{device}/commands", payload)
+        flushed += time.perf_counter() - begin
+
+    readings = homes * rounds
+    # Without the change detection every reading commands the led and the fan
+    commands = (outbox.counters["posted"] if coalesce else client.published) - homes - readings
+    return {
+        "homes": homes,
+        "rounds": rounds,
+        "bytes_per_home": round(memory / homes),
+        "reading_us": round(elapsed / readings * 1e6, 3),
+        "flush_ms": round(flushed / rounds * 1e3, 3),
+        "readings_per_s": round(readings / (elapsed + flushed)),
+        "commands": commands,
+        "commands_unchanged_skipped": 2 * readings - commands,
+        "commands_superseded": outbox.counters["superseded"],
+        "messages_published": client.published,
+        "bytes_published": client.bytes,
+    }
+
+
+def bench_presence(homes: int, seed: int) -> dict:
+    """
+    Measure the noise detector and the expiry of the presence flags: every home is commanded once,
+    then receives a burst of noise (half of them also a PIR event) and no other message, while
+    the timer wheel is advanced every WHEEL_RESOLUTION seconds until all the flags expire
+    :param homes: number of smart homes
+    :param seed: seed of the random generator
+    """
+    rng = Random(seed)
+    wheel = TimerWheel()
+    client = FakeClient()
+    smart_homes = [fake_home(index, wheel) for index in range(homes)]
+    now = time.time() + TEMPERATURE_INTERVAL
+    for home in smart_homes:
+        home.parse_message({"n": "temperature", "v": round(rng.uniform(21, 23), 1), "u": "Cel"}, client, now)
+
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    # A burst of noise, a bit more than the events needed to detect it
+    events = 0
+    begin = time.perf_counter()
+    for second in range(2 * NOISE_EVENTS):
+        for index, home in enumerate(smart_homes):
+            home.parse_message({"n": "noise", "v": 1, "u": None}, client, now + second)
+            if second == 0 and index % 2 == 0:
+                home.parse_message({"n": "PIR", "v": 1, "u": None}, client, now)
+            events += 1
+    noise = time.perf_counter() - begin
+    memory = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    people = sum(home.people for home in smart_homes)
+
+    # Only the wheel is advanced, the flags have to expire without messages
+    published = client.published
+    late = 0.0
+    advanced = ticks = 0.0
+    clock = now
+    while len(wheel) and clock < now + 2 * TIMEOUT_SOUND:
+        clock += WHEEL_RESOLUTION
+        begin = time.perf_counter()
+        expired = wheel.advance(clock)
+        for home in expired:
+            # Time at which the last flag of the home expires
+            left = max(home.time_pir + TIMEOUT_PIR if home.pir_flag else 0.0,
+                       home.time_noise + TIMEOUT_SOUND if home.noise_flag else 0.0)
+            home.refresh(clock)
+            if not home.people:
+                late = max(late, clock - left)
+        advanced += time.perf_counter() - begin
+        ticks += 1
+
+    return {
+        "homes": homes,
+        "noise_events": events,
+        "noise_event_us": round(noise / events * 1e6, 3),
+        "noise_bytes_per_home": round(memory / homes),
+        "homes_with_people": people,
+        "homes_with_people_after_timeouts": sum(home.people for home in smart_homes),
+        "advance_us": round(advanced / ticks * 1e6, 3),
+        "expiry_late_max_s": round(late, 3),
+        "commands_without_temperature": client.published - published,
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse the command line
+    :param argv: arguments, default sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Benchmark of the smart homes")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="numbers of smart homes to test")
+    parser.add_argument("--rounds", type=int, default=10, help="temperature readings sent to every home")
+    parser.add_argument("--fleet", action="store_true", help="control the homes with the fleet controller")
+    parser.add_argument("--coalesce", action="store_true",
+                        help="send the commands of every home as one SenML pack per round")
+    parser.add_argument("--presence", action="store_true",
+                        help="measure the noise detector and the expiry of the presence flags")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random generator")
+    parser.add_argument("--output", help="file in which store the report, default stdout")
+    parser.add_argument("--history", help="JSON lines file to which append the report")
+    return parser.parse_args(argv)
+
+
+def main():
+    """
+    Run the benchmark and store the report
+    """
+    args = parse_args()
+    report = {
+        "timestamp": time.time(),
+        "results": [
+            bench_presence(size, args.seed) if args.presence else bench(size, args.rounds, args.seed, args.fleet, args.coalesce)
+            for size in args.sizes
+        ]
+    }
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.history:
+        with open(args.history, "a") as fp:
+            fp.write(json.dumps(report) + "\n")
+
+
+# -----------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    main()
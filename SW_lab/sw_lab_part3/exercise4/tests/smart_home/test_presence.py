@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Test the presence detection of the smart home
+
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+
+    Copyright 2020 Angelo Cutaia
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import unittest
+
+# Internals
+from smart_home.presence import RateDetector, TimerWheel
+
+# -------------------------------------------------------------------------
+
+
+class TestTimerWheel(unittest.TestCase):
+    """
+    Test the expiration of the timers, across the rounds of the wheel
+    """
+
+    def setUp(self):
+        """
+        Wheel of 8 slots of 1 second
+        """
+        self.wheel = TimerWheel(resolution=1.0, slots=8)
+
+    def test_expire(self):
+        """
+        Test that a timer expires once, when its deadline is passed
+        """
+        self.wheel.schedule("a", 5.5)
+        self.wheel.schedule("b", 7)
+        self.assertEqual(self.wheel.advance(5), [])
+        self.assertEqual(self.wheel.advance(5.6), ["a"])
+        self.assertEqual(self.wheel.advance(7), ["b"])
+        self.assertEqual(self.wheel.advance(8), [])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_reschedule(self):
+        """
+        Test that a timer scheduled again replaces the previous one, and a cancelled one never expires
+        """
+        self.wheel.schedule("a", 5)
+        self.wheel.schedule("a", 9)
+        self.wheel.schedule("b", 6)
+        self.assertEqual(self.wheel.advance(6), ["b"])
+        self.wheel.cancel("a")
+        self.wheel.cancel("c")
+        self.assertEqual(self.wheel.advance(10), [])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_rounds(self):
+        """
+        Test that a timer of a later round of the same slot waits for its deadline,
+        and that the timers are found after a gap longer than a round
+        """
+        self.wheel.schedule("a", 3)
+        self.wheel.schedule("b", 11)
+        self.assertEqual(self.wheel.advance(3.5), ["a"])
+        self.assertEqual(self.wheel.advance(10), [])
+        self.assertEqual(self.wheel.advance(11), ["b"])
+
+        self.wheel.schedule("c", 20)
+        self.assertEqual(self.wheel.advance(1000), ["c"])
+
+    def test_past_deadline(self):
+        """
+        Test that a timer scheduled in the past expires at the next advance
+        """
+        self.wheel.advance(10)
+        self.wheel.schedule("a", 5)
+        self.assertEqual(self.wheel.advance(10), ["a"])
+
+
+class TestRateDetector(unittest.TestCase):
+    """
+    Test the bursts of events
+    """
+
+    def test_burst(self):
+        """
+        Test that a burst is detected only when the previous events all happened in the interval
+        """
+        detector = RateDetector(3, 10)
+        self.assertEqual([detector.hit(now) for now in (0, 1, 2, 3)], [False, False, False, True])
+        self.assertFalse(detector.hit(20))
+        self.assertEqual(detector.count(20), 1)
+        self.assertEqual(detector.count(12.5), 2)
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""
+Email service benchmark
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import argparse
+from contextlib import redirect_stdout
+import json
+import os
+import smtplib
+import tempfile
+import time
+from typing import List, Optional
+
+# Third Party
+from paho.mqtt.client import MQTTMessage
+
+# Internals
+from app.catalog.database import DataBase
+from mailer.directory import UserDirectory
+from mailer.sink import running_sink
+from service_email_main import DIGEST_POLICY, EMAIL_POLICY, NOTIFY_POLICY, Service
+
+# -----------------------------------------------------------------------------
+
+###########
+# HELPERS #
+###########
+
+
+class FakeClient:
+    """
+    Stand-in for the paho client that only counts the publishes
+    """
+
+    def __init__(self):
+        """
+        Instantiate the client
+        """
+        self.published = 0
+
+    def publish(self, topic: str, payload: str = None):
+        """
+        Count the publish
+        :param topic: topic
+        :param payload: payload
+        """
+        self.published += 1
+
+
+def alarm(device: str) -> MQTTMessage:
+    """
+    Build the alarm message of a device
+    :param device: device out of range
+    """
+    msg = MQTTMessage(topic=b"bench/alarm_temperature")
+    msg.payload = json.dumps({"alarm": True, "device": device}).encode()
+    return msg
+
+
+def fake_users(users: int, emails: int) -> List[dict]:
+    """
+    Build the users of the catalog
+    :param users: number of users
+    :param emails: email addresses of every user
+    """
+    return [
+        {
+            "userID": f"User{index}",
+            "name": "Bench",
+            "surname": f"User{index}",
+            "email_addresses": {f"EMAIL{email}": f"user{index}.{email}@bench.local" for email in range(emails)}
+        }
+        for index in range(users)
+    ]
+
+
+def connection_per_recipient(host: str, port: int, sender: str, user_list: dict, text: str):
+    """
+    Send the alarm as done before the pool, kept as a baseline: a connection for
+    every recipient. The STARTTLS and login steps are skipped, the sink doesn't support them
+    :param host: SMTP server
+    :param port: port of the server
+    :param sender: address of the sender
+    :param user_list: users to contact
+    :param text: mail
+    """
+    for user_id in user_list:
+        for email in user_list[user_id]:
+            server = smtplib.SMTP(host, port)
+            server.ehlo()
+            server.sendmail(sender, email, text)
+            server.quit()
+
+
+def wait_delivered(service: Service, timeout: float = 60.0):
+    """
+    Wait until the notifications queued by the service are delivered
+    :param service: email service
+    :param timeout: maximum seconds to wait
+    """
+    deadline = time.monotonic() + timeout
+    while len(service.notifier) and time.monotonic() < deadline:
+        time.sleep(0.001)
+
+# -----------------------------------------------------------------------------
+
+#############
+# BENCHMARK #
+#############
+
+
+def bench(users: int, emails: int, alarms: int, latency: float, baseline: bool) -> dict:
+    """
+    Measure the alarms and the mails sent per second by the email service,
+    and the time spent in the MQTT callback for every alarm
+    :param users: users registered
+    :param emails: email addresses of every user
+    :param alarms: alarms received
+    :param latency: seconds the SMTP server waits before every reply
+    :param baseline: open a connection for every recipient, as before the pool
+    """
+    with running_sink(latency=latency) as sink:
+        EMAIL_POLICY.update(
+            host=sink.host, port=sink.port, security="none", sender="service@bench.local", directory=0.0
+        )
+        NOTIFY_POLICY.update(spool="")
+        # An email for every alarm
+        DIGEST_POLICY.update(window=0.0, interval=0.0)
+        service = Service()
+        client = FakeClient()
+        service.service = client
+        service.directory.apply(fake_users(users, emails), full=True)
+        messages = [alarm(f"BenchYUN{index}") for index in range(alarms)]
+        text = f"Subject: {service.subject}\r\n\r\nBenchYUN is out of range of good functioning"
+
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            service.scheduler.start()
+            service.started()
+            start = time.perf_counter()
+            for msg in messages:
+                if baseline:
+                    connection_per_recipient(sink.host, sink.port, service.from_email, service.directory.emails, text)
+                else:
+                    service.my_on_message(client, None, msg)
+            # Time spent by the MQTT callbacks, then wait for the deliveries in background
+            callback = time.perf_counter() - start
+            wait_delivered(service)
+            elapsed = time.perf_counter() - start
+            service.scheduler.stop()
+            service.stopping()
+
+    return {
+        "mode": "connection_per_recipient" if baseline else "pool",
+        "users": users,
+        "recipients": users * emails,
+        "alarms": alarms,
+        "latency_ms": latency * 1e3,
+        "alarms_per_s": round(alarms / elapsed, 2),
+        "callback_ms": round(callback / alarms * 1e3, 3),
+        "mails_per_s": round(sink.counters["mails"] / elapsed, 2),
+        "recipients_per_s": round(sink.counters["recipients"] / elapsed, 2),
+        "connections": sink.counters["connections"],
+        "mails": sink.counters["mails"],
+        "published": client.published,
+    }
+
+
+def bench_restart(alarms: int, latency: float) -> dict:
+    """
+    Queue alarms while the SMTP server is unreachable, stop the service and check that
+    a new instance delivers them from the spool
+    :param alarms: alarms received before the restart
+    :param latency: seconds the SMTP server waits before every reply
+    """
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        NOTIFY_POLICY.update(
+            spool=os.path.join(directory, "notifications.spool"), retries=100, backoff=0.01, max_backoff=0.05
+        )
+        DIGEST_POLICY.update(window=0.0, interval=0.0)
+        # First run: nothing listening on the port, every delivery fails and is retried
+        EMAIL_POLICY.update(
+            host="127.0.0.1", port=1, security="none", sender="service@bench.local", timeout=0.5, directory=0.0
+        )
+        service = Service()
+        service.service = FakeClient()
+        service.directory.apply(fake_users(10, 1), full=True)
+        service.scheduler.start()
+        service.started()
+        for index in range(alarms):
+            service.my_on_message(service.service, None, alarm(f"BenchYUN{index}"))
+        time.sleep(0.2)
+        service.scheduler.stop()
+        service.stopping()
+        spooled = len(service.notifier.spool)
+
+        # Second run: the server is back
+        with running_sink(latency=latency) as sink:
+            EMAIL_POLICY.update(host=sink.host, port=sink.port)
+            service = Service()
+            client = FakeClient()
+            service.service = client
+            start = time.perf_counter()
+            service.scheduler.start()
+            service.started()
+            wait_delivered(service)
+            elapsed = time.perf_counter() - start
+            service.scheduler.stop()
+            service.stopping()
+            counters = dict(service.notifier.counters)
+
+    return {
+        "mode": "restart",
+        "alarms": alarms,
+        "spooled": spooled,
+        "restored": counters["restored"],
+        "sent": counters["sent"],
+        "mails": sink.counters["mails"],
+        "published": client.published,
+        "recovery_ms": round(elapsed * 1e3, 2),
+    }
+
+
+def bench_storm(users: int, devices: int, alarms: int, window: float, interval: float, burst: int) -> dict:
+    """
+    Count the emails sent for a storm of alarms from a few flapping devices,
+    with and without the digest
+    :param users: users registered
+    :param devices: devices raising the alarms in turn
+    :param alarms: alarms received
+    :param window: seconds in which the alarms are grouped, 0 for an email per alarm
+    :param interval: seconds to earn a new email for a user, 0 no limit
+    :param burst: emails a user can receive in a row
+    """
+    with running_sink() as sink, open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        EMAIL_POLICY.update(
+            host=sink.host, port=sink.port, security="none", sender="service@bench.local", directory=0.0
+        )
+        NOTIFY_POLICY.update(spool="")
+        DIGEST_POLICY.update(window=window, interval=interval, burst=burst)
+        service = Service()
+        client = FakeClient()
+        service.service = client
+        service.directory.apply(fake_users(users, 1), full=True)
+        service.scheduler.start()
+        service.started()
+        for index in range(alarms):
+            service.my_on_message(client, None, alarm(f"BenchYUN{index % devices}"))
+        # Close the window at once instead of waiting for its end
+        service.send_digests()
+        wait_delivered(service)
+        service.scheduler.stop()
+        service.stopping()
+        counters = dict(service.digest.counters)
+
+    return {
+        "mode": "digest" if window > 0 else "rate_limit" if interval > 0 else "email_per_alarm",
+        "users": users,
+        "devices": devices,
+        "alarms": alarms,
+        "mails": sink.counters["mails"],
+        "recipients": sink.counters["recipients"],
+        "digests": counters["digests"],
+        "collapsed": counters["collapsed"],
+        "suppressed": counters["suppressed"],
+        "limited": counters["limited"],
+        "waiting": len(service.digest),
+    }
+
+
+def bench_directory(users: int, changes: int) -> dict:
+    """
+    Compare the update of the users with all the users of the catalog and with
+    only the users changed, on a catalog database with the given users
+    :param users: users registered
+    :param changes: users whose email addresses change between two updates
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        DataBase.__db__ = os.path.join(directory, "catalog.db")
+        DataBase.setup_database()
+        rows = fake_users(users, 2)
+        for user in rows:
+            DataBase.insert_user(user["userID"], user["name"], user["surname"], user["email_addresses"])
+        full = UserDirectory()
+        incremental = UserDirectory()
+        data = DataBase.get_users_since(0)
+        incremental.apply(data["users"], data["version"], full=True)
+        for user in rows[:changes]:
+            emails = {"WORK": f"new.{user['userID']}@bench.local"}
+            DataBase.insert_user(user["userID"], user["name"], user["surname"], emails)
+
+        # Same work of the catalog and of the service: query, JSON body, update of the directory
+        start = time.perf_counter()
+        body = json.dumps(DataBase.get_all_users())
+        full.apply(json.loads(body), full=True)
+        full_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        changed = json.dumps(DataBase.get_users_since(incremental.version))
+        data = json.loads(changed)
+        incremental.apply(data["users"], data["version"])
+        incremental_elapsed = time.perf_counter() - start
+
+    assert full.emails == incremental.emails and full.recipients == incremental.recipients
+    return {
+        "mode": "directory",
+        "users": users,
+        "changes": changes,
+        "full_bytes": len(body),
+        "full_ms": round(full_elapsed * 1e3, 3),
+        "incremental_bytes": len(changed),
+        "incremental_ms": round(incremental_elapsed * 1e3, 3),
+        "recipients": len(incremental.recipients),
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse the command line
+    :param argv: arguments, default sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Benchmark of the email service against a local SMTP sink")
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 10, 100], help="numbers of users to test")
+    parser.add_argument("--emails", type=int, default=2, help="email addresses of every user")
+    parser.add_argument("--alarms", type=int, default=20, help="alarms received for each size")
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds before every reply of the server")
+    parser.add_argument("--baseline", action="store_true", help="also measure a connection per recipient")
+    parser.add_argument("--restart", action="store_true", help="also check the delivery after a restart")
+    parser.add_argument("--storm", action="store_true", help="count the emails of a storm of alarms")
+    parser.add_argument("--devices", type=int, default=3, help="devices raising the alarms of the storm")
+    parser.add_argument("--directory", action="store_true", help="compare full and incremental user updates")
+    parser.add_argument("--changes", type=int, default=1, help="users changed between two user updates")
+    parser.add_argument("--output", help="file in which store the report, default stdout")
+    parser.add_argument("--history", help="JSON lines file to which append the report")
+    return parser.parse_args(argv)
+
+
+def main():
+    """
+    Run the benchmark and store the report
+    """
+    args = parse_args()
+    modes = [True, False] if args.baseline else [False]
+    report = {
+        "timestamp": time.time(),
+        "results": [
+            bench(users, args.emails, args.alarms, args.latency, baseline)
+            for users in args.users
+            for baseline in modes
+        ]
+    }
+    if args.storm:
+        report["results"] += [
+            bench_storm(users, args.devices, args.alarms, window, interval, 5)
+            for users in args.users
+            for window, interval in ((0.0, 0.0), (0.0, 60.0), (10.0, 60.0))
+        ]
+    if args.directory:
+        report["results"] += [bench_directory(users, args.changes) for users in args.users]
+    if args.restart:
+        report["results"].append(bench_restart(args.alarms, args.latency))
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.history:
+        with open(args.history, "a") as fp:
+            fp.write(json.dumps(report) + "\n")
+
+
+# -----------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    main()
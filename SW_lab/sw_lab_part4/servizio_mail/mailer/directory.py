@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Directory of the users of the email service
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+from typing import Dict, Iterable, Optional, Tuple
+
+# Internals
+from runtime.http import CatalogClient
+
+# ---------------------------------------------------------------
+
+
+class UserDirectory:
+    """
+    Copy of the users of the catalog, indexed by userID and kept updated incrementally:
+    the catalog numbers every change of the users with a revision, and sync only asks for
+    the users changed after the last revision seen. The user ids, the email addresses of
+    every user and the flat list of all the recipients are precomputed at every change and
+    replaced as a whole, so that the readers use them without any lock
+    """
+
+    def __init__(self):
+        """
+        Instantiate an empty directory
+        """
+        self.version = 0
+        self.user_ids: Tuple[str, ...] = ()
+        """Users with at least an email address"""
+        self.emails: Dict[str, Tuple[str, ...]] = {}
+        """Email addresses of every user"""
+        self.recipients: Tuple[str, ...] = ()
+        """All the email addresses, sorted and without duplicates"""
+        self.counters = {"syncs": 0, "full": 0, "changes": 0}
+
+    def apply(self, users: Iterable[dict], version: Optional[int] = None, full: bool = False) -> int:
+        """
+        Update the directory with users of the catalog, called by a single thread at a time
+
+        :param users: users of the catalog {"userID": .., "email_addresses": {..}, ..}
+        :param version: revision of the catalog the users are up to
+        :param full: the users are all the users of the catalog, the others are dropped
+        :return: number of users added, changed or dropped
+        """
+        emails = {} if full else dict(self.emails)
+        changes = 0
+        for user in users:
+            addresses = tuple(sorted(set(user["email_addresses"].values())))
+            if emails.get(user["userID"]) != addresses:
+                changes += 1
+            emails[user["userID"]] = addresses
+        if full:
+            changes += sum(user_id not in emails for user_id in self.emails)
+        if version is not None:
+            self.version = version
+        if not changes:
+            return 0
+
+        # Publish the new tables, the readers see either the old or the new ones
+        self.emails = emails
+        self.user_ids = tuple(user_id for user_id, addresses in emails.items() if addresses)
+        self.recipients = tuple(sorted({email for addresses in emails.values() for email in addresses}))
+        self.counters["changes"] += changes
+        return changes
+
+    def sync(self, catalog: CatalogClient) -> int:
+        """
+        Ask the catalog for the users changed after the last revision seen. A catalog
+        that doesn't number the changes is asked for all the users
+
+        :param catalog: client of the catalog
+        :return: number of users added, changed or dropped
+        :raise CatalogUnavailable: the catalog didn't answer or the circuit is open
+        """
+        self.counters["syncs"] += 1
+        data = catalog.get(f"users/changes?since={self.version}")
+        if isinstance(data, dict) and "version" in data:
+            if data["version"] < self.version:
+                # The catalog lost its database, start again from its users
+                self.counters["full"] += 1
+                return self.apply(catalog.get("users/all") or [], data["version"], full=True)
+            return self.apply(data["users"], data["version"])
+        self.counters["full"] += 1
+        return self.apply(catalog.get("users/all") or [], full=True)
+
+    def __len__(self) -> int:
+        """
+        Number of users
+        """
+        return len(self.emails)
+
+    def report(self) -> str:
+        """
+        Metrics of the directory in a line of log
+        """
+        return (
+            f"{len(self.emails)} users and {len(self.recipients)} recipients at revision {self.version}, "
+            f"{self.counters['syncs']} syncs ({self.counters['full']} full), {self.counters['changes']} changes"
+        )
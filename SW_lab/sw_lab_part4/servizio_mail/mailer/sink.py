@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Local SMTP sink
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import asyncio
+from contextlib import contextmanager
+import re
+import threading
+from typing import Iterator, List, Optional, Set, Tuple
+
+# ---------------------------------------------------------------
+
+Mail = Tuple[str, List[str], bytes]
+"""Sender, recipients and content of a mail received"""
+
+# ---------------------------------------------------------------
+
+
+def _address(command: str) -> str:
+    """
+    Address of a MAIL FROM or RCPT TO command
+
+    :param command: command received
+    """
+    match = re.search(r"<([^>]*)>", command)
+    return match.group(1) if match else command.partition(":")[2].split(" ")[0]
+
+
+class SMTPSink:
+    """
+    Minimal SMTP server that runs inside the process, in a background thread, and
+    accepts every mail without delivering it. Every reply can be delayed to simulate
+    the round trip to a remote server, and the connections can be closed after a number
+    of mails to exercise the reconnection of the clients. No TLS nor authentication:
+    it's meant for local tests and benchmarks, not for production
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 1025, latency: float = 0.0,
+                 max_mails: int = 0, keep: bool = False):
+        """
+        Instantiate the sink
+
+        :param host: address to bind
+        :param port: port to bind, 0 to choose a free one
+        :param latency: seconds before every reply
+        :param max_mails: mails accepted on a connection before closing it, 0 no limit
+        :param keep: keep the mails received in mails
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.max_mails = max_mails
+        self.keep = keep
+        self.mails: List[Mail] = []
+        self.counters = {"connections": 0, "mails": 0, "recipients": 0, "closed": 0}
+        self._writers: Set[asyncio.StreamWriter] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+
+    # -------------------------------------------------------------------------
+
+    def start(self) -> "SMTPSink":
+        """
+        Start the sink in a background thread, return when it's listening
+
+        :return: the sink itself
+        """
+        self._thread = threading.Thread(target=self._run, name="SMTPSink", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        """
+        Stop the sink and close all the connections
+        """
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+    def _run(self):
+        """
+        Event loop of the sink
+        """
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle, self.host, self.port)
+        )
+        # Port chosen by the OS
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            for writer in list(self._writers):
+                writer.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+    # -------------------------------------------------------------------------
+
+    async def _reply(self, writer: asyncio.StreamWriter, replies: List[str]):
+        """
+        Send the replies to the commands received together, after the latency
+
+        :param writer: stream of the client
+        :param replies: replies, the lines of a reply separated by \\n
+        """
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        writer.write("".join(reply.replace("\n", "\r\n") + "\r\n" for reply in replies).encode())
+        await writer.drain()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Serve a client until it quits. The commands are read as they arrive, so the ones
+        pipelined by the client are answered together, after a single latency
+
+        :param reader: stream of the commands received
+        :param writer: stream of the replies
+        """
+        self._writers.add(writer)
+        self.counters["connections"] += 1
+        sender, recipients, mails = "", [], 0
+        buffer, in_data, closing = b"", False, False
+        try:
+            await self._reply(writer, ["220 sink ESMTP"])
+            while not closing:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                buffer += chunk
+                replies = []
+                while not closing:
+                    if in_data:
+                        # The content ends with a line made of a dot
+                        data = b"\r\n" + buffer
+                        end = data.find(b"\r\n.\r\n")
+                        if end < 0:
+                            break
+                        content, buffer = data[2:end], data[end + 5:]
+                        in_data = False
+                        self.counters["mails"] += 1
+                        self.counters["recipients"] += len(recipients)
+                        if self.keep:
+                            self.mails.append((sender, recipients, re.sub(rb"(?m)^\.\.", b".", content)))
+                        mails += 1
+                        replies.append("250 OK")
+                        if self.max_mails and mails >= self.max_mails:
+                            # Close as a server shutting down would, without waiting for QUIT
+                            self.counters["closed"] += 1
+                            closing = True
+                        continue
+
+                    end = buffer.find(b"\r\n")
+                    if end < 0:
+                        break
+                    command, buffer = buffer[:end].decode(errors="replace").strip(), buffer[end + 2:]
+                    verb = command[:4].upper()
+                    if verb in ("EHLO", "HELO"):
+                        replies.append("250-sink\n250-PIPELINING\n250 SIZE 10485760")
+                    elif verb == "MAIL":
+                        sender, recipients = _address(command), []
+                        replies.append("250 OK")
+                    elif verb == "RCPT":
+                        recipients.append(_address(command))
+                        replies.append("250 OK")
+                    elif verb == "DATA":
+                        in_data = True
+                        replies.append("354 End data with <CR><LF>.<CR><LF>")
+                    elif verb in ("RSET", "NOOP"):
+                        replies.append("250 OK")
+                    elif verb == "QUIT":
+                        replies.append("221 Bye")
+                        closing = True
+                    else:
+                        replies.append("502 Command not implemented")
+                if replies:
+                    await self._reply(writer, replies)
+        except ConnectionError:
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+
+@contextmanager
+def running_sink(host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 max_mails: int = 0, keep: bool = False) -> Iterator[SMTPSink]:
+    """
+    Run a sink for the duration of a with block, useful as test fixture
+
+    :param host: address to bind
+    :param port: port to bind, 0 to choose a free one
+    :param latency: seconds before every reply
+    :param max_mails: mails accepted on a connection before closing it, 0 no limit
+    :param keep: keep the mails received in sink.mails
+    :return: the running sink, sink.port contains the port in use
+    """
+    sink = SMTPSink(host, port, latency, max_mails, keep).start()
+    try:
+        yield sink
+    finally:
+        sink.stop()
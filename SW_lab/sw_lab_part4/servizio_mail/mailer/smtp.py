@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+Pool of SMTP connections
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import re
+import smtplib
+from threading import Condition
+import time
+from typing import Dict, List, Sequence, Tuple, Union
+
+# ---------------------------------------------------------------
+
+POOL_SIZE = 2
+"""Connections kept open to the SMTP server"""
+
+IDLE_TIMEOUT = 60.0
+"""Seconds after which an idle connection is replaced instead of reused, servers drop them"""
+
+TIMEOUT = 10.0
+"""Seconds to wait for the SMTP server"""
+
+MAX_RECIPIENTS = 100
+"""Recipients of a single mail, more are sent as several mails on the same connection"""
+
+SECURITY = ("starttls", "ssl", "none")
+"""Security of the connection: STARTTLS upgrade, TLS from the start or plain text"""
+
+
+class MailUnavailable(Exception):
+    """The SMTP server couldn't be reached, or dropped the connection at every attempt"""
+
+
+def encode_mail(message: Union[str, bytes]) -> bytes:
+    """
+    Encode a mail for the DATA command: CRLF line endings, leading dots doubled
+    and the final dot line
+
+    :param message: mail, headers included
+    """
+    if isinstance(message, str):
+        message = re.sub(r"(?:\r\n|\n|\r(?!\n))", "\r\n", message).encode("ascii")
+    message = re.sub(rb"(?m)^\.", b"..", message)
+    if not message.endswith(b"\r\n"):
+        message += b"\r\n"
+    return message + b".\r\n"
+
+
+def sendmail_pipelined(connection: smtplib.SMTP, sender: str, recipients: List[str],
+                       message: Union[str, bytes]) -> Dict[str, tuple]:
+    """
+    Send a mail with PIPELINING (RFC 2920): MAIL, all the RCPT and DATA are written at once
+    and their replies read afterwards, so a mail costs two round trips whatever the recipients.
+    Same results and errors of smtplib.SMTP.sendmail
+
+    :param connection: connection to a server offering PIPELINING
+    :param sender: address of the sender
+    :param recipients: addresses of the recipients
+    :param message: mail, headers included
+    :return: recipients refused by the server, {address: (code, reply)}
+    """
+    commands = [f"MAIL FROM:{smtplib.quoteaddr(sender)}"]
+    commands.extend(f"RCPT TO:{smtplib.quoteaddr(recipient)}" for recipient in recipients)
+    commands.append("DATA")
+    connection.send("".join(f"{command}\r\n" for command in commands))
+    replies = [connection.getreply() for _ in commands]
+
+    mail, data = replies[0], replies[-1]
+    refused = {
+        recipient: reply for recipient, reply in zip(recipients, replies[1:-1]) if reply[0] not in (250, 251)
+    }
+    if data[0] != 354:
+        connection.rset()
+        if mail[0] != 250:
+            raise smtplib.SMTPSenderRefused(mail[0], mail[1], sender)
+        if len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        raise smtplib.SMTPDataError(*data)
+
+    connection.send(encode_mail(message))
+    code, reply = connection.getreply()
+    if code != 250:
+        connection.rset()
+        raise smtplib.SMTPDataError(code, reply)
+    return refused
+
+
+class SMTPPool:
+    """
+    Pool of long-lived SMTP connections. A connection is opened, secured and authenticated
+    once and then reused for the next mails; idle connections are replaced after
+    idle_timeout seconds, and a connection dropped by the server is replaced and the mail
+    sent again up to retries times. A mail is sent once with all its recipients in the
+    envelope, pipelining the commands if the server offers PIPELINING.
+    It's thread safe: every connection is used by one thread at a time
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        security: str = "starttls",
+        user: str = "",
+        password: str = "",
+        size: int = POOL_SIZE,
+        idle_timeout: float = IDLE_TIMEOUT,
+        timeout: float = TIMEOUT,
+        retries: int = 1,
+        max_recipients: int = MAX_RECIPIENTS
+    ):
+        """
+        Instantiate the pool, the connections are opened when needed
+
+        :param host: SMTP server
+        :param port: port of the server
+        :param security: "starttls", "ssl" or "none", without security the pool doesn't log in
+        :param user: user to log in with, if not empty
+        :param password: password of the user
+        :param size: maximum number of connections
+        :param idle_timeout: seconds after which an idle connection is replaced
+        :param timeout: seconds to wait for the server
+        :param retries: attempts after a connection dropped
+        :param max_recipients: recipients of a single mail
+        """
+        if security not in SECURITY:
+            raise ValueError(f"security must be one of {SECURITY}, not {security}")
+        self.host = host
+        self.port = port
+        self.security = security
+        self.user = user
+        self.password = password
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.max_recipients = max_recipients
+        self.counters = {"mails": 0, "recipients": 0, "connections": 0, "reused": 0, "dropped": 0, "failures": 0}
+        self._condition = Condition()
+        # Connections not in use, with the time of their last use
+        self._idle: List[Tuple[smtplib.SMTP, float]] = []
+        self._open = 0
+
+    # Connections
+
+    def _connect(self) -> smtplib.SMTP:
+        """
+        Open, secure and authenticate a connection
+        """
+        if self.security == "ssl":
+            connection = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            connection.ehlo()
+            if self.security == "starttls":
+                connection.starttls()
+                connection.ehlo()
+            if self.security != "none" and self.user:
+                connection.login(self.user, self.password)
+        except Exception:
+            connection.close()
+            raise
+        with self._condition:
+            self.counters["connections"] += 1
+        return connection
+
+    def _acquire(self) -> smtplib.SMTP:
+        """
+        Take a connection: an idle one if still fresh, otherwise a new one.
+        Waits if all the connections are in use
+        """
+        stale = []
+        with self._condition:
+            while not self._idle and self._open >= self.size:
+                self._condition.wait()
+            connection = None
+            while self._idle:
+                candidate, last_use = self._idle.pop()
+                if time.monotonic() - last_use < self.idle_timeout:
+                    connection = candidate
+                    self.counters["reused"] += 1
+                    break
+                stale.append(candidate)
+                self._open -= 1
+            if connection is None:
+                # Reserve the place of the connection opened below
+                self._open += 1
+        for candidate in stale:
+            self._quit(candidate)
+        if connection is not None:
+            return connection
+        try:
+            return self._connect()
+        except Exception:
+            self._discard()
+            raise
+
+    def _release(self, connection: smtplib.SMTP):
+        """
+        Give back a connection that can be reused
+
+        :param connection: connection taken with _acquire
+        """
+        with self._condition:
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    def _discard(self, connection: smtplib.SMTP = None):
+        """
+        Forget a connection that can't be reused
+
+        :param connection: connection taken with _acquire, None if it couldn't be opened
+        """
+        if connection is not None:
+            connection.close()
+        with self._condition:
+            self._open -= 1
+            self._condition.notify()
+
+    @staticmethod
+    def _quit(connection: smtplib.SMTP):
+        """
+        Close a connection politely, ignoring the errors
+
+        :param connection: connection to close
+        """
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.close()
+
+    # Mails
+
+    def send(self, sender: str, recipients: Sequence[str], message: Union[str, bytes]) -> Dict[str, tuple]:
+        """
+        Send a mail to all the recipients, as few mails of max_recipients recipients
+
+        :param sender: address of the sender
+        :param recipients: addresses of the recipients
+        :param message: mail, headers included
+        :return: recipients refused by the server, {address: (code, reply)}
+        :raise MailUnavailable: the server couldn't be reached
+        :raise smtplib.SMTPException: the server refused the mail or the credentials, not worth retrying
+        """
+        refused = {}
+        for start in range(0, len(recipients), self.max_recipients):
+            refused.update(self._send(sender, list(recipients[start:start + self.max_recipients]), message))
+        return refused
+
+    def _send(self, sender: str, recipients: List[str], message: Union[str, bytes]) -> Dict[str, tuple]:
+        """
+        Send a mail on a pooled connection, replacing the connection if the server dropped it
+
+        :param sender: address of the sender
+        :param recipients: addresses of the recipients
+        :param message: mail, headers included
+        :return: recipients refused by the server
+        :raise MailUnavailable: the server couldn't be reached
+        :raise smtplib.SMTPAuthenticationError: the server refused the credentials
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                connection = self._acquire()
+            except smtplib.SMTPAuthenticationError:
+                # Wrong credentials, retrying would only get the account locked
+                with self._condition:
+                    self.counters["failures"] += 1
+                raise
+            except (smtplib.SMTPException, OSError) as error:
+                last_error = error
+                break
+            try:
+                if connection.has_extn("pipelining"):
+                    refused = sendmail_pipelined(connection, sender, recipients, message)
+                else:
+                    refused = connection.sendmail(sender, recipients, message)
+            except smtplib.SMTPRecipientsRefused as error:
+                # All the recipients refused, the connection is still good
+                self._release(connection)
+                refused = error.recipients
+            except (smtplib.SMTPServerDisconnected, OSError) as error:
+                self._discard(connection)
+                last_error = error
+                with self._condition:
+                    self.counters["dropped"] += 1
+                continue
+            except smtplib.SMTPResponseException as error:
+                if error.smtp_code != 421:
+                    self._release(connection)
+                    raise
+                # Service not available, the server is closing the connection
+                self._discard(connection)
+                last_error = error
+                with self._condition:
+                    self.counters["dropped"] += 1
+                continue
+            except BaseException:
+                # SMTP errors, but also e.g. UnicodeEncodeError for a non-ASCII address:
+                # the state of the connection is unknown, its place in the pool is given back
+                self._discard(connection)
+                raise
+            else:
+                self._release(connection)
+            with self._condition:
+                self.counters["mails"] += 1
+                self.counters["recipients"] += len(recipients) - len(refused)
+            return refused
+
+        with self._condition:
+            self.counters["failures"] += 1
+        raise MailUnavailable(f"{self.host}:{self.port} {last_error}")
+
+    def report(self) -> str:
+        """
+        Metrics of the pool in a line of log
+        """
+        with self._condition:
+            counters = dict(self.counters)
+        return (
+            f"{counters['mails']} mails to {counters['recipients']} recipients on {counters['connections']} "
+            f"connections ({counters['reused']} reused, {counters['dropped']} dropped), "
+            f"{counters['failures']} failures"
+        )
+
+    def close(self):
+        """
+        Close the idle connections
+        """
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for connection, _ in idle:
+            self._quit(connection)
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+HTTP client of the catalog
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+from random import uniform
+from threading import Lock
+import time
+from typing import Any, Dict, Optional
+
+# Third Party
+import requests
+from requests.adapters import HTTPAdapter
+
+# Internals
+from configuration.loader import settings
+
+# ---------------------------------------------------------------
+
+BACKOFF_INITIAL = 1.0
+"""Seconds to wait after the first failure"""
+
+BACKOFF_MAXIMUM = 30.0
+"""Maximum seconds to wait between two attempts"""
+
+POOL_SIZE = 4
+"""Connections to the catalog kept alive by the session"""
+
+
+class CatalogUnavailable(Exception):
+    """The catalog didn't answer, or the circuit breaker is open"""
+
+
+class Backoff:
+    """
+    Exponential backoff: every failure doubles the delay, up to a maximum,
+    and a success brings it back to the initial value. With jitter the delay
+    is randomly shortened by up to that fraction, so that clients failing
+    together don't retry together
+    """
+
+    def __init__(
+        self,
+        initial: float = BACKOFF_INITIAL,
+        maximum: float = BACKOFF_MAXIMUM,
+        factor: float = 2.0,
+        jitter: float = 0.0
+    ):
+        """
+        Instantiate the backoff
+
+        :param initial: Seconds to wait after the first failure
+        :param maximum: Maximum seconds to wait
+        :param factor: Growth of the delay after every failure
+        :param jitter: Fraction of the delay that is randomised, between 0 and 1
+        """
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.delay = initial
+
+    def next(self) -> float:
+        """
+        Delay to wait before the next attempt
+
+        :return: seconds
+        """
+        delay = self.delay * uniform(1 - self.jitter, 1)
+        self.delay = min(self.delay * self.factor, self.maximum)
+        return delay
+
+    def reset(self):
+        """
+        Go back to the initial delay
+        """
+        self.delay = self.initial
+
+
+class CircuitBreaker:
+    """
+    Stop calling a remote service after a number of consecutive failures (open circuit),
+    so that callers fail immediately instead of waiting for the timeouts. After reset_timeout
+    seconds one call is let through (half open): a success closes the circuit, a failure
+    opens it again
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failures: int, reset_timeout: float):
+        """
+        Instantiate the circuit breaker
+
+        :param failures: consecutive failures that open the circuit
+        :param reset_timeout: seconds before trying again
+        """
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failed = 0
+        self._opened = 0.0
+        self._lock = Lock()
+
+    def allow(self) -> bool:
+        """
+        Check if a call can be made
+
+        :return: False if the circuit is open
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        """
+        Record a successful call
+        """
+        with self._lock:
+            self.state = self.CLOSED
+            self._failed = 0
+
+    def failure(self):
+        """
+        Record a failed call
+        """
+        with self._lock:
+            self._failed += 1
+            if self.state == self.HALF_OPEN or self._failed >= self.failures:
+                if self.state != self.OPEN:
+                    print(f"[{time.ctime()}] WARNING catalog circuit open for {self.reset_timeout:g} seconds")
+                self.state = self.OPEN
+                self._opened = time.monotonic()
+
+
+class CatalogClient:
+    """
+    Client of the catalog REST API. All the requests share one requests.Session,
+    so the TCP connections to the catalog are kept alive and reused instead of
+    being opened for every request. Every request has a connect and a read timeout,
+    failures are retried with a jittered exponential backoff and a circuit breaker
+    stops calling a catalog that keeps failing. The policy is the "http" section
+    of the configuration
+    """
+
+    def __init__(self, catalog: dict, policy: Optional[dict] = None):
+        """
+        Instantiate the client
+
+        :param catalog: address of the catalog {"ip": .., "port": ..}, read at every request
+        :param policy: timeouts, retries and circuit breaker, default the "http" section of the settings
+        """
+        self.catalog = catalog
+        self.policy = dict(settings["http"] if policy is None else policy)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.timeout = (self.policy["connect_timeout"], self.policy["read_timeout"])
+        self.breaker = CircuitBreaker(self.policy["failures"], self.policy["reset_timeout"])
+        self.metrics = {"retries": 0, "failures": 0, "rejected": 0}
+        self._lock = Lock()
+
+    def url(self, path: str) -> str:
+        """
+        URL of a resource of the catalog
+
+        :param path: path after /catalog/
+        """
+        return f"http://{self.catalog['ip']}:{self.catalog['port']}/catalog/{path}"
+
+    def _count(self, metric: str):
+        """
+        Increment a metric
+
+        :param metric: name of the metric
+        """
+        with self._lock:
+            self.metrics[metric] += 1
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        Send a request to the catalog, retrying connection errors, timeouts and 5xx answers
+
+        :param method: HTTP method
+        :param path: path after /catalog/
+        :param kwargs: arguments of requests.Session.request
+        :return: the response, whatever its status code below 500
+        :raise CatalogUnavailable: the catalog didn't answer or the circuit is open
+        """
+        if not self.breaker.allow():
+            self._count("rejected")
+            raise CatalogUnavailable("circuit open")
+
+        backoff = Backoff(self.policy["backoff"], jitter=0.5)
+        error = None
+        for attempt in range(int(self.policy["retries"]) + 1):
+            if attempt:
+                self._count("retries")
+                time.sleep(backoff.next())
+            try:
+                result = self.session.request(method, self.url(path), timeout=self.timeout, **kwargs)
+            except requests.RequestException as exception:
+                error = type(exception).__name__
+                continue
+            if result.status_code < 500:
+                self.breaker.success()
+                return result
+            error = f"HTTP {result.status_code}"
+
+        self._count("failures")
+        self.breaker.failure()
+        raise CatalogUnavailable(error)
+
+    def get(self, path: str) -> Optional[Any]:
+        """
+        GET a resource of the catalog
+
+        :param path: path after /catalog/
+        :return: the decoded JSON, None if the resource is not found
+        :raise CatalogUnavailable: the catalog didn't answer or the circuit is open
+        """
+        result = self.request("GET", path)
+        if result.status_code != 200:
+            return None
+        try:
+            return result.json()
+        except ValueError:
+            return None
+
+    def post(self, path: str, body: dict) -> bool:
+        """
+        POST a JSON body to the catalog
+
+        :param path: path after /catalog/
+        :param body: body of the request
+        :return: True if the catalog accepted the request
+        :raise CatalogUnavailable: the catalog didn't answer or the circuit is open
+        """
+        return self.request("POST", path, json=body).status_code == 200
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Metrics of the client: requests sent on the session, TCP connections opened and requests
+        that reused a connection already open, retries, failed requests,
+        requests rejected by the circuit breaker and state of the circuit
+        """
+        pools = self.session.get_adapter(self.url("")).poolmanager.pools
+        pools = [pools[key] for key in pools.keys()]
+        with self._lock:
+            metrics = dict(self.metrics)
+        metrics["requests"] = sum(pool.num_requests for pool in pools)
+        metrics["connections"] = sum(pool.num_connections for pool in pools)
+        metrics["reused"] = max(metrics["requests"] - metrics["connections"], 0)
+        metrics["circuit"] = self.breaker.state
+        return metrics
+
+    def report(self) -> str:
+        """
+        Metrics of the client in a line of log
+        """
+        stats = self.stats()
+        return (
+            f"{stats['requests']} requests on {stats['connections']} connections "
+            f"({stats['reused']} reused), {stats['retries']} retries, {stats['failures']} failures, "
+            f"{stats['rejected']} rejected, circuit {stats['circuit']}"
+        )
+
+    def close(self):
+        """
+        Close the pooled connections
+        """
+        self.session.close()
+
+
+_shared: Optional[CatalogClient] = None
+_shared_lock = Lock()
+
+
+def catalog_client(catalog: dict) -> CatalogClient:
+    """
+    Client of the catalog shared by the whole process, so that services, devices
+    and broker discovery use the same pool of connections
+
+    :param catalog: address of the catalog {"ip": .., "port": ..}
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = CatalogClient(catalog)
+        return _shared
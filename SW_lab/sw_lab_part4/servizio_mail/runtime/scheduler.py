@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Timer scheduler
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import heapq
+from itertools import count
+from queue import SimpleQueue
+from random import uniform
+from threading import Condition, Lock, Thread, current_thread
+import time
+from typing import Callable, List, Optional, Tuple
+
+# ---------------------------------------------------------------
+
+
+class Task:
+    """Callable scheduled by the Scheduler, once or periodically"""
+
+    __slots__ = ("when", "due", "function", "args", "interval", "jitter", "blocking", "cancelled")
+
+    def __init__(
+        self,
+        when: float,
+        function: Callable,
+        args: tuple,
+        interval: float = 0.0,
+        jitter: float = 0.0,
+        blocking: bool = False
+    ):
+        """
+        Instantiate the task
+
+        :param when: time.monotonic() at which the task runs
+        :param function: callable to run
+        :param args: arguments of the callable
+        :param interval: seconds between two runs, 0 to run once
+        :param jitter: fraction of the interval by which every run is randomly delayed
+        :param blocking: the task waits on the network, e.g. the catalog, and runs on the blocking worker
+        """
+        self.when = self.due = when
+        self.function = function
+        self.args = args
+        self.interval = interval
+        self.jitter = jitter
+        self.blocking = blocking
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Cancel the task: it won't run again, even if it is running now
+        """
+        self.cancelled = True
+
+
+class Scheduler:
+    """
+    Run the tasks of a process on a single thread, instead of one threading.Timer
+    (and so one thread) for every scheduled call. The tasks are kept in a heap
+    ordered by the time at which they run. Periodic tasks are scheduled from the
+    time at which they were due, not from the end of the previous run, so they don't
+    drift; the jitter only delays a single run and the runs missed are skipped.
+    The thread of the scheduler is kept for short ticks: the blocking tasks, like the requests
+    to the catalog that can wait for its timeouts and retries, are handed to a second worker
+    thread, so they never delay the ticks. A periodic blocking task is scheduled again only
+    once its run is over, so its runs never overlap
+    """
+
+    def __init__(self, name: str = "Scheduler"):
+        """
+        Instantiate the scheduler
+
+        :param name: name of the thread
+        """
+        self.name = name
+        self._heap: List[Tuple[float, int, Task]] = []
+        self._order = count()
+        self._condition = Condition()
+        self._thread: Optional[Thread] = None
+        self._worker: Optional[Thread] = None
+        self._blocking: SimpleQueue = SimpleQueue()
+        self._stopped = False
+
+    def start(self):
+        """
+        Start the thread of the scheduler
+        """
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+            # Every worker has its own queue, a worker still blocked after a stop just exits
+            self._blocking = SimpleQueue()
+            self._worker = Thread(
+                target=self._work, args=(self._blocking,), name=f"{self.name}Blocking", daemon=True
+            )
+            self._worker.start()
+
+    def call_later(self, delay: float, function: Callable, *args, blocking: bool = False) -> Task:
+        """
+        Run a callable after a delay
+
+        :param delay: seconds to wait
+        :param function: callable to run
+        :param args: arguments of the callable
+        :param blocking: the callable waits on the network, run it on the blocking worker
+        :return: the task, that can be cancelled
+        """
+        task = Task(time.monotonic() + delay, function, args, blocking=blocking)
+        with self._condition:
+            heapq.heappush(self._heap, (task.when, next(self._order), task))
+            self._condition.notify()
+        return task
+
+    def call_every(self, interval: float, function: Callable, *args, delay: Optional[float] = None,
+                   jitter: float = 0.0, blocking: bool = False) -> Task:
+        """
+        Run a callable every interval seconds
+
+        :param interval: seconds between two runs
+        :param function: callable to run
+        :param args: arguments of the callable
+        :param delay: seconds before the first run, default interval
+        :param jitter: fraction of the interval by which every run is randomly delayed,
+            to spread the runs of many tasks with the same interval
+        :param blocking: the callable waits on the network, run it on the blocking worker
+        :return: the task, that can be cancelled
+        """
+        task = Task(
+            time.monotonic() + (interval if delay is None else delay), function, args, interval, jitter, blocking
+        )
+        task.when += self._jitter(task)
+        with self._condition:
+            heapq.heappush(self._heap, (task.when, next(self._order), task))
+            self._condition.notify()
+        return task
+
+    def reschedule(self, task: Task, delay: float):
+        """
+        Run again a task after a delay, unless it has been cancelled in the meantime.
+        A task rescheduling itself can't race with its cancellation
+
+        :param task: task to run again
+        :param delay: seconds to wait
+        """
+        with self._condition:
+            if task.cancelled or self._stopped:
+                return
+            task.when = task.due = time.monotonic() + delay
+            heapq.heappush(self._heap, (task.when, next(self._order), task))
+            self._condition.notify()
+
+    def stop(self):
+        """
+        Stop the scheduler, discarding the tasks not yet run, and wait for the running one.
+        A blocking task still waiting on the network isn't waited for, it can't reschedule itself
+        """
+        with self._condition:
+            self._stopped = True
+            self._heap.clear()
+            self._condition.notify()
+            thread, self._thread = self._thread, None
+            if self._worker is not None:
+                self._blocking.put(None)
+                self._worker = None
+        if thread is not None and thread is not current_thread():
+            thread.join()
+
+    def _run(self):
+        """
+        Wait for the first task of the heap and run it
+        """
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    if self._heap:
+                        wait = self._heap[0][0] - time.monotonic()
+                        if wait <= 0:
+                            break
+                        self._condition.wait(wait)
+                    else:
+                        self._condition.wait()
+                if self._stopped:
+                    return
+                when, _, task = heapq.heappop(self._heap)
+            if task.cancelled or when != task.when:
+                # Cancelled or rescheduled
+                continue
+            if task.blocking:
+                self._blocking.put(task)
+            else:
+                self._execute(task)
+
+    def _work(self, tasks: SimpleQueue):
+        """
+        Run the blocking tasks, until the scheduler is stopped
+
+        :param tasks: queue of the blocking tasks due, None to stop
+        """
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            if not task.cancelled:
+                self._execute(task)
+
+    def _execute(self, task: Task):
+        """
+        Run a task and schedule its next run if periodic
+
+        :param task: task due
+        """
+        try:
+            task.function(*task.args)
+        except Exception as error:
+            print(f"[{time.ctime()}] WARNING scheduled task {task.function.__name__} failed: {error!r}")
+        if task.interval:
+            self._repeat(task)
+
+    def _repeat(self, task: Task):
+        """
+        Schedule the next run of a periodic task
+
+        :param task: periodic task just run
+        """
+        now = time.monotonic()
+        task.due += task.interval
+        if task.due <= now:
+            # Skip the runs missed
+            task.due += (int((now - task.due) / task.interval) + 1) * task.interval
+        with self._condition:
+            if task.cancelled or self._stopped:
+                return
+            task.when = task.due + self._jitter(task)
+            heapq.heappush(self._heap, (task.when, next(self._order), task))
+            # Run by the blocking worker, the scheduler may be waiting for an earlier task
+            self._condition.notify()
+
+    @staticmethod
+    def _jitter(task: Task) -> float:
+        """
+        Random delay of a run of a task
+
+        :param task: periodic task
+        :return: seconds
+        """
+        return uniform(0, task.jitter * task.interval) if task.jitter else 0.0
+
+
+_shared: Optional[Scheduler] = None
+_shared_lock = Lock()
+
+
+def shared_scheduler() -> Scheduler:
+    """
+    Scheduler shared by the whole process, already started, so that all the
+    periodic jobs of the devices simulated in a process run on a single thread
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = Scheduler("SharedScheduler")
+            _shared.start()
+        return _shared
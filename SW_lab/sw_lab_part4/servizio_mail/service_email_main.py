@@ -16,21 +16,27 @@ Exercise1 sw_lab4
     limitations under the License.
 """
 # Standard Library
-from collections import defaultdict
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from functools import partial
 import json
-from random import randrange
-import smtplib
-import sys
 import time
-from typing import Any, Dict, List, DefaultDict
-from threading import Timer, Lock
+from smtplib import SMTPException
+from typing import Any, Optional
 
 # Third Party
 from paho.mqtt.client import Client, MQTTMessage
-import requests
+
+# Internals
+from configuration.loader import discover_broker, load_settings, register_defaults
+from mailer.directory import UserDirectory
+from mailer.smtp import MailUnavailable, SMTPPool
+from notify.digest import Devices, Digest
+from notify.dispatcher import Dispatcher
+from notify.spool import Spool
+from profiler.sampler import profile_from_env
+from runtime.http import CatalogUnavailable, catalog_client
+from runtime.scheduler import Task
+from runtime.service import CatalogService
 
 # -----------------------------------------------------------------------------
 
@@ -43,21 +49,49 @@ SERVICE_UNIQUE_ID = "AlarmTemperature"
 CATALOG_IP_PORT = {"ip": "0.0.0.0", "port": 8080}
 
 SERVICE_BROKER_PORT = {"ip": "test.mosquitto.org", "port": 1883}
-SERVICE_INFO = json.dumps(
-    {
-        "serviceID": "EmailService/LabSw4",
-        "description": "Check every user signed in the catalog and every service that generates an alarm in case of "
-                       "temperature out of range. In case of alarm, send via email the device that generated the alarm"
-                       "to each user."
-                       "Publish every userID that was contacted via email",
-        "end_points": {
-            "MQTT": {
-                "broker": SERVICE_BROKER_PORT,
-                "subscribe": ["labsw4/arduino/contacted/user"]
-            }
+SERVICE_INFO = {
+    "serviceID": "EmailService/LabSw4",
+    "description": "Check every user signed in the catalog and every service that generates an alarm in case of "
+                   "temperature out of range. In case of alarm, send via email the device that generated the alarm"
+                   "to each user."
+                   "Publish every userID that was contacted via email",
+    "end_points": {
+        "MQTT": {
+            "broker": SERVICE_BROKER_PORT,
+            "subscribe": ["labsw4/arduino/contacted/user"]
         }
     }
-)
+}
+
+# SMTP server and account (Gmail) of the service, connections kept open by the pool
+EMAIL_POLICY = {
+    "host": "smtp.gmail.com",
+    "port": 587,
+    "security": "starttls",
+    "user": "******",
+    "password": "******",
+    "sender": "",
+    "pool": 2,
+    "idle_timeout": 60.0,
+    "timeout": 10.0,
+    "max_recipients": 100,
+    "directory": 10.0
+}
+
+# Background delivery of the notifications, the MQTT callbacks only queue them
+NOTIFY_POLICY = {
+    "spool": "notifications.spool",
+    "capacity": 1000,
+    "workers": 4,
+    "concurrency": 2,
+    "retries": 5,
+    "backoff": 1.0,
+    "max_backoff": 60.0,
+    "sync": 0
+}
+
+# Alarms grouped in one email for every user, and emails a user can receive
+DIGEST_POLICY = {"window": 10.0, "interval": 60.0, "burst": 5}
 
 
 # -----------------------------------------------------------------------------
@@ -79,20 +113,27 @@ def find_service(data: dict) -> bool:
     return False
 
 
-class Service:
+def digest_body(devices: Devices) -> str:
+    """
+    Text of the email of a digest
+    :param devices: devices out of range with their alarms
+    """
+    return "\n".join(
+        f"{device} is out of range of good functioning" + (f" ({alarms} alarms)" if alarms > 1 else "")
+        for device, alarms in devices
+    )
+
+
+class Service(CatalogService):
     """Service that sends emails"""
 
-    _mqtt_client: Dict[str, Client] = {}
-    _service_list: Dict[str, dict] = {}
-    _broker: DefaultDict[str, set] = defaultdict(set)
-    _broker_port: Dict[str, int] = {}
-    _topic: DefaultDict[str, set] = defaultdict(set)
-    _update_thread: Timer = None
+    resource = "services"
+    key = "serviceID"
+    kind = "SERVICE"
+    label = "ServiceTemperatureAlarm"
+    client_prefix = "EMailService"
     alarm_user_topic = "labsw4/arduino/contacted/user"
-    _user_list: Dict[str, dict] = {}
     # Email
-    from_email = "******" #E-mail (Gmail) associated to the service
-    password = "******"   #Password of this e-mail
     subject = "Temperature alarm"
     signature = "\n\nBest regards,\n\nSmart Home - IoT distributed platform developers"  # signature block
 
@@ -100,397 +141,174 @@ class Service:
         """
         Instantiate the service
         """
-        self.service = Client(client_id=f"EMailService{randrange(1, 100000)}")
-        self.service.on_message = partial(self.my_on_message, email_service=self.service)
-        self.user_lock = Lock()
-        self.service_lock = Lock()
+        super().__init__(CATALOG_IP_PORT, SERVICE_BROKER_PORT, SERVICE_INFO)
+        self.directory = UserDirectory()
+        self._directory_task: Optional[Task] = None
+        self.from_email = EMAIL_POLICY["sender"] or EMAIL_POLICY["user"]
+        self.mailer = SMTPPool(
+            EMAIL_POLICY["host"],
+            EMAIL_POLICY["port"],
+            security=EMAIL_POLICY["security"],
+            user=EMAIL_POLICY["user"],
+            password=EMAIL_POLICY["password"],
+            size=EMAIL_POLICY["pool"],
+            idle_timeout=EMAIL_POLICY["idle_timeout"],
+            timeout=EMAIL_POLICY["timeout"],
+            max_recipients=EMAIL_POLICY["max_recipients"]
+        )
+        spool = None
+        if NOTIFY_POLICY["spool"]:
+            spool = Spool(NOTIFY_POLICY["spool"], sync=bool(NOTIFY_POLICY["sync"]))
+        self.notifier = Dispatcher(
+            self.scheduler,
+            spool,
+            capacity=NOTIFY_POLICY["capacity"],
+            workers=NOTIFY_POLICY["workers"],
+            retries=NOTIFY_POLICY["retries"],
+            backoff=NOTIFY_POLICY["backoff"],
+            max_backoff=NOTIFY_POLICY["max_backoff"]
+        )
+        # Only an unreachable server is worth a retry, the other errors would fail again
+        self.notifier.register(
+            "email", self.send_email, NOTIFY_POLICY["concurrency"], permanent=(SMTPException, UnicodeError)
+        )
+        self.digest = Digest(DIGEST_POLICY["interval"], DIGEST_POLICY["burst"])
+        self._digest_task: Optional[Task] = None
 
-    def _update(self, service_list: List[dict]):
+    def find(self, entry: dict) -> bool:
         """
-        Update reserved dicts
-        :param service_list: service list to add
+        Follow the alarm services
+        :param entry: service of the catalog
         """
-        for alarm in service_list:
-            service = alarm["serviceID"]
-            broker = alarm["end_points"]["MQTT"]["broker"]["ip"]
-            port = alarm["end_points"]["MQTT"]["broker"]["port"]
-            topics = {
-                topic
-                for topic in alarm["end_points"]["MQTT"]["subscribe"]
-                if "alarm_temperature" in topic
-            }
-
-            self._service_list[service] = {
-                "ip": broker,
-                "topics": topics,
-            }
-
-            self._broker_port[broker] = port
-
-            self._broker[broker].update({service})
-            self._topic[broker].update(topics)
+        return find_service(entry)
 
-            print(f"[{time.ctime()}] SERVICE {service} ONLINE")
+    def describe(self, entry: dict) -> dict:
+        """
+        Broker and alarm topics of an alarm service
+        :param entry: service of the catalog
+        """
+        mqtt = entry["end_points"]["MQTT"]
+        return {
+            "ip": mqtt["broker"]["ip"],
+            "port": mqtt["broker"]["port"],
+            "topics": {topic for topic in mqtt["subscribe"] if "alarm_temperature" in topic}
+        }
 
-    def setup(self, first_time: bool = True):
+    def update_users(self):
         """
-        Setup the service
+        Update the users to contact with the changes of the catalog
         """
+        known = self.directory.emails
         try:
-            print(f"[{time.ctime()}] EXTRACT info about all the services registered")
-            result: requests.Response = requests.get(
-                url=f"http://{CATALOG_IP_PORT['ip']}:{CATALOG_IP_PORT['port']}/catalog/services/all"
-            )
-            while result.status_code != 200:
-                print(
-                    f"[{time.ctime()}] WARNING no service registered found, retrying after 30 seconds"
-                )
-                time.sleep(30)
-                result: requests.Response = requests.get(
-                    url=f"http://{CATALOG_IP_PORT['ip']}:{CATALOG_IP_PORT['port']}"
-                    f"/catalog/services/all"
-                )
-            print(f"[{time.ctime()}] SERVICES found")
-            data = json.loads(result.content.decode())
-
-            print(
-                f"[{time.ctime()}] EXTRACT from the services list info about Alarm_Temperature"
-            )
-            service_list = [alarm for alarm in data if find_service(alarm)]
-            if len(service_list) == 0:
-                print(f"[{time.ctime()}] No ServiceTemperatureAlarm found... retrying in 10 seconds")
-                time.sleep(10)
-                self.setup(first_time)
-                return
-
-            print(f"[{time.ctime()}] EXTRACT info about all the users registered")
-            result: requests.Response = requests.get(
-                url=f"http://{CATALOG_IP_PORT['ip']}:{CATALOG_IP_PORT['port']}/catalog/users/all"
-            )
-            user_list = {}
-            if result.status_code == 200:
-                data = json.loads(result.content.decode())
-                user_list = {
-                    user["userID"]: {
-
-                        user["email_addresses"][email]
-                        for email in user["email_addresses"]
-                    }
-                    for user in data
-                }
-
-        except KeyboardInterrupt:
-            print(f"[{time.ctime()}] EXIT")
-            if first_time:
-                sys.exit()
+            changes = self.directory.sync(self.catalog)
+        except CatalogUnavailable as error:
+            print(f"[{time.ctime()}] WARNING users not updated, catalog unreachable ({error})")
             return
+        if changes:
+            print(f"[{time.ctime()}] USERS {changes} added, changed or removed")
+            self.digest.forget(user_id for user_id in known if user_id not in self.directory.emails)
 
-        if first_time:
-            # Connect the service
-            self.service.connect(
-                host=SERVICE_BROKER_PORT["ip"], port=SERVICE_BROKER_PORT["port"]
-            )
-            print(
-                f"[{time.ctime()}] SERVICE CONNECTED to "
-                f"broker: {SERVICE_BROKER_PORT['ip']} "
-                f"on port: port={SERVICE_BROKER_PORT['port']}"
+    def registered(self):
+        """
+        Log the users, the emails and the deliveries
+        """
+        if EMAIL_POLICY["directory"] <= 0:
+            self.update_users()
+        print(f"[{time.ctime()}] USERS {self.directory.report()}")
+        print(f"[{time.ctime()}] MAIL {self.mailer.report()}")
+        print(f"[{time.ctime()}] DIGEST {self.digest.report()}")
+        print(f"[{time.ctime()}] NOTIFY {self.notifier.report()}")
+
+    def started(self):
+        """
+        Deliver the notifications, starting from the ones left by the previous run,
+        follow the changes of the users and send the digests at the end of every window
+        """
+        self.notifier.start()
+        if EMAIL_POLICY["directory"] > 0:
+            self._directory_task = self.scheduler.call_every(
+                EMAIL_POLICY["directory"], self.update_users, delay=0, blocking=True
             )
+        if DIGEST_POLICY["window"] > 0:
+            self._digest_task = self.scheduler.call_every(DIGEST_POLICY["window"], self.send_digests)
 
-        # Update registered services and users and subscribe to all the topics
-        with self.service_lock:
-            self._update(service_list)
-            self.subscribe(service_list)
-
-        with self.user_lock:
-            self._user_list.update(user_list)
-
-        # Register inside the catalog
-        print(f"[{time.ctime()}] PING the Catalog on : {CATALOG_IP_PORT['ip']}")
-        requests.post(
-            f'http://{CATALOG_IP_PORT["ip"]}:{CATALOG_IP_PORT["port"]}/catalog/services',
-            data=SERVICE_INFO,
-            headers={"Content-Type": "application/json"}
-        )
-
-    def start(self):
+    def stopping(self):
         """
-        Start the service.
+        Queue the digests of the last window, stop the deliveries and close the SMTP connections
         """
-        # Setup the service
-        self.setup()
-
-        # Start all the external mqtt_clients
-        for broker in self._mqtt_client:
-            self._mqtt_client[broker].loop_start()
-
-        # Schedule the update of the registration
-        self._update_thread = Timer(60, self.update_registration)
-        self._update_thread.start()
-
-        try:
-            # Run the service forever
-            self.service.loop_forever()
-        except KeyboardInterrupt:
-            self.stop()
-
-    def my_on_message(self, client: Client, userdata: Any, msg: MQTTMessage, email_service: Client = None):
+        for task in (self._directory_task, self._digest_task):
+            if task is not None:
+                task.cancel()
+        self.send_digests()
+        self.notifier.stop()
+        self.mailer.close()
+
+    def my_on_message(self, client: Client, userdata: Any, msg: MQTTMessage):
         """
-        Check if alarm is true. If so, send emails.
+        Check if alarm is true. If so, add it to the digest of the users registered now,
+        that is emailed in background at the end of the window.
         :param client: MQTT client
         :param userdata: They could be any type
         :param msg: MQTT message
-        :param email_service: Service Client
         """
         data = json.loads(msg.payload.decode())
-        if data["alarm"]:
-            message_body = f"{data['device']} is out of range of good functioning"
-        else:
+        if not data["alarm"]:
             return
-        with self.user_lock:
-            for user_id in self._user_list:
-                for email in self._user_list[user_id]:
-                    msg = MIMEMultipart()
-                    msg["From"] = f"Smart Home - IoT distributed platform <{self.from_email}>"
-                    msg["To"] = email
-                    msg["Subject"] = self.subject
-                    msg.attach(MIMEText(message_body + self.signature, 'plain'))
-
-                    server = smtplib.SMTP("smtp.gmail.com", 587)
-                    server.starttls()
-                    server.login(self.from_email, self.password)
-                    text = msg.as_string()
-                    server.sendmail(self.from_email, email, text)
-                    server.quit()
-                    print(f"[{time.ctime()}] EMAIL SENT TO {email}")
-
-            email_service.publish(
-                self.alarm_user_topic,
-                payload=json.dumps(
-                    {
-                        "userID": [
-                            user_id
-                            for user_id in self._user_list
-                        ]
-                    }
-                )
-            )
-            print(f"[{time.ctime()}] EMAILS SENT TO USERS: {[user_id for user_id in self._user_list]}")
+        self.digest.add(data["device"], self.directory.user_ids)
+        if DIGEST_POLICY["window"] <= 0:
+            self.send_digests()
 
-    def update_registration(self):
+    def send_digests(self):
         """
-        Update service registration to the catalog
+        Queue an email for every group of users with the same digest
         """
-        print(f"[{time.ctime()}] EXTRACT info about all the users registered")
-        result: requests.Response = requests.get(
-            url=f"http://{CATALOG_IP_PORT['ip']}:{CATALOG_IP_PORT['port']}/catalog/users/all"
-        )
-        user_list = {}
-        if result.status_code == 200:
-            data = json.loads(result.content.decode())
-            user_list = {
-                user["userID"]: {
-
-                    user["email_addresses"][email]
-                    for email in user["email_addresses"]
-                }
-                for user in data
-            }
-        with self.user_lock:
-            self._user_list.update(user_list)
-
-        print(f"[{time.ctime()}] EXTRACT info about all the services registered")
-        result: requests.Response = requests.get(
-            url=f"http://{CATALOG_IP_PORT['ip']}:{CATALOG_IP_PORT['port']}/catalog/services/all"
-        )
-
-        # No device found
-        if result.status_code != 200:
-            self.reset()
-            return
-
-        data = json.loads(result.content.decode())
-        service_list = [alarm for alarm in data if find_service(alarm)]
-        if len(service_list) == 0:
-            self.reset()
-            return
-
-        # New Devices Found
-        new_services = {alarm["serviceID"] for alarm in service_list}
-        # Old devices list
-        old_services = set(self._service_list.keys())
-
-        # Check if there are update to do
-        if old_services == new_services:
-            # No update, ping the catalog
-            print(f"[{time.ctime()}] PING the Catalog on : {CATALOG_IP_PORT['ip']}")
-            requests.post(
-                f'http://{CATALOG_IP_PORT["ip"]}:{CATALOG_IP_PORT["port"]}/catalog/services',
-                data=SERVICE_INFO,
-                headers={"Content-Type": "application/json"}
-            )
-            self._update_thread = Timer(60, self.update_registration)
-            self._update_thread.start()
-            return
+        emails = self.directory.emails
+        for devices, user_ids in self.digest.flush():
+            users = {user_id: list(emails[user_id]) for user_id in user_ids if user_id in emails}
+            if users and not self.notifier.submit("email", {"body": digest_body(devices), "users": users}):
+                print(f"[{time.ctime()}] WARNING email not queued, too many notifications pending")
 
-        with self.service_lock:
-            # Delete inactive devices
-            delete_list = {
-                alarm: self._service_list[alarm]
-                for alarm in self._service_list
-                if alarm not in new_services
-            }
-            # Unsubscribe from devices
-            self.unsubscribe(delete_list)
-
-            # Update registered devices and subscribe
-            new_services = [
-                alarm
-                for alarm in service_list
-                if alarm["serviceID"] not in old_services
-            ]
-
-            self._update(new_services)
-            self.subscribe(new_services)
-
-        self._update_thread = Timer(60, self.update_registration)
-        self._update_thread.start()
-
-    def reset(self):
-        """
-        Reset the service
-        """
-        with self.service_lock:
-            self._clear()
-        self.setup(first_time=False)
-        # Start all the external mqtt_clients
-        for broker in self._mqtt_client:
-            self._mqtt_client[broker].loop_start()
-        self._update_thread = Timer(60, self.update_registration)
-        self._update_thread.start()
-
-    def unsubscribe(self, service_list: dict):
-        """
-        Unsubscribe from services
-        :param service_list: service list
-        """
-        for alarm in service_list:
-            print(f"[{time.ctime()}] SERVICE {alarm} OFFLINE")
-            broker = service_list[alarm]["ip"]
-            topics = service_list[alarm]["topics"]
-
-            if broker == SERVICE_BROKER_PORT["ip"]:
-                for topic in topics:
-                    self.service.unsubscribe(topic)
-                    print(f"[{time.ctime()}] UNSUBSCRIBED from : {topic}")
-
-            else:
-                for topic in topics:
-                    self._mqtt_client[broker].unsubscribe(topic)
-                    print(f"[{time.ctime()}] UNSUBSCRIBED from : {topic}")
-
-            # Update topics
-            self._topic[broker] = self._topic[broker].difference(topics)
-
-            # Disconnect from external broker
-            if len(self._topic[broker]) == 0:
-                if broker != SERVICE_BROKER_PORT["ip"]:
-                    self._mqtt_client[broker].disconnect()
-                    self._mqtt_client[broker].loop_stop()
-                    print(f"[{time.ctime()}] DISCONNECTED from broker: {broker}")
-                    del self._mqtt_client[broker]
-
-                # Clean
-                del self._topic[broker]
-                del self._broker_port[broker]
-
-            # Delete device
-            del self._service_list[alarm]
-            self._broker[broker].discard(alarm)
-
-    def subscribe(self, service_list: List[dict]):
-        """
-        Subscribe to services
-        :param service_list: list of services
-        """
-        for alarm in service_list:
-            broker = alarm["end_points"]["MQTT"]["broker"]["ip"]
-            topics = {
-                topic
-                for topic in alarm["end_points"]["MQTT"]["subscribe"]
-            }
-            # Subscribe to topics
-            if broker == SERVICE_BROKER_PORT["ip"]:
-                for topic in topics:
-                    self.service.subscribe(topic)
-                    print(f"[{time.ctime()}] SUBSCRIBED to : {topic}")
-
-            # Connect to external brokers
-            else:
-                if broker in self._mqtt_client:
-                    # Connection already made
-                    for topic in topics:
-                        self._mqtt_client[broker].subscribe(topic)
-                        print(f"[{time.ctime()}] SUBSCRIBED to : {topic}")
-                else:
-                    # Connect to the broker
-                    self._mqtt_client[broker] = Client(
-                        f"EmailAlarmService{randrange(1, 1000000)}"
-                    )
-                    self._mqtt_client[broker].on_message = partial(
-                        self.my_on_message, email_service=self.service
-                    )
-                    self._mqtt_client[broker].connect(
-                        host=broker, port=self._broker_port[broker]
-                    )
-
-                    for topic in topics:
-                        self._mqtt_client[broker].subscribe(topic)
-                        print(f"[{time.ctime()}] SUBSCRIBED to : {topic}")
-
-    def _clear(self):
+    def send_email(self, notification: dict):
         """
-        Clear all the data stored
+        Send the email of an alarm and publish the users contacted
+        :param notification: body of the email and emails of the users {"body": .., "users": {userID: [..]}}
+        :raise MailUnavailable: the SMTP server couldn't be reached, the email is sent again later
         """
-        # Unsubscribe from all topics
-        self.unsubscribe(self._service_list.copy())
-
-        # Disconnect from all the external brokers
-        for broker in self._mqtt_client:
-            self._mqtt_client[broker].disconnect()
-            self._mqtt_client[broker].loop_stop()
-            print(f"[{time.ctime()}] DISCONNECTED from broker: {broker}")
-
-        # Clear
-        self._mqtt_client.clear()
-        self._service_list.clear()
-        self._broker.clear()
-        self._broker_port.clear()
-        self._topic.clear()
-
-    def stop(self):
-        """
-        Stop the service
-        """
-        # Stop the schedule
-        self._update_thread.cancel()
-
-        # Wait for the threads to finish
-        if self._update_thread.is_alive():
-            self._update_thread.join()
-
-        # Disconnect the clients
-        print(f"[{time.ctime()}] SHUTTING DOWN")
-        for client in self._mqtt_client:
-            self._mqtt_client[client].disconnect()
-            self._mqtt_client[client].loop_stop()
-        # Disconnect the service
-        self.service.disconnect()
-        print(f"[{time.ctime()}] EXIT")
-
+        user_list = {user_id: set(emails) for user_id, emails in notification["users"].items()}
+        recipients = sorted({email for emails in user_list.values() for email in emails})
+
+        # A single mail for all the users, the recipients are only in the envelope
+        msg = MIMEMultipart()
+        msg["From"] = f"Smart Home - IoT distributed platform <{self.from_email}>"
+        msg["To"] = "undisclosed-recipients:;"
+        msg["Subject"] = self.subject
+        msg.attach(MIMEText(notification["body"] + self.signature, 'plain'))
+        try:
+            refused = self.mailer.send(self.from_email, recipients, msg.as_string())
+        except MailUnavailable as error:
+            print(f"[{time.ctime()}] WARNING emails not sent, SMTP server unreachable ({error})")
+            raise
+        for email in refused:
+            print(f"[{time.ctime()}] WARNING EMAIL REFUSED FOR {email}")
+        print(f"[{time.ctime()}] EMAIL SENT TO {len(recipients) - len(refused)} recipients")
+
+        contacted = [user_id for user_id, emails in user_list.items() if emails - set(refused)]
+        self.service.publish(self.alarm_user_topic, payload=json.dumps({"userID": contacted}))
+        print(f"[{time.ctime()}] EMAILS SENT TO USERS: {contacted}")
 
 # -----------------------------------------------------------------------------------------------------------
 
 
 if __name__ == "__main__":
+    register_defaults("email", EMAIL_POLICY)
+    register_defaults("notify", NOTIFY_POLICY)
+    register_defaults("digest", DIGEST_POLICY)
+    settings = load_settings()
+    CATALOG_IP_PORT.update(settings["catalog"])
+    EMAIL_POLICY.update(settings["email"])
+    NOTIFY_POLICY.update(settings["notify"])
+    DIGEST_POLICY.update(settings["digest"])
+    SERVICE_BROKER_PORT.update(discover_broker(CATALOG_IP_PORT, session=catalog_client(CATALOG_IP_PORT).session))
+    profile_from_env()
     service = Service()
     service.start()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Test the dispatcher of the notifications
+
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+
+    Copyright 2020 Angelo Cutaia
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import os
+import tempfile
+from threading import Event, Lock
+import time
+import unittest
+
+# Internals
+from notify.dispatcher import Dispatcher
+from notify.spool import Spool
+from runtime.scheduler import Scheduler
+
+# -------------------------------------------------------------------------
+
+
+class Recorder:
+    """
+    Handler of a channel that records the deliveries, failing the first attempts if asked
+    """
+
+    def __init__(self, expected: int, failures: int = 0, error: Exception = OSError("unreachable")):
+        """
+        :param expected: deliveries after which delivered is set
+        :param failures: attempts that raise error before the first delivery
+        :param error: error raised by the failed attempts
+        """
+        self.expected = expected
+        self.failures = failures
+        self.error = error
+        self.deliveries = []
+        self.delivered = Event()
+        self._lock = Lock()
+
+    def __call__(self, payload: dict):
+        with self._lock:
+            if self.failures:
+                self.failures -= 1
+                raise self.error
+            self.deliveries.append((payload["n"], time.monotonic()))
+            if len(self.deliveries) >= self.expected:
+                self.delivered.set()
+
+    @property
+    def order(self) -> list:
+        return [name for name, _ in self.deliveries]
+
+
+class TestDispatcher(unittest.TestCase):
+    """
+    Test the queue by key with its rate limits, the retries and the spool of the dispatcher
+    """
+
+    def setUp(self):
+        """
+        Scheduler of the retries and spool in a temporary folder
+        """
+        self.scheduler = Scheduler("TestDispatcher")
+        self.scheduler.start()
+        self.addCleanup(self.scheduler.stop)
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.path = os.path.join(folder.name, "notifications.spool")
+        self.spool = Spool(self.path)
+
+    def dispatcher(self, **kwargs) -> Dispatcher:
+        """
+        Dispatcher on the spool, stopped at the end of the test
+
+        :param kwargs: arguments of the dispatcher
+        """
+        dispatcher = Dispatcher(self.scheduler, self.spool, **kwargs)
+        self.addCleanup(dispatcher.stop, 1.0)
+        return dispatcher
+
+    def test_unknown_channel(self):
+        """
+        Test that a notification of a channel not registered is neither counted nor stored
+        """
+        dispatcher = self.dispatcher()
+        with self.assertRaises(KeyError):
+            dispatcher.submit("sms", {"n": "a"})
+        self.assertEqual(len(dispatcher), 0)
+        self.assertEqual(dispatcher.counters["submitted"], 0)
+        self.assertEqual(len(self.spool), 0)
+
+    def test_capacity(self):
+        """
+        Test that the notifications beyond the capacity are rejected
+        """
+        dispatcher = self.dispatcher(capacity=2)
+        dispatcher.register("chat", Recorder(2))
+        self.assertTrue(dispatcher.submit("chat", {"n": "a"}))
+        self.assertTrue(dispatcher.submit("chat", {"n": "b"}))
+        self.assertFalse(dispatcher.submit("chat", {"n": "c"}))
+        self.assertEqual(dispatcher.counters["rejected"], 1)
+        self.assertEqual(len(self.spool), 2)
+
+    def test_key_rate(self):
+        """
+        Test that a key at its rate limit waits without holding back the other keys
+        """
+        handler = Recorder(3)
+        dispatcher = self.dispatcher()
+        dispatcher.register("chat", handler, key="chat", key_rate=5)
+        for name, chat in (("a1", 1), ("a2", 1), ("b1", 2)):
+            dispatcher.submit("chat", {"n": name, "chat": chat})
+        dispatcher.start()
+        self.assertTrue(handler.delivered.wait(2))
+        self.assertEqual(handler.order, ["a1", "b1", "a2"])
+        times = dict(handler.deliveries)
+        self.assertGreater(times["a2"] - times["a1"], 0.15)
+        self.assertLess(times["b1"] - times["a1"], 0.15)
+
+    def test_channel_rate(self):
+        """
+        Test that the deliveries of a channel are spaced by its rate, whatever their key
+        """
+        handler = Recorder(3)
+        dispatcher = self.dispatcher()
+        dispatcher.register("chat", handler, concurrency=3, rate=20, key="chat")
+        for chat in range(3):
+            dispatcher.submit("chat", {"n": chat, "chat": chat})
+        dispatcher.start()
+        self.assertTrue(handler.delivered.wait(2))
+        self.assertGreater(handler.deliveries[-1][1] - handler.deliveries[0][1], 0.08)
+
+    def test_retry(self):
+        """
+        Test that a failed delivery is retried and then completed in the spool
+        """
+        handler = Recorder(1, failures=2)
+        dispatcher = self.dispatcher(backoff=0.01)
+        dispatcher.register("email", handler)
+        dispatcher.start()
+        dispatcher.submit("email", {"n": "a"})
+        self.assertTrue(handler.delivered.wait(2))
+        time.sleep(0.05)
+        self.assertEqual((dispatcher.counters["retried"], dispatcher.counters["sent"]), (2, 1))
+        self.assertEqual(len(dispatcher), 0)
+        self.assertEqual(len(self.spool), 0)
+
+    def test_permanent(self):
+        """
+        Test that a permanent error and the last failed retry drop the notification
+        """
+        permanent = Recorder(1, failures=1, error=ValueError("bad address"))
+        transient = Recorder(1, failures=3)
+        dispatcher = self.dispatcher(retries=1, backoff=0.01)
+        dispatcher.register("email", permanent, permanent=(ValueError,))
+        dispatcher.register("chat", transient)
+        dispatcher.start()
+        dispatcher.submit("email", {"n": "a"})
+        dispatcher.submit("chat", {"n": "b"})
+        deadline = time.monotonic() + 2
+        while len(dispatcher) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(dispatcher), 0)
+        self.assertEqual((dispatcher.counters["failed"], dispatcher.counters["retried"]), (2, 1))
+        self.assertEqual(permanent.deliveries + transient.deliveries, [])
+
+    def test_restore(self):
+        """
+        Test that the notifications left in the spool are delivered at the restart,
+        and the ones of a channel not registered anymore are forgotten
+        """
+        self.spool.add({"id": "1", "channel": "email", "payload": {"n": "a"}, "attempts": 0})
+        self.spool.add({"id": "2", "channel": "sms", "payload": {"n": "b"}, "attempts": 0})
+        self.spool.close()
+        self.spool = Spool(self.path)
+
+        handler = Recorder(1)
+        dispatcher = self.dispatcher()
+        dispatcher.register("email", handler)
+        dispatcher.start()
+        self.assertTrue(handler.delivered.wait(2))
+        time.sleep(0.05)
+        self.assertEqual(handler.order, ["a"])
+        self.assertEqual(dispatcher.counters["restored"], 1)
+        self.assertEqual(len(self.spool), 0)
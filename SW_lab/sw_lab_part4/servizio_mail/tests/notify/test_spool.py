@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Test the spool of the notifications
+
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+
+    Copyright 2020 Angelo Cutaia
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import os
+import tempfile
+import unittest
+
+# Internals
+from notify.spool import Spool
+
+# -------------------------------------------------------------------------
+
+
+def notification(notification_id: str) -> dict:
+    """
+    Notification stored in the spool
+
+    :param notification_id: id of the notification
+    """
+    return {"id": notification_id, "channel": "email", "payload": {}, "attempts": 0}
+
+
+class TestSpool(unittest.TestCase):
+    """
+    Test the replay of the journal at the restart and its compaction
+    """
+
+    def setUp(self):
+        """
+        Journal in a temporary folder
+        """
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.path = os.path.join(folder.name, "notifications.spool")
+
+    def reopen(self, spool: Spool) -> Spool:
+        """
+        Close a spool and open its journal again, as at a restart
+
+        :param spool: spool to close
+        """
+        spool.close()
+        spool = Spool(self.path)
+        self.addCleanup(spool.close)
+        return spool
+
+    def lines(self) -> int:
+        """
+        Lines of the journal
+        """
+        with open(self.path) as fp:
+            return len(fp.readlines())
+
+    def test_replay(self):
+        """
+        Test that only the notifications not completed are pending at the restart, in order
+        """
+        spool = Spool(self.path)
+        for notification_id in "abc":
+            spool.add(notification(notification_id))
+        spool.done("b")
+        spool = self.reopen(spool)
+        self.assertEqual([pending["id"] for pending in spool.pending()], ["a", "c"])
+
+        # The notifications of this run are not recovered
+        spool.add(notification("d"))
+        spool.done("a")
+        self.assertEqual([pending["id"] for pending in spool.recovered()], ["c"])
+
+    def test_closed(self):
+        """
+        Test that a notification completed after the close is still pending at the restart
+        """
+        spool = Spool(self.path)
+        spool.add(notification("a"))
+        spool.close()
+        spool.done("a")
+        spool = self.reopen(spool)
+        self.assertEqual(len(spool), 1)
+
+    def test_truncated_line(self):
+        """
+        Test that a line truncated by a crash is ignored, and the next notifications are kept
+        """
+        spool = Spool(self.path)
+        spool.add(notification("a"))
+        spool.close()
+        with open(self.path, "a") as fp:
+            fp.write('{"id": "b", "chan')
+        spool = self.reopen(spool)
+        spool.add(notification("c"))
+        spool = self.reopen(spool)
+        self.assertEqual([pending["id"] for pending in spool.pending()], ["a", "c"])
+
+    def test_compaction(self):
+        """
+        Test that the journal is rewritten with only the pending notifications
+        """
+        spool = Spool(self.path, compact_after=2)
+        for notification_id in "abc":
+            spool.add(notification(notification_id))
+        spool.done("a")
+        self.assertEqual(self.lines(), 4)
+        spool.done("b")
+        self.assertEqual(self.lines(), 1)
+        spool.add(notification("d"))
+        spool = self.reopen(spool)
+        self.assertEqual([pending["id"] for pending in spool.pending()], ["c", "d"])
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Alarm service benchmark
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import argparse
+from contextlib import redirect_stdout
+import json
+import os
+from random import Random
+import time
+from typing import List, Optional
+
+# Third Party
+from paho.mqtt.client import MQTTMessage
+
+# Internals
+from service_alarm_main import ALARM_POLICY, SERVICE_BROKER_PORT, Service
+
+# -----------------------------------------------------------------------------
+
+#############
+# CONSTANTS #
+#############
+
+DEVICE_PREFIX = "BenchYUN"
+
+# -----------------------------------------------------------------------------
+
+###########
+# HELPERS #
+###########
+
+
+def fake_arduino(index: int) -> dict:
+    """
+    Build the catalog record of an arduino offering temperature and led via MQTT
+    :param index: index of the device
+    """
+    device = f"{DEVICE_PREFIX}{index}"
+    return {
+        "deviceID": device,
+        "available_resources": {"MQTT": ["Temp", "Led"]},
+        "end_points": {
+            "MQTT": {
+                "ip": SERVICE_BROKER_PORT["ip"],
+                "port": SERVICE_BROKER_PORT["port"],
+                "end_points": {
+                    "subscribe": [f"bench/{device}/temp"],
+                    "publish": [f"bench/{device}/led"]
+                }
+            }
+        }
+    }
+
+
+class FakeClient:
+    """
+    Stand-in for the paho client that only counts the publishes
+    """
+
+    def __init__(self):
+        """
+        Instantiate the client
+        """
+        self.published = 0
+
+    def publish(self, topic: str, payload: str = None):
+        """
+        Count the publish
+        :param topic: topic
+        :param payload: payload
+        """
+        self.published += 1
+
+    def unsubscribe(self, topic: str):
+        """
+        Nothing to unsubscribe from
+        :param topic: topic
+        """
+
+
+def message(topic: str, value: float) -> MQTTMessage:
+    """
+    Build a SenML temperature message
+    :param topic: topic of the message
+    :param value: temperature
+    """
+    msg = MQTTMessage(topic=topic.encode())
+    msg.payload = json.dumps({"n": "temperature", "v": value, "u": "Cel"}).encode()
+    return msg
+
+
+def linear_lookup(device_list: dict, topic: str):
+    """
+    Device lookup as done before the routing table, kept as a baseline
+    :param device_list: devices known by the service
+    :param topic: topic of the telemetry
+    """
+    for device in device_list:
+        if topic in device_list[device]["topics"]:
+            return device, device_list[device]["led_topics"]
+
+# -----------------------------------------------------------------------------
+
+#############
+# BENCHMARK #
+#############
+
+
+def bench(devices: int, messages: int, seed: int) -> dict:
+    """
+    Measure the per-message cost of the alarm callback with a given number of devices
+    :param devices: registered devices
+    :param messages: messages to dispatch
+    :param seed: seed of the random generator
+    """
+    rng = Random(seed)
+    service = Service()
+    client = FakeClient()
+    # Alarms and led commands are published with the service client
+    service.service = client
+    service.connections.service = client
+    arduinos = [fake_arduino(index) for index in range(devices)]
+    topics = [arduino["end_points"]["MQTT"]["end_points"]["subscribe"][0] for arduino in arduinos]
+    batch = [message(rng.choice(topics), rng.uniform(-10, 40)) for _ in range(messages)]
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        with service.device_lock:
+            service._update(arduinos)
+
+        start = time.perf_counter()
+        for msg in batch:
+            service.my_on_message(client, None, msg)
+        routed = time.perf_counter() - start
+
+        # In batch mode the callback only collects the readings
+        start = time.perf_counter()
+        if service.engine is not None:
+            for transition in service.engine.flush():
+                service._publish_transition(transition)
+        flushed = time.perf_counter() - start
+
+        lookups = min(messages, 2000)
+        start = time.perf_counter()
+        for msg in batch[:lookups]:
+            linear_lookup(service._device_list, msg.topic)
+        linear = time.perf_counter() - start
+
+        with service.device_lock:
+            service._clear()
+
+    return {
+        "devices": devices,
+        "messages": messages,
+        "callback_us": round(routed / messages * 1e6, 3),
+        "flush_ms": round(flushed * 1e3, 3),
+        "readings_per_s": round(messages / (routed + flushed)),
+        "linear_lookup_us": round(linear / lookups * 1e6, 3),
+        "published": client.published,
+        **(service.counters if service.engine is None else service.engine.counters)
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse the command line
+    :param argv: arguments, default sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Benchmark of the alarm service callback")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000],
+                        help="numbers of registered devices to test")
+    parser.add_argument("--messages", type=int, default=20000, help="messages dispatched for each size")
+    parser.add_argument("--batch", action="store_true", help="evaluate the readings with the rule engine")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random generator")
+    parser.add_argument("--output", help="file in which store the report, default stdout")
+    parser.add_argument("--history", help="JSON lines file to which append the report")
+    return parser.parse_args(argv)
+
+
+def main():
+    """
+    Run the benchmark and store the report
+    """
+    args = parse_args()
+    if args.batch:
+        ALARM_POLICY["batch"] = 1.0
+    report = {
+        "timestamp": time.time(),
+        "results": [bench(size, args.messages, args.seed) for size in args.sizes]
+    }
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.history:
+        with open(args.history, "a") as fp:
+            fp.write(json.dumps(report) + "\n")
+
+
+# -----------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    main()
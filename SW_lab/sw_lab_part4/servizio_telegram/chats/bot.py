@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Stand-in of the Telegram bot
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+from collections import deque
+from itertools import count
+from random import uniform
+from threading import Lock
+import time
+from typing import Deque, Dict
+
+# ---------------------------------------------------------------
+
+GLOBAL_RATE = 30.0
+"""Messages per second a bot can send to all the chats"""
+
+CHAT_RATE = 1.0
+"""Messages per second a bot can send to a private chat"""
+
+GROUP_RATE = 20 / 60
+"""Messages per second a bot can send to a group"""
+
+TOLERANCE = 0.9
+"""Fraction of the interval between two messages below which a message counts as a violation"""
+
+
+class StandInBot:
+    """
+    Offline stand-in of telegram.Bot for the tests and the benchmarks: sendMessage waits the
+    latency of the Telegram API and records the message, without any network. The rate limits
+    of Telegram are checked on the arrival of every message, counting the messages that exceed
+    the global rate or that come too close to the previous one of the same chat (groups have
+    negative ids and a lower rate)
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.1,
+        jitter: float = 0.5,
+        global_rate: float = GLOBAL_RATE,
+        chat_rate: float = CHAT_RATE,
+        group_rate: float = GROUP_RATE
+    ):
+        """
+        Instantiate the bot
+
+        :param latency: mean seconds of a call to the API
+        :param jitter: fraction of the latency that is randomised
+        :param global_rate: messages per second to all the chats
+        :param chat_rate: messages per second to a private chat
+        :param group_rate: messages per second to a group
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.counters = {"messages": 0, "global_violations": 0, "chat_violations": 0}
+        self.messages: Dict[int, int] = {}
+        """Messages received by every chat"""
+        self._lock = Lock()
+        self._last: Dict[int, float] = {}
+        self._second: Deque[float] = deque()
+        self._ids = count(1)
+
+    def sendMessage(self, chat_id: int, text: str, **kwargs) -> dict:
+        """
+        Send a message, as telegram.Bot.sendMessage
+
+        :param chat_id: id of the chat
+        :param text: text of the message
+        :param kwargs: other options of the API, ignored
+        :return: the message sent
+        """
+        now = time.monotonic()
+        with self._lock:
+            # Messages of the last second
+            self._second.append(now)
+            while self._second[0] <= now - 1:
+                self._second.popleft()
+            if len(self._second) > self.global_rate:
+                self.counters["global_violations"] += 1
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            last = self._last.get(chat_id)
+            if last is not None and now - last < TOLERANCE / rate:
+                self.counters["chat_violations"] += 1
+            self._last[chat_id] = now
+            self.messages[chat_id] = self.messages.get(chat_id, 0) + 1
+            self.counters["messages"] += 1
+            message_id = next(self._ids)
+        time.sleep(self.latency * uniform(1 - self.jitter, 1 + self.jitter))
+        return {"message_id": message_id, "chat": {"id": chat_id}, "text": text}
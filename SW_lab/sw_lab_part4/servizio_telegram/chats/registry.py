@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Registry of the Telegram chats
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import json
+import os
+from threading import Lock
+from typing import Dict, FrozenSet, Iterable, Optional, Set, Tuple
+
+# ---------------------------------------------------------------
+
+COMPACT_AFTER = 1000
+"""Obsolete lines in the journal after which it's rewritten with only the current chats"""
+
+
+def chat_id_of(value) -> int:
+    """
+    Id of a chat received from outside, e.g. "12345" from an MQTT message
+
+    :param value: id of the chat
+    :raise ValueError: the value is not an integer
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"chat id must be an integer, not {value!r}")
+    return int(value)
+
+
+class ChatRegistry:
+    """
+    Chats that receive the alarms, with the devices each of them is subscribed to (None for
+    all the devices). Every change is appended as a JSON line to a journal, read at once at
+    startup, so that the chats survive a restart; once enough lines are obsolete the journal
+    is rewritten with only the current chats. The chats of every device are computed once
+    and kept until the next change
+    """
+
+    def __init__(self, path: str = "", compact_after: int = COMPACT_AFTER):
+        """
+        Open the registry, loading the chats of the journal
+
+        :param path: file of the journal, empty to keep the chats only in memory
+        :param compact_after: obsolete lines after which the journal is rewritten
+        """
+        self.path = path
+        self.compact_after = compact_after
+        self._lock = Lock()
+        self._chats: Dict[int, Optional[FrozenSet[str]]] = {}
+        self._recipients: Dict[str, Tuple[int, ...]] = {}
+        self._lines = 0
+        self._file = None
+        if path:
+            truncated = self._load()
+            self._file = open(path, "a")
+            if truncated:
+                # The next change starts on its own line instead of completing the truncated one
+                self._file.write("\n")
+
+    def _load(self) -> bool:
+        """
+        Replay the journal, a truncated last line (crash while writing) is ignored
+
+        :return: True if the last line is truncated
+        """
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as fp:
+            content = fp.read()
+        lines = content.splitlines()
+        for line in lines:
+            try:
+                entry = json.loads(line)
+                chat_id = int(entry["chat_id"])
+            except (ValueError, KeyError, TypeError):
+                continue
+            self._lines += 1
+            if entry.get("removed"):
+                self._chats.pop(chat_id, None)
+            else:
+                devices = entry.get("devices")
+                self._chats[chat_id] = None if devices is None else frozenset(devices)
+        return bool(content) and not content.endswith("\n")
+
+    def _write(self, entry: dict):
+        """
+        Append a change to the journal and forget the chats computed, holding the lock
+
+        :param entry: change of a chat
+        """
+        self._recipients.clear()
+        if self._file is None:
+            return
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        self._lines += 1
+        if self._lines - len(self._chats) >= self.compact_after:
+            self._compact()
+
+    def _compact(self):
+        """
+        Rewrite the journal with only the current chats, holding the lock.
+        The new journal replaces the old one atomically
+        """
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as fp:
+            for chat_id, devices in self._chats.items():
+                fp.write(json.dumps(self._entry(chat_id, devices)) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+        self._file.close()
+        os.replace(temporary, self.path)
+        self._file = open(self.path, "a")
+        self._lines = len(self._chats)
+
+    @staticmethod
+    def _entry(chat_id: int, devices: Optional[FrozenSet[str]]) -> dict:
+        """
+        Line of the journal of a chat
+
+        :param chat_id: id of the chat
+        :param devices: devices of the chat, None for all of them
+        """
+        return {"chat_id": chat_id, "devices": None if devices is None else sorted(devices)}
+
+    def subscribe(self, chat_id: int, devices: Optional[Iterable[str]] = None) -> bool:
+        """
+        Add a chat, or change its subscription
+
+        :param chat_id: id of the chat, converted to int
+        :param devices: devices whose alarms the chat receives, None or empty for all of them
+        :return: True if the chat or its subscription is new
+        :raise ValueError: the chat id is not an integer
+        """
+        chat_id = chat_id_of(chat_id)
+        devices = frozenset(devices) if devices else None
+        with self._lock:
+            if chat_id in self._chats and self._chats[chat_id] == devices:
+                return False
+            self._chats[chat_id] = devices
+            self._write(self._entry(chat_id, devices))
+        return True
+
+    def remove(self, chat_id: int) -> bool:
+        """
+        Remove a chat
+
+        :param chat_id: id of the chat
+        :return: True if the chat was registered
+        :raise ValueError: the chat id is not an integer
+        """
+        chat_id = chat_id_of(chat_id)
+        with self._lock:
+            if chat_id not in self._chats:
+                return False
+            del self._chats[chat_id]
+            self._write({"chat_id": chat_id, "removed": True})
+        return True
+
+    def recipients(self, device: str) -> Tuple[int, ...]:
+        """
+        Chats that receive the alarms of a device
+
+        :param device: device of the alarm
+        """
+        recipients = self._recipients.get(device)
+        if recipients is None:
+            with self._lock:
+                recipients = tuple(
+                    chat_id for chat_id, devices in self._chats.items() if devices is None or device in devices
+                )
+                self._recipients[device] = recipients
+        return recipients
+
+    def devices(self, chat_id: int) -> Optional[Set[str]]:
+        """
+        Devices a chat is subscribed to
+
+        :param chat_id: id of the chat
+        :return: the devices, None for all of them
+        :raise KeyError: the chat is not registered
+        """
+        with self._lock:
+            devices = self._chats[chat_id]
+        return None if devices is None else set(devices)
+
+    def __contains__(self, chat_id: int) -> bool:
+        """
+        Check if a chat is registered
+
+        :param chat_id: id of the chat
+        """
+        return chat_id in self._chats
+
+    def __len__(self) -> int:
+        """
+        Number of chats
+        """
+        return len(self._chats)
+
+    def report(self) -> str:
+        """
+        Metrics of the registry in a line of log
+        """
+        with self._lock:
+            chats = len(self._chats)
+            everything = sum(devices is None for devices in self._chats.values())
+            lines = self._lines
+        return (
+            f"{chats} chats ({everything} for all the devices, {chats - everything} subscribed to some), "
+            f"{lines} journal lines"
+        )
+
+    def close(self):
+        """
+        Close the journal
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+"""
+Embedded MQTT 3.1.1 broker
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import asyncio
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import struct
+import threading
+import time
+from typing import DefaultDict, Deque, Dict, Iterator, Optional, Set, Tuple
+
+# ---------------------------------------------------------------
+
+#############
+# CONSTANTS #
+#############
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+RATE_WINDOW = 10
+"""Seconds used to compute the message rate of every topic"""
+
+# ---------------------------------------------------------------
+
+###########
+# PACKETS #
+###########
+
+
+def encode_length(length: int) -> bytes:
+    """
+    Encode the remaining length of a packet
+
+    :param length: remaining length
+    :return: variable length encoding
+    """
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value: bytes) -> bytes:
+    """
+    Encode a string prefixed by its length
+
+    :param value: string to encode
+    :return: encoded string
+    """
+    return struct.pack("!H", len(value)) + value
+
+
+def packet(packet_type: int, flags: int, body: bytes) -> bytes:
+    """
+    Build a packet
+
+    :param packet_type: MQTT control packet type
+    :param flags: flags of the fixed header
+    :param body: variable header and payload
+    :return: encoded packet
+    """
+    return bytes([(packet_type << 4) | flags]) + encode_length(len(body)) + body
+
+
+def decode_string(data: bytes, offset: int) -> Tuple[bytes, int]:
+    """
+    Decode a string prefixed by its length
+
+    :param data: packet body
+    :param offset: start of the string
+    :return: string and offset of the next field
+    """
+    (length,) = struct.unpack_from("!H", data, offset)
+    offset += 2
+    return data[offset:offset + length], offset + length
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """
+    Check if a topic matches a subscription filter, wildcards + and # supported
+
+    :param topic_filter: subscription filter
+    :param topic: topic of the message
+    :return: True if the message must be delivered
+    """
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+# ---------------------------------------------------------------
+
+#########
+# STATS #
+#########
+
+
+class TopicStats:
+    """Messages received on every topic, with the rate of the last RATE_WINDOW seconds"""
+
+    def __init__(self):
+        """
+        Instantiate the statistics
+        """
+        self.messages: DefaultDict[str, int] = defaultdict(int)
+        self.bytes: DefaultDict[str, int] = defaultdict(int)
+        self.delivered: DefaultDict[str, int] = defaultdict(int)
+        self._recent: DefaultDict[str, Deque[float]] = defaultdict(deque)
+        self._lock = threading.Lock()
+        self.start = time.monotonic()
+
+    def add(self, topic: str, size: int, delivered: int):
+        """
+        Store a message
+
+        :param topic: topic of the message
+        :param size: payload size
+        :param delivered: number of subscribers that received the message
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.messages[topic] += 1
+            self.bytes[topic] += size
+            self.delivered[topic] += delivered
+            recent = self._recent[topic]
+            recent.append(now)
+            while recent[0] < now - RATE_WINDOW:
+                recent.popleft()
+
+    def snapshot(self) -> Dict[str, dict]:
+        """
+        Statistics of every topic
+
+        :return: dict {topic: {"messages", "bytes", "delivered", "rate", "average_rate"}}
+        """
+        now = time.monotonic()
+        elapsed = max(now - self.start, 1e-9)
+        with self._lock:
+            return {
+                topic: {
+                    "messages": self.messages[topic],
+                    "bytes": self.bytes[topic],
+                    "delivered": self.delivered[topic],
+                    "rate": round(
+                        sum(1 for received in self._recent[topic] if received >= now - RATE_WINDOW)
+                        / min(RATE_WINDOW, elapsed), 3
+                    ),
+                    "average_rate": round(self.messages[topic] / elapsed, 3),
+                }
+                for topic in self.messages
+            }
+
+
+# ---------------------------------------------------------------
+
+###########
+# SESSION #
+###########
+
+
+class Session:
+    """Connection of a client"""
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        """
+        Instantiate the session
+
+        :param writer: stream used to send packets to the client
+        """
+        self.writer = writer
+        self.client_id = ""
+        self.subscriptions: Set[str] = set()
+
+    def send(self, data: bytes):
+        """
+        Send a packet to the client
+
+        :param data: encoded packet
+        """
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+
+# ---------------------------------------------------------------
+
+##########
+# BROKER #
+##########
+
+
+class Broker:
+    """
+    Minimal MQTT 3.1.1 broker that runs inside the process, in a background thread.
+    It supports QoS 0/1/2 publish from the clients (messages are delivered with QoS 0),
+    retained messages, wildcards subscriptions and keeps per topic statistics.
+    It's meant for local tests and benchmarks, not for production
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 1883):
+        """
+        Instantiate the broker
+
+        :param host: address to bind
+        :param port: port to bind, 0 to choose a free one
+        """
+        self.host = host
+        self.port = port
+        self.stats = TopicStats()
+        self._exact: DefaultDict[str, Set[Session]] = defaultdict(set)
+        self._wildcard: DefaultDict[str, Set[Session]] = defaultdict(set)
+        self._retained: Dict[str, bytes] = {}
+        self._sessions: Set[Session] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+        # Error raised while binding, re-raised by start
+        self._error: Optional[BaseException] = None
+
+    # -------------------------------------------------------------------------
+
+    def start(self) -> "Broker":
+        """
+        Start the broker in a background thread, return when it's listening
+
+        :return: the broker itself
+        :raise OSError: the broker can't listen on the address, e.g. the port is already in use
+        """
+        self._thread = threading.Thread(target=self._run, name="MqttBroker", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            self._thread.join()
+            self._loop = None
+            raise self._error
+        return self
+
+    def stop(self):
+        """
+        Stop the broker and close all the connections
+        """
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+    def _run(self):
+        """
+        Event loop of the broker
+        """
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port)
+            )
+            # Port chosen by the OS
+            self.port = self._server.sockets[0].getsockname()[1]
+        except BaseException as error:
+            self._error = error
+            self._loop.close()
+            return
+        finally:
+            self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            for session in list(self._sessions):
+                session.writer.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+    # -------------------------------------------------------------------------
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Serve a client until it disconnects
+
+        :param reader: stream of the packets received
+        :param writer: stream of the packets to send
+        """
+        session = Session(writer)
+        self._sessions.add(session)
+        try:
+            while True:
+                header = await reader.readexactly(1)
+                length, multiplier = 0, 1
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) * multiplier
+                    multiplier *= 128
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length)
+                if not self._dispatch(session, header[0] >> 4, header[0] & 0x0F, body):
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._remove(session)
+            writer.close()
+
+    def _dispatch(self, session: Session, packet_type: int, flags: int, body: bytes) -> bool:
+        """
+        Handle a packet
+
+        :param session: client that sent the packet
+        :param packet_type: MQTT control packet type
+        :param flags: flags of the fixed header
+        :param body: variable header and payload
+        :return: False if the connection must be closed
+        """
+        if packet_type == CONNECT:
+            # Protocol name, level, flags, keep alive and then client id
+            _, offset = decode_string(body, 0)
+            client_id, _ = decode_string(body, offset + 4)
+            session.client_id = client_id.decode()
+            session.send(packet(CONNACK, 0, b"\x00\x00"))
+
+        elif packet_type == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            topic, offset = decode_string(body, 0)
+            if qos:
+                packet_id = body[offset:offset + 2]
+                offset += 2
+                session.send(packet(PUBACK if qos == 1 else PUBREC, 0, packet_id))
+            self.publish(topic.decode(), body[offset:], bool(flags & 0x01))
+
+        elif packet_type == PUBREL:
+            session.send(packet(PUBCOMP, 0, body[:2]))
+
+        elif packet_type == SUBSCRIBE:
+            packet_id, offset = body[:2], 2
+            granted = bytearray()
+            while offset < len(body):
+                topic_filter, offset = decode_string(body, offset)
+                offset += 1  # Requested QoS, always granted as 0
+                self._subscribe(session, topic_filter.decode())
+                granted.append(0)
+            session.send(packet(SUBACK, 0, packet_id + bytes(granted)))
+
+        elif packet_type == UNSUBSCRIBE:
+            packet_id, offset = body[:2], 2
+            while offset < len(body):
+                topic_filter, offset = decode_string(body, offset)
+                self._unsubscribe(session, topic_filter.decode())
+            session.send(packet(UNSUBACK, 0, packet_id))
+
+        elif packet_type == PINGREQ:
+            session.send(packet(PINGRESP, 0, b""))
+
+        elif packet_type == DISCONNECT:
+            return False
+
+        return True
+
+    # -------------------------------------------------------------------------
+
+    def _subscribe(self, session: Session, topic_filter: str):
+        """
+        Subscribe a client and send the retained messages
+
+        :param session: client to subscribe
+        :param topic_filter: subscription filter
+        """
+        routes = self._wildcard if "+" in topic_filter or "#" in topic_filter else self._exact
+        routes[topic_filter].add(session)
+        session.subscriptions.add(topic_filter)
+        for topic, payload in self._retained.items():
+            if topic_matches(topic_filter, topic):
+                session.send(packet(PUBLISH, 0x01, encode_string(topic.encode()) + payload))
+
+    def _unsubscribe(self, session: Session, topic_filter: str):
+        """
+        Unsubscribe a client
+
+        :param session: client to unsubscribe
+        :param topic_filter: subscription filter
+        """
+        for routes in (self._exact, self._wildcard):
+            if topic_filter in routes:
+                routes[topic_filter].discard(session)
+                if not routes[topic_filter]:
+                    del routes[topic_filter]
+        session.subscriptions.discard(topic_filter)
+
+    def _remove(self, session: Session):
+        """
+        Forget a disconnected client
+
+        :param session: client to remove
+        """
+        for topic_filter in list(session.subscriptions):
+            self._unsubscribe(session, topic_filter)
+        self._sessions.discard(session)
+
+    def publish(self, topic: str, payload: bytes, retain: bool = False):
+        """
+        Deliver a message to all the subscribers.
+        Must be called from the thread of the broker
+
+        :param topic: topic of the message
+        :param payload: payload of the message
+        :param retain: store the message for the future subscribers
+        """
+        if retain:
+            if payload:
+                self._retained[topic] = payload
+            else:
+                self._retained.pop(topic, None)
+
+        subscribers = set(self._exact.get(topic, ()))
+        for topic_filter, sessions in self._wildcard.items():
+            if topic_matches(topic_filter, topic):
+                subscribers.update(sessions)
+
+        data = packet(PUBLISH, 0, encode_string(topic.encode()) + payload)
+        for subscriber in subscribers:
+            subscriber.send(data)
+        self.stats.add(topic, len(payload), len(subscribers))
+
+
+# ---------------------------------------------------------------
+
+
+@contextmanager
+def running_broker(host: str = "127.0.0.1", port: int = 0) -> Iterator[Broker]:
+    """
+    Run a broker for the duration of a with block, useful as test fixture
+
+    :param host: address to bind
+    :param port: port to bind, 0 to choose a free one
+    :return: the running broker, broker.port contains the port in use
+    """
+    broker = Broker(host, port).start()
+    try:
+        yield broker
+    finally:
+        broker.stop()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Digest of the alarm notifications
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+from threading import Lock
+import time
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+# ---------------------------------------------------------------
+
+INTERVAL = 60.0
+"""Seconds to earn a new digest for a recipient"""
+
+BURST = 5
+"""Digests a recipient can receive in a row before being rate limited"""
+
+Devices = Tuple[Tuple[str, int], ...]
+"""Devices of a digest with their alarms, sorted by device"""
+
+
+class TokenBucket:
+    """
+    Rate limit: a token is earned every interval seconds up to burst tokens,
+    and every digest sent spends one
+    """
+
+    __slots__ = ("interval", "burst", "tokens", "stamp")
+
+    def __init__(self, interval: float, burst: int, now: float):
+        """
+        Instantiate a full bucket
+
+        :param interval: seconds to earn a token, 0 disables the limit
+        :param burst: maximum tokens
+        :param now: current time
+        """
+        self.interval = interval
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = now
+
+    def take(self, now: float) -> bool:
+        """
+        Spend a token if there is one
+
+        :param now: current time
+        :return: False if the recipient is rate limited
+        """
+        if self.interval <= 0:
+            return True
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) / self.interval)
+        self.stamp = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Digest:
+    """
+    Group the alarms of every recipient: within a window the repeated alarms of a device are
+    collapsed in a counter, and at the end of the window every recipient gets a single digest
+    with all its devices, if its token bucket allows it. A rate limited recipient keeps its
+    digest, that grows until the next window in which it has a token. Recipients with the same
+    digest are returned together, so that a channel can send them a single message
+    """
+
+    def __init__(self, interval: float = INTERVAL, burst: int = BURST):
+        """
+        Instantiate the digest
+
+        :param interval: seconds to earn a new digest for a recipient, 0 disables the limit
+        :param burst: digests a recipient can receive in a row
+        """
+        self.interval = interval
+        self.burst = burst
+        self.counters = {"alarms": 0, "collapsed": 0, "suppressed": 0, "limited": 0, "digests": 0, "messages": 0}
+        self._lock = Lock()
+        self._pending: Dict[Hashable, Dict[str, int]] = {}
+        self._buckets: Dict[Hashable, TokenBucket] = {}
+
+    def add(self, device: str, recipients: Iterable[Hashable]):
+        """
+        Record an alarm of a device for the recipients
+
+        :param device: device that generated the alarm
+        :param recipients: recipients to notify
+        """
+        with self._lock:
+            for recipient in recipients:
+                devices = self._pending.setdefault(recipient, {})
+                if device in devices:
+                    devices[device] += 1
+                    self.counters["collapsed"] += 1
+                else:
+                    devices[device] = 1
+                self.counters["alarms"] += 1
+
+    def flush(self, now: Optional[float] = None) -> List[Tuple[Devices, List[Hashable]]]:
+        """
+        Close the window: take the digests of the recipients that are not rate limited
+
+        :param now: current time, default time.monotonic()
+        :return: list of (devices with their alarms, recipients of that digest)
+        """
+        if now is None:
+            now = time.monotonic()
+        groups: Dict[Devices, List[Hashable]] = {}
+        with self._lock:
+            for recipient in list(self._pending):
+                bucket = self._buckets.get(recipient)
+                if bucket is None:
+                    bucket = self._buckets[recipient] = TokenBucket(self.interval, self.burst, now)
+                if not bucket.take(now):
+                    self.counters["limited"] += 1
+                    continue
+                devices = self._pending.pop(recipient)
+                digest = tuple(sorted(devices.items()))
+                groups.setdefault(digest, []).append(recipient)
+                self.counters["digests"] += 1
+                # Alarms that didn't get a notification of their own
+                self.counters["suppressed"] += sum(devices.values()) - 1
+            self.counters["messages"] += len(groups)
+        return list(groups.items())
+
+    def forget(self, recipients: Iterable[Hashable]):
+        """
+        Drop the pending digests and the rate limits of recipients no longer registered
+
+        :param recipients: recipients to forget
+        """
+        with self._lock:
+            for recipient in recipients:
+                self._pending.pop(recipient, None)
+                self._buckets.pop(recipient, None)
+
+    def __len__(self) -> int:
+        """
+        Recipients with a digest waiting
+        """
+        return len(self._pending)
+
+    def report(self) -> str:
+        """
+        Metrics of the digest in a line of log
+        """
+        with self._lock:
+            counters = dict(self.counters)
+            waiting = len(self._pending)
+        return (
+            f"{counters['alarms']} alarms in {counters['digests']} digests and {counters['messages']} messages, "
+            f"{counters['collapsed']} collapsed, {counters['suppressed']} suppressed, "
+            f"{counters['limited']} rate limited, {waiting} waiting"
+        )
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+"""
+Dispatcher of the notifications
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+from array import array
+from collections import deque
+from heapq import heappop, heappush
+from itertools import count
+from random import uniform
+from threading import Condition, Thread
+import time
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, Type, Union
+import uuid
+
+# Internals
+from runtime.scheduler import Scheduler
+from .spool import Spool
+
+# ---------------------------------------------------------------
+
+CAPACITY = 1000
+"""Notifications waiting to be delivered, new ones are rejected when full"""
+
+WORKERS = 4
+"""Threads delivering the notifications"""
+
+RETRIES = 5
+"""Attempts after the first failure of a notification"""
+
+BACKOFF_INITIAL = 1.0
+"""Seconds before the first retry, doubled at every failure"""
+
+BACKOFF_MAXIMUM = 60.0
+"""Maximum seconds between two attempts"""
+
+LATENCY_SAMPLES = 10000
+"""Delivery latencies kept for every channel to compute the percentiles"""
+
+Handler = Callable[[dict], None]
+"""Deliver the payload of a notification, raise to retry"""
+
+Rate = Union[float, Callable[[Any], float]]
+"""Deliveries per second, 0 for no limit, or a function giving the rate of a key"""
+
+
+class Channel:
+    """
+    A way to deliver the notifications, with its handler, the maximum number of notifications
+    delivered at the same time and the rate limits. The notifications are queued by key (a field
+    of the payload, e.g. the recipient) and the keys are kept in a heap by the time at which
+    they can receive the next notification, so that a recipient at its rate limit doesn't hold
+    back the others. All the methods are called holding the condition of the dispatcher
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: Handler,
+        concurrency: int,
+        permanent: Tuple[Type[Exception], ...],
+        rate: float,
+        key: Optional[str],
+        key_rate: Rate
+    ):
+        """
+        Instantiate the channel
+
+        :param name: name of the channel
+        :param handler: function delivering a payload
+        :param concurrency: notifications delivered at the same time
+        :param permanent: errors that are not retried
+        :param rate: deliveries per second of the channel, 0 for no limit
+        :param key: field of the payload whose values are rate limited one by one, None for no key
+        :param key_rate: deliveries per second to every key
+        """
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.permanent = permanent
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.key = key
+        self.key_rate = key_rate
+        self.active = 0
+        self._queues: Dict[Any, Deque[dict]] = {}
+        self._heap: List[Tuple[float, int, Any]] = []
+        self._sequence = count()
+        # Earliest time of the next delivery, of the channel and of every key
+        self._ready = 0.0
+        self._ready_key: Dict[Any, float] = {}
+        self.latencies = array("d", bytes(8 * LATENCY_SAMPLES))
+        self.samples = 0
+
+    def _key_interval(self, key: Any) -> float:
+        """
+        Seconds between two deliveries to a key
+
+        :param key: key of the notifications
+        """
+        try:
+            rate = self.key_rate(key) if callable(self.key_rate) else self.key_rate
+            return 1 / rate if rate > 0 else 0.0
+        except (TypeError, ValueError, ZeroDivisionError) as error:
+            # A key the rate can't be computed for is not limited, instead of stopping the worker
+            print(f"[{time.ctime()}] WARNING {self.name} rate of {key!r} unknown ({error!r})")
+            return 0.0
+
+    def push(self, notification: dict, now: float):
+        """
+        Queue a notification
+
+        :param notification: notification to deliver
+        :param now: current time
+        """
+        key = notification["payload"].get(self.key) if self.key else None
+        queue = self._queues.get(key)
+        if queue is None:
+            # The key isn't in the heap, it enters when it can receive a notification
+            queue = self._queues[key] = deque()
+            heappush(self._heap, (max(now, self._ready_key.get(key, 0.0)), next(self._sequence), key))
+        queue.append(notification)
+
+    def pop(self, now: float) -> Tuple[Optional[dict], Optional[float]]:
+        """
+        Take the next notification that can be delivered now
+
+        :param now: current time
+        :return: the notification, or None and the seconds after which one can be delivered
+            (None if the channel is empty or at its concurrency)
+        """
+        if not self._heap or self.active >= self.concurrency:
+            return None, None
+        ready = max(self._heap[0][0], self._ready)
+        if ready > now:
+            return None, ready - now
+        # Computed before changing the queues, so that they stay consistent
+        key = self._heap[0][2]
+        interval = self._key_interval(key)
+        heappop(self._heap)
+        queue = self._queues[key]
+        notification = queue.popleft()
+        self._ready = max(self._ready, now) + self.interval
+        if interval:
+            self._ready_key[key] = now + interval
+        if queue:
+            heappush(self._heap, (now + interval, next(self._sequence), key))
+        else:
+            del self._queues[key]
+            if len(self._ready_key) > 2 * len(self._queues) + 1024:
+                # Forget the keys that can already receive
+                self._ready_key = {other: ready for other, ready in self._ready_key.items() if ready > now}
+        self.active += 1
+        return notification, None
+
+    def record(self, latency: float):
+        """
+        Store the latency of a delivery
+
+        :param latency: seconds from the submission to the delivery
+        """
+        self.latencies[self.samples % LATENCY_SAMPLES] = latency
+        self.samples += 1
+
+    def percentiles(self) -> Dict[str, float]:
+        """
+        Percentiles of the latency of the last deliveries, in seconds
+        """
+        samples = sorted(self.latencies[:min(self.samples, LATENCY_SAMPLES)])
+        if not samples:
+            return {}
+        return {
+            name: samples[min(len(samples) - 1, int(len(samples) * fraction))]
+            for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))
+        }
+
+
+class Dispatcher:
+    """
+    Deliver the notifications in background. submit only stores the notification in a bounded
+    queue, and in the spool on disk if any, so it can be called from the MQTT callbacks;
+    a pool of workers delivers them through their channel, with at most concurrency
+    notifications of a channel at the same time and within its rate limits, global and for
+    every key. A failed delivery is retried on the scheduler with an exponential backoff, or
+    after the retry_after seconds of the error if it has one, and the notifications still
+    pending at the restart are restored from the spool
+    """
+
+    def __init__(
+        self,
+        scheduler: Scheduler,
+        spool: Optional[Spool] = None,
+        capacity: int = CAPACITY,
+        workers: int = WORKERS,
+        retries: int = RETRIES,
+        backoff: float = BACKOFF_INITIAL,
+        max_backoff: float = BACKOFF_MAXIMUM
+    ):
+        """
+        Instantiate the dispatcher
+
+        :param scheduler: scheduler on which the retries are scheduled
+        :param spool: spool in which store the notifications, None to keep them only in memory
+        :param capacity: notifications waiting to be delivered
+        :param workers: threads delivering the notifications
+        :param retries: attempts after the first failure
+        :param backoff: seconds before the first retry
+        :param max_backoff: maximum seconds between two attempts
+        """
+        self.scheduler = scheduler
+        self.spool = spool
+        self.capacity = capacity
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.counters = {"submitted": 0, "sent": 0, "retried": 0, "failed": 0, "rejected": 0, "restored": 0}
+        self._channels: Dict[str, Channel] = {}
+        self._condition = Condition()
+        # Notifications accepted and not delivered yet: ready, running or waiting for a retry
+        self._pending = 0
+        self._threads: List[Thread] = []
+        self._running = False
+
+    def register(
+        self,
+        name: str,
+        handler: Handler,
+        concurrency: int = 1,
+        permanent: Tuple[Type[Exception], ...] = (),
+        rate: float = 0.0,
+        key: Optional[str] = None,
+        key_rate: Rate = 0.0
+    ):
+        """
+        Add a channel
+
+        :param name: name of the channel, used by submit
+        :param handler: function delivering the payload of a notification, raising to retry
+        :param concurrency: notifications of the channel delivered at the same time
+        :param permanent: errors of the handler that are not retried
+        :param rate: deliveries per second of the channel, 0 for no limit
+        :param key: field of the payload whose values are rate limited one by one, e.g. the recipient
+        :param key_rate: deliveries per second to every key, or function giving the rate of a key
+        """
+        self._channels[name] = Channel(name, handler, concurrency, permanent, rate, key, key_rate)
+
+    def start(self):
+        """
+        Restore the notifications left in the spool by the previous run and start the workers,
+        the channels have to be registered before
+        """
+        if self.spool is not None:
+            with self._condition:
+                now = time.monotonic()
+                for notification in self.spool.recovered():
+                    channel = self._channels.get(notification["channel"])
+                    if channel is None:
+                        self.spool.done(notification["id"])
+                        continue
+                    channel.push(notification, now)
+                    self._pending += 1
+                    self.counters["restored"] += 1
+        self._running = True
+        self._threads = [
+            Thread(target=self._work, name=f"Notify{index}", daemon=True) for index in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Stop the workers after the deliveries in progress, the notifications
+        not delivered stay in the spool. A delivery still running after the timeout
+        is not completed in the spool, so it's repeated at the restart
+
+        :param timeout: seconds to wait for the workers
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        running = sum(thread.is_alive() for thread in self._threads)
+        if running:
+            print(f"[{time.ctime()}] WARNING {running} deliveries still running, left pending in the spool")
+        if self.spool is not None:
+            self.spool.close()
+
+    def submit(self, channel: str, payload: dict) -> bool:
+        """
+        Queue a notification, without waiting for its delivery
+
+        :param channel: channel of the notification
+        :param payload: JSON serialisable data given to the handler of the channel
+        :return: False if the queue is full and the notification has been rejected
+        :raise KeyError: the channel isn't registered, nothing is queued
+        """
+        notification = {
+            "id": uuid.uuid4().hex, "channel": channel, "payload": payload, "attempts": 0, "submitted": time.time()
+        }
+        with self._condition:
+            queue = self._channels[channel]
+            if self._pending >= self.capacity:
+                self.counters["rejected"] += 1
+                return False
+            self._pending += 1
+            self.counters["submitted"] += 1
+        if self.spool is not None:
+            self.spool.add(notification)
+        with self._condition:
+            queue.push(notification, time.monotonic())
+            self._condition.notify()
+        return True
+
+    def __len__(self) -> int:
+        """
+        Notifications not delivered yet
+        """
+        return self._pending
+
+    def _next(self) -> Optional[Tuple[Channel, dict]]:
+        """
+        Wait for a notification of a channel below its concurrency and its rate limits,
+        holding the condition
+
+        :return: channel and notification, None when stopping
+        """
+        while self._running:
+            now = time.monotonic()
+            wait = None
+            for channel in self._channels.values():
+                notification, delay = channel.pop(now)
+                if notification is not None:
+                    # Another notification could be ready too
+                    self._condition.notify()
+                    return channel, notification
+                if delay is not None and (wait is None or delay < wait):
+                    wait = delay
+            self._condition.wait(wait)
+        return None
+
+    def _work(self):
+        """
+        Deliver the notifications until the dispatcher is stopped
+        """
+        while True:
+            with self._condition:
+                job = self._next()
+            if job is None:
+                return
+            channel, notification = job
+            delay = None
+            try:
+                channel.handler(notification["payload"])
+                outcome = "sent"
+            except channel.permanent as error:
+                print(f"[{time.ctime()}] WARNING {channel.name} notification dropped ({error!r})")
+                outcome = "failed"
+            except Exception as error:
+                if notification["attempts"] < self.retries:
+                    outcome = "retried"
+                    # Flood control of the remote service, e.g. telegram.error.RetryAfter
+                    delay = getattr(error, "retry_after", None)
+                else:
+                    print(
+                        f"[{time.ctime()}] WARNING {channel.name} notification dropped after "
+                        f"{notification['attempts'] + 1} attempts ({error!r})"
+                    )
+                    outcome = "failed"
+
+            with self._condition:
+                channel.active -= 1
+                self.counters[outcome] += 1
+                if outcome == "sent" and "submitted" in notification:
+                    channel.record(time.time() - notification["submitted"])
+                if outcome != "retried":
+                    self._pending -= 1
+                self._condition.notify()
+                stopped = not self._running
+
+            if outcome == "retried":
+                if not isinstance(delay, (int, float)):
+                    # Exponential backoff with jitter, as runtime.http.Backoff
+                    delay = min(self.backoff * 2 ** notification["attempts"], self.max_backoff) * uniform(0.5, 1)
+                notification["attempts"] += 1
+                self.scheduler.call_later(delay, self._retry, channel, notification)
+            elif self.spool is not None and not stopped:
+                self.spool.done(notification["id"])
+
+    def _retry(self, channel: Channel, notification: dict):
+        """
+        Queue again a notification after its backoff
+
+        :param channel: channel of the notification
+        :param notification: notification to deliver
+        """
+        with self._condition:
+            channel.push(notification, time.monotonic())
+            self._condition.notify()
+
+    def latency(self, channel: str) -> Dict[str, float]:
+        """
+        Percentiles (p50, p95, p99 and max) of the seconds from the submission to the delivery
+        of the last notifications of a channel
+
+        :param channel: name of the channel
+        """
+        with self._condition:
+            return self._channels[channel].percentiles()
+
+    def report(self) -> str:
+        """
+        Metrics of the dispatcher in a line of log
+        """
+        with self._condition:
+            counters = dict(self.counters)
+            pending = self._pending
+            latencies = {name: channel.percentiles() for name, channel in self._channels.items()}
+        line = (
+            f"{counters['submitted']} submitted, {counters['sent']} sent, {counters['retried']} retried, "
+            f"{counters['failed']} failed, {counters['rejected']} rejected, {counters['restored']} restored, "
+            f"{pending} pending"
+        )
+        for name, percentiles in latencies.items():
+            if percentiles:
+                line += f", {name} latency " + " ".join(
+                    f"{percentile} {seconds * 1e3:.0f} ms" for percentile, seconds in percentiles.items()
+                )
+        return line
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Spool of the notifications
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import json
+import os
+from threading import Lock
+from typing import Dict, List, Optional, Set, TextIO
+
+# ---------------------------------------------------------------
+
+COMPACT_AFTER = 1000
+"""Completed notifications in the journal after which it's rewritten with only the pending ones"""
+
+
+class Spool:
+    """
+    Journal on disk of the notifications not delivered yet, so that they survive a restart.
+    Every notification accepted is appended as a JSON line, and a line is appended when it's
+    delivered or given up: the pending notifications are the ones added and not completed.
+    The file is rewritten with only the pending notifications once enough of them are completed
+    """
+
+    def __init__(self, path: str, sync: bool = False, compact_after: int = COMPACT_AFTER):
+        """
+        Open the spool, creating the file if needed
+
+        :param path: file of the journal
+        :param sync: flush the writes to the disk (fsync), slower but safe against power loss
+        :param compact_after: completed notifications after which the journal is rewritten
+        """
+        self.path = path
+        self.sync = sync
+        self.compact_after = compact_after
+        self._lock = Lock()
+        self._pending: Dict[str, dict] = {}
+        self._completed = 0
+        truncated = self._load()
+        # Left pending by the previous run
+        self._recovered: Set[str] = set(self._pending)
+        # None once closed, the notifications completed afterwards stay pending for the restart
+        self._file: Optional[TextIO] = open(self.path, "a")
+        if truncated:
+            # The next entry starts on its own line instead of completing the truncated one
+            self._file.write("\n")
+
+    def _load(self) -> bool:
+        """
+        Replay the journal, a truncated last line (crash while writing) is ignored
+
+        :return: True if the last line is truncated
+        """
+        if not os.path.exists(self.path):
+            return False
+        line = ""
+        with open(self.path) as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if "done" in entry:
+                    self._completed += self._pending.pop(entry["done"], None) is not None
+                else:
+                    self._pending[entry["id"]] = entry
+        return bool(line) and not line.endswith("\n")
+
+    def _write(self, entry: dict):
+        """
+        Append an entry to the journal, holding the lock
+
+        :param entry: notification or completion
+        """
+        if self._file is None:
+            return
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+
+    def pending(self) -> List[dict]:
+        """
+        Notifications not delivered yet, in the order they were added
+        """
+        with self._lock:
+            return list(self._pending.values())
+
+    def recovered(self) -> List[dict]:
+        """
+        Notifications left pending by the previous run and not delivered yet, in the order they were added
+        """
+        with self._lock:
+            return [notification for key, notification in self._pending.items() if key in self._recovered]
+
+    def __len__(self) -> int:
+        """
+        Number of notifications not delivered yet
+        """
+        return len(self._pending)
+
+    def add(self, notification: dict):
+        """
+        Store a notification
+
+        :param notification: JSON serialisable dict with a unique "id"
+        """
+        with self._lock:
+            self._write(notification)
+            self._pending[notification["id"]] = notification
+
+    def done(self, notification_id: str):
+        """
+        Forget a notification delivered or given up
+
+        :param notification_id: id of the notification
+        """
+        with self._lock:
+            if self._file is None or self._pending.pop(notification_id, None) is None:
+                return
+            self._recovered.discard(notification_id)
+            self._write({"done": notification_id})
+            self._completed += 1
+            if self._completed >= self.compact_after:
+                self._compact()
+
+    def _compact(self):
+        """
+        Rewrite the journal with only the pending notifications, holding the lock.
+        The new journal replaces the old one atomically
+        """
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as fp:
+            for notification in self._pending.values():
+                fp.write(json.dumps(notification) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+        self._file.close()
+        os.replace(temporary, self.path)
+        self._file = open(self.path, "a")
+        self._completed = 0
+
+    def close(self):
+        """
+        Close the journal, the next writes are ignored
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
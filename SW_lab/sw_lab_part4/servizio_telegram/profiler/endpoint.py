@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Profiler endpoint for CherryPy
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import os
+
+# Third Party
+import cherrypy
+
+# Internals
+from .sampler import ProfileRunning, profile_seconds, sampler
+
+# ---------------------------------------------------------------
+
+PROFILE_ENDPOINT_ENV = "IOT_PROFILE_ENDPOINT"
+"""Environment variable that enables the profiler endpoint"""
+
+PROFILER_CONFIG = {"/": {"request.dispatch": cherrypy.dispatch.MethodDispatcher()}}
+"""Configuration of the Profiler endpoint"""
+
+
+@cherrypy.expose
+class Profiler:
+    """Profiler endpoint"""
+
+    def GET(self, seconds: str = "10"):
+        """
+        Sample all the threads of the server for the requested seconds,
+        only one profile at a time so that at most one worker of the server is busy
+
+        :param seconds: Duration of the profile
+        :return: collapsed stacks, ready for flamegraph.pl
+        """
+        try:
+            seconds = profile_seconds(seconds)
+        except ValueError as error:
+            raise cherrypy.HTTPError(status=400, message=str(error))
+
+        try:
+            stacks = sampler.sample(seconds, blocking=False)
+        except ProfileRunning as error:
+            raise cherrypy.HTTPError(status=409, message=str(error))
+        cherrypy.response.headers["Content-Type"] = "text/plain"
+        return sampler.collapse(stacks)
+
+
+def mount_profiler() -> bool:
+    """
+    Mount the profiler on "/profile" if the environment variable IOT_PROFILE_ENDPOINT is set
+
+    :return: True if the endpoint was mounted
+    """
+    if not os.environ.get(PROFILE_ENDPOINT_ENV):
+        return False
+    cherrypy.tree.mount(Profiler(), "/profile", PROFILER_CONFIG)
+    return True
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Statistical sampling profiler
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+from collections import Counter
+import math
+import os
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+# ---------------------------------------------------------------
+
+PROFILE_ENV = "IOT_PROFILE"
+"""Environment variable containing the seconds to profile after the startup"""
+
+PROFILE_OUTPUT_ENV = "IOT_PROFILE_OUTPUT"
+"""Environment variable containing the file in which the collapsed stacks are stored"""
+
+SAMPLE_INTERVAL = 0.005
+"""Seconds between two samples"""
+
+MAX_PROFILE_SECONDS = 300
+"""Maximum duration of a profile"""
+
+
+class ProfileRunning(Exception):
+    """Another profile is running, only one at a time is allowed"""
+
+
+def profile_seconds(value: str) -> float:
+    """
+    Duration of a profile, capped at MAX_PROFILE_SECONDS
+
+    :param value: seconds, as given by the user
+    :raise ValueError: the value isn't a positive number
+    """
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"seconds: {value} isn't a number")
+    if not math.isfinite(seconds) or seconds <= 0:
+        raise ValueError(f"seconds: {value} must be a positive number")
+    return min(seconds, MAX_PROFILE_SECONDS)
+
+
+class Sampler:
+    """
+    Statistical profiler that periodically samples the stack of every thread
+    of the process (CherryPy workers, paho network loops, timers...).
+    The result is in the collapsed format used by flamegraph.pl and speedscope:
+    one line for every stack, with the frames separated by ';' followed by the number of samples
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        """
+        Instantiate the sampler
+
+        :param interval: Seconds between two samples
+        """
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _frame_name(frame) -> str:
+        """
+        Name of a frame inside the collapsed stacks
+
+        :param frame: Frame to describe
+        :return: function name, file and line of definition
+        """
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def sample(self, seconds: float, blocking: bool = True) -> Dict[str, int]:
+        """
+        Sample the stacks of all the threads for the given amount of time.
+        Only one profile at a time can run
+
+        :param seconds: Duration of the profile
+        :param blocking: wait for the profile running, if any, instead of raising ProfileRunning
+        :return: dict {collapsed stack: number of samples}
+        :raise ProfileRunning: another profile is running and blocking is False
+        """
+        seconds = min(float(seconds), MAX_PROFILE_SECONDS)
+        stacks = Counter()
+        me = threading.get_ident()
+
+        if not self._lock.acquire(blocking):
+            raise ProfileRunning("a profile is already running")
+        try:
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    # Don't profile the profiler
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(self._frame_name(frame))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    stacks[";".join(reversed(stack))] += 1
+                time.sleep(self.interval)
+        finally:
+            self._lock.release()
+
+        return dict(stacks)
+
+    @staticmethod
+    def collapse(stacks: Dict[str, int]) -> str:
+        """
+        Format the stacks in the collapsed format, ready for flamegraph.pl
+
+        :param stacks: Stacks returned by Sampler.sample
+        :return: one line for every stack
+        """
+        return "".join(
+            f"{stack} {count}\n"
+            for stack, count in sorted(stacks.items(), key=lambda item: item[1], reverse=True)
+        )
+
+
+sampler = Sampler()
+"""Sampler shared by the process"""
+
+
+def profile_from_env() -> Optional[threading.Thread]:
+    """
+    If the environment variable IOT_PROFILE is set, profile the process for IOT_PROFILE seconds
+    in background and store the collapsed stacks in IOT_PROFILE_OUTPUT (default: profile-<pid>.folded)
+
+    :return: the thread running the profile, None if profiling is disabled
+    """
+    value = os.environ.get(PROFILE_ENV)
+    if not value:
+        return None
+    try:
+        seconds = profile_seconds(value)
+    except ValueError as error:
+        print(f"[{time.ctime()}] WARNING {PROFILE_ENV} ignored, profiler disabled ({error})")
+        return None
+
+    output = os.environ.get(PROFILE_OUTPUT_ENV, f"profile-{os.getpid()}.folded")
+
+    def _profile():
+        """
+        Run the profile and store the result
+        """
+        stacks = sampler.sample(seconds)
+        with open(output, "w") as fp:
+            fp.write(sampler.collapse(stacks))
+        print(f"[{time.ctime()}] PROFILE stored in: {output}")
+
+    print(f"[{time.ctime()}] PROFILING for {seconds} seconds")
+    thread = threading.Thread(target=_profile, name="Profiler", daemon=True)
+    thread.start()
+    return thread
@@ -16,18 +16,25 @@ Exercise2 sw_lab4
     limitations under the License.
 """
 # Standard Library
-from collections import defaultdict
 import json
-from random import randrange
-import sys
 import time
-from threading import Timer, Lock
-from typing import Any, Dict, List, DefaultDict
+from typing import Any, Optional
 
 # Third Party
 from paho.mqtt.client import Client, MQTTMessage
-import requests
 from telegram import Bot
+from telegram.error import BadRequest, ChatMigrated, Unauthorized
+
+# Internals
+from chats.registry import ChatRegistry, chat_id_of
+from configuration.loader import discover_broker, load_settings, register_defaults
+from notify.digest import Devices, Digest
+from notify.dispatcher import Dispatcher
+from notify.spool import Spool
+from profiler.sampler import profile_from_env
+from runtime.http import catalog_client
+from runtime.scheduler import Task
+from runtime.service import CatalogService
 
 # -----------------------------------------------------------------------------
 
@@ -45,20 +52,36 @@ SERVICE_UNIQUE_ID = "AlarmTemperature"
 CATALOG_IP_PORT = {"ip": "0.0.0.0", "port": 8080}
 
 SERVICE_BROKER_PORT = {"ip": "test.mosquitto.org", "port": 1883}
-SERVICE_INFO = json.dumps(
-    {
-        "serviceID": "TelegramService/LabSw4",
-        "description": "Check every service that generates an alarm in case of "
-                       "temperature out of range. In case of alarm, send via Telegram Bot the device"
-                       "that generated the alarm to each chat_id registered",
-        "end_points": {
-            "MQTT": {
-                "broker": SERVICE_BROKER_PORT,
-                "publish": ["labsw4/telegram/user/chat_id"]
-            }
+SERVICE_INFO = {
+    "serviceID": "TelegramService/LabSw4",
+    "description": "Check every service that generates an alarm in case of "
+                   "temperature out of range. In case of alarm, send via Telegram Bot the device"
+                   "that generated the alarm to each chat_id registered",
+    "end_points": {
+        "MQTT": {
+            "broker": SERVICE_BROKER_PORT,
+            "publish": ["labsw4/telegram/user/chat_id"]
         }
     }
-)
+}
+
+# Background delivery of the notifications, the MQTT callbacks only queue them
+NOTIFY_POLICY = {
+    "spool": "notifications.spool",
+    "capacity": 1000,
+    "workers": 4,
+    "concurrency": 2,
+    "retries": 5,
+    "backoff": 1.0,
+    "max_backoff": 60.0,
+    "sync": 0
+}
+
+# Chats and their subscriptions, kept across restarts, and rate limits of the Telegram API
+TELEGRAM_POLICY = {"chats": "chats.journal", "concurrency": 8, "rate": 30.0, "chat_rate": 1.0, "group_rate": 0.33}
+
+# Alarms grouped in one message for every chat, and messages a chat can receive
+DIGEST_POLICY = {"window": 10.0, "interval": 60.0, "burst": 5}
 
 
 # -----------------------------------------------------------------------------
@@ -80,359 +103,200 @@ def find_service(data: dict) -> bool:
     return False
 
 
-class Service:
+def chat_rate(chat_id: int) -> float:
+    """
+    Messages per second that can be sent to a chat, groups have negative ids
+    :param chat_id: id of the chat
+    """
+    return TELEGRAM_POLICY["group_rate"] if chat_id < 0 else TELEGRAM_POLICY["chat_rate"]
+
+
+def digest_text(devices: Devices) -> str:
+    """
+    Text of the message of a digest
+    :param devices: devices out of range with their alarms
+    """
+    return "\n".join(
+        f"{device} is out of range of good functioning" + (f" ({alarms} alarms)" if alarms > 1 else "")
+        for device, alarms in devices
+    ) + SIGNATURE
+
+
+class Service(CatalogService):
     """Service that sends messages via Telegram bot"""
 
-    _mqtt_client: Dict[str, Client] = {}
-    _service_list: Dict[str, dict] = {}
-    _broker: DefaultDict[str, set] = defaultdict(set)
-    _broker_port: Dict[str, int] = {}
-    _topic: DefaultDict[str, set] = defaultdict(set)
-    _update_thread: Timer = None
+    resource = "services"
+    key = "serviceID"
+    kind = "SERVICE"
+    label = "ServiceTemperatureAlarm"
+    client_prefix = "TelegramService"
     chat_id_topic = "labsw4/telegram/user/chat_id"
-    _user_list: Dict[str, dict] = {}
     # Telegram
     bot: Bot = Bot(token=TELEGRAM_TOKEN)
-    chat_id_list = set()
 
     def __init__(self):
         """
         Instantiate the service
         """
-        self.service = Client(client_id=f"TelegramService{randrange(1, 100000)}")
-        self.service.on_message = self.my_on_message
-        self.char_id_lock = Lock()
-        self.service_lock = Lock()
+        super().__init__(CATALOG_IP_PORT, SERVICE_BROKER_PORT, SERVICE_INFO)
+        self.chats = ChatRegistry(TELEGRAM_POLICY["chats"])
+        spool = None
+        if NOTIFY_POLICY["spool"]:
+            spool = Spool(NOTIFY_POLICY["spool"], sync=bool(NOTIFY_POLICY["sync"]))
+        self.notifier = Dispatcher(
+            self.scheduler,
+            spool,
+            capacity=NOTIFY_POLICY["capacity"],
+            workers=max(NOTIFY_POLICY["workers"], TELEGRAM_POLICY["concurrency"]),
+            retries=NOTIFY_POLICY["retries"],
+            backoff=NOTIFY_POLICY["backoff"],
+            max_backoff=NOTIFY_POLICY["max_backoff"]
+        )
+        # Messages sent concurrently within the limits of Telegram, globally and for every chat.
+        # A chat that doesn't exist or blocked the bot would fail again, the network errors are retried
+        self.notifier.register(
+            "telegram",
+            self.send_message,
+            TELEGRAM_POLICY["concurrency"],
+            permanent=(BadRequest, Unauthorized),
+            rate=TELEGRAM_POLICY["rate"],
+            key="chat_id",
+            key_rate=chat_rate
+        )
+        self.digest = Digest(DIGEST_POLICY["interval"], DIGEST_POLICY["burst"])
+        self._digest_task: Optional[Task] = None
 
-    def _update(self, service_list: List[dict]):
+    def find(self, entry: dict) -> bool:
         """
-        Update reserved dicts
-        :param service_list: service list to add
+        Follow the alarm services
+        :param entry: service of the catalog
         """
-        for alarm in service_list:
-            service = alarm["serviceID"]
-            broker = alarm["end_points"]["MQTT"]["broker"]["ip"]
-            port = alarm["end_points"]["MQTT"]["broker"]["port"]
-            topics = {
-                topic
-                for topic in alarm["end_points"]["MQTT"]["subscribe"]
-                if "alarm_temperature" in topic
-            }
+        return find_service(entry)
 
-            self._service_list[service] = {
-                "ip": broker,
-                "topics": topics
-            }
-
-            self._broker_port[broker] = port
-
-            self._broker[broker].update({service})
-            self._topic[broker].update(topics)
-
-            print(f"[{time.ctime()}] SERVICE {service} ONLINE")
-
-    def setup(self, first_time: bool = True):
+    def describe(self, entry: dict) -> dict:
         """
-        Setup the service
+        Broker and alarm topics of an alarm service
+        :param entry: service of the catalog
         """
-        try:
-            print(f"[{time.ctime()}] EXTRACT info about all the services registered")
-            result: requests.Response = requests.get(
-                url=f"http://{CATALOG_IP_PORT['ip']}:{CATALOG_IP_PORT['port']}/catalog/services/all"
-            )
-            while result.status_code != 200:
-                print(
-                    f"[{time.ctime()}] WARNING no service registered found, retrying after 30 seconds"
-                )
-                time.sleep(30)
-                result: requests.Response = requests.get(
-                    url=f"http://{CATALOG_IP_PORT['ip']}:{CATALOG_IP_PORT['port']}"
-                    f"/catalog/services/all"
-                )
-            print(f"[{time.ctime()}] SERVICES found")
-            data = json.loads(result.content.decode())
-
-            print(
-                f"[{time.ctime()}] EXTRACT from the services list info about Alarm_Temperature"
-            )
-            service_list = [alarm for alarm in data if find_service(alarm)]
-            if len(service_list) == 0:
-                print(f"[{time.ctime()}] No ServiceTemperatureAlarm found... retrying in 10 seconds")
-                time.sleep(10)
-                self.setup(first_time)
-                return
-
-        except KeyboardInterrupt:
-            print(f"[{time.ctime()}] EXIT")
-            if first_time:
-                sys.exit()
-            return
-
-        if first_time:
-            # Connect the service
-            self.service.connect(
-                host=SERVICE_BROKER_PORT["ip"], port=SERVICE_BROKER_PORT["port"]
-            )
-            print(
-                f"[{time.ctime()}] SERVICE CONNECTED to "
-                f"broker: {SERVICE_BROKER_PORT['ip']} "
-                f"on port: port={SERVICE_BROKER_PORT['port']}"
-            )
-            self.service.subscribe(self.chat_id_topic)
-
-        # Update registered services and subscribe to all the topics
-        with self.service_lock:
-            self._update(service_list)
-            self.subscribe(service_list)
-
-        # Register inside the catalog
-        print(f"[{time.ctime()}] PING the Catalog on : {CATALOG_IP_PORT['ip']}")
-        requests.post(
-            f'http://{CATALOG_IP_PORT["ip"]}:{CATALOG_IP_PORT["port"]}/catalog/services',
-            data=SERVICE_INFO,
-            headers={"Content-Type": "application/json"}
-        )
+        mqtt = entry["end_points"]["MQTT"]
+        return {
+            "ip": mqtt["broker"]["ip"],
+            "port": mqtt["broker"]["port"],
+            "topics": {topic for topic in mqtt["subscribe"] if "alarm_temperature" in topic}
+        }
 
-    def start(self):
+    def connecting(self):
         """
-        Start the service.
+        Listen to the chat ids of the users
         """
-        # Setup the service
-        self.setup()
+        self.connections.subscribe(self.broker["ip"], self.broker["port"], [self.chat_id_topic])
 
-        # Start all the external mqtt_clients
-        for broker in self._mqtt_client:
-            self._mqtt_client[broker].loop_start()
+    def started(self):
+        """
+        Deliver the notifications, starting from the ones left by the previous run,
+        and send the digests at the end of every window
+        """
+        self.notifier.start()
+        if DIGEST_POLICY["window"] > 0:
+            self._digest_task = self.scheduler.call_every(DIGEST_POLICY["window"], self.send_digests)
 
-        # Schedule the update of the registration
-        self._update_thread = Timer(60, self.update_registration)
-        self._update_thread.start()
+    def registered(self):
+        """
+        Log the chats, the digests and the deliveries
+        """
+        print(f"[{time.ctime()}] CHATS {self.chats.report()}")
+        print(f"[{time.ctime()}] DIGEST {self.digest.report()}")
+        print(f"[{time.ctime()}] NOTIFY {self.notifier.report()}")
 
-        try:
-            # Run the service forever
-            self.service.loop_forever()
-        except KeyboardInterrupt:
-            self.stop()
+    def stopping(self):
+        """
+        Queue the digests of the last window, stop the deliveries and close the chats
+        """
+        if self._digest_task is not None:
+            self._digest_task.cancel()
+        self.send_digests()
+        self.notifier.stop()
+        self.chats.close()
 
     def my_on_message(self, client: Client, userdata: Any, msg: MQTTMessage):
         """
-        Receive new chat ids. Receive alarm status and check if it is true. If so, send messages
-        via Telegram Bot.
+        Receive new chat ids, with the devices they are subscribed to ({"chat_id": .., "devices": [..]},
+        without devices for all of them, {"chat_id": .., "removed": true} to remove a chat). Receive alarm
+        status and check if it is true. If so, add it to the digest of every chat subscribed to the device,
+        that is sent in background via Telegram Bot at the end of the window.
         :param client: MQTT client
         :param userdata: They could be any type
         :param msg: MQTT message
         """
         data = json.loads(msg.payload.decode())
         if msg.topic == self.chat_id_topic:
-            with self.char_id_lock:
-                self.chat_id_list.add(data["chat_id"])
+            try:
+                chat_id = chat_id_of(data["chat_id"])
+            except (KeyError, ValueError) as error:
+                print(f"[{time.ctime()}] WARNING chat ignored, wrong chat id ({error})")
+                return
+            if data.get("removed"):
+                if self.chats.remove(chat_id):
+                    self.digest.forget([chat_id])
+                    print(f"[{time.ctime()}] CHAT_ID {chat_id} REMOVED")
+            elif self.chats.subscribe(chat_id, data.get("devices")):
+                devices = self.chats.devices(chat_id)
+                subscription = sorted(devices) if devices else "ALL THE DEVICES"
+                print(f"[{time.ctime()}] CHAT_ID {chat_id} SUBSCRIBED TO {subscription}")
             return
 
         if data["alarm"]:
-            message_body = f"{data['device']} is out of range of good functioning{SIGNATURE}"
-            with self.char_id_lock:
-                for chat_id in self.chat_id_list:
-                    self.bot.sendMessage(chat_id=chat_id, text=message_body)
-                    print(f"[{time.ctime()}] TELEGRAM MESSAGE SENT TO CHAT_ID: {chat_id}")
+            self.digest.add(data["device"], self.chats.recipients(data["device"]))
+            if DIGEST_POLICY["window"] <= 0:
+                self.send_digests()
         else:
             return
 
-    def update_registration(self):
+    def send_digests(self):
         """
-        Update service registration to the catalog
+        Queue a message for every chat with a digest
         """
-        print(f"[{time.ctime()}] EXTRACT info about all the services registered")
-        result: requests.Response = requests.get(
-            url=f"http://{CATALOG_IP_PORT['ip']}:{CATALOG_IP_PORT['port']}/catalog/services/all"
-        )
-
-        # No device found
-        if result.status_code != 200:
-            self.reset()
-            return
-
-        data = json.loads(result.content.decode())
-        service_list = [alarm for alarm in data if find_service(alarm)]
-        if len(service_list) == 0:
-            self.reset()
-            return
-
-        # New Devices Found
-        new_services = {alarm["serviceID"] for alarm in service_list}
-        # Old devices list
-        old_services = set(self._service_list.keys())
-
-        # Check if there are update to do
-        if old_services == new_services:
-            # No update, ping the catalog
-            print(f"[{time.ctime()}] PING the Catalog on : {CATALOG_IP_PORT['ip']}")
-            requests.post(
-                f'http://{CATALOG_IP_PORT["ip"]}:{CATALOG_IP_PORT["port"]}/catalog/services',
-                data=SERVICE_INFO,
-                headers={"Content-Type": "application/json"}
-            )
-            self._update_thread = Timer(60, self.update_registration)
-            self._update_thread.start()
-            return
+        for devices, chat_ids in self.digest.flush():
+            text = digest_text(devices)
+            for chat_id in chat_ids:
+                if not self.notifier.submit("telegram", {"chat_id": chat_id, "text": text}):
+                    print(f"[{time.ctime()}] WARNING message for {chat_id} not queued, too many notifications pending")
 
-        with self.service_lock:
-            # Delete inactive devices
-            delete_list = {
-                alarm: self._service_list[alarm]
-                for alarm in self._service_list
-                if alarm not in new_services
-            }
-            # Unsubscribe from devices
-            self.unsubscribe(delete_list)
-
-            # Update registered devices and subscribe
-            new_services = [
-                alarm
-                for alarm in service_list
-                if alarm["serviceID"] not in old_services
-            ]
-
-            self._update(new_services)
-            self.subscribe(new_services)
-
-        self._update_thread = Timer(60, self.update_registration)
-        self._update_thread.start()
-
-    def reset(self):
+    def send_message(self, notification: dict):
         """
-        Reset the service
+        Send a message via Telegram Bot
+        :param notification: chat id and text {"chat_id": .., "text": ..}
         """
-        with self.service_lock:
-            self._clear()
-        self.setup(first_time=False)
-        # Start all the external mqtt_clients
-        for broker in self._mqtt_client:
-            self._mqtt_client[broker].loop_start()
-        self._update_thread = Timer(60, self.update_registration)
-        self._update_thread.start()
-
-    def unsubscribe(self, service_list: dict):
-        """
-        Unsubscribe from services
-        :param service_list: service list
-        """
-        for alarm in service_list:
-            print(f"[{time.ctime()}] SERVICE {alarm} OFFLINE")
-            broker = service_list[alarm]["ip"]
-            topics = service_list[alarm]["topics"]
-
-            if broker == SERVICE_BROKER_PORT["ip"]:
-                for topic in topics:
-                    self.service.unsubscribe(topic)
-                    print(f"[{time.ctime()}] UNSUBSCRIBED from : {topic}")
-
-            else:
-                for topic in topics:
-                    self._mqtt_client[broker].unsubscribe(topic)
-                    print(f"[{time.ctime()}] UNSUBSCRIBED from : {topic}")
-
-            # Update topics
-            self._topic[broker] = self._topic[broker].difference(topics)
-
-            # Disconnect from external broker
-            if len(self._topic[broker]) == 0:
-                if broker != SERVICE_BROKER_PORT["ip"]:
-                    self._mqtt_client[broker].disconnect()
-                    self._mqtt_client[broker].loop_stop()
-                    print(f"[{time.ctime()}] DISCONNECTED from broker: {broker}")
-                    del self._mqtt_client[broker]
-
-                # Clean
-                del self._topic[broker]
-                del self._broker_port[broker]
-
-            # Delete device
-            del self._service_list[alarm]
-            self._broker[broker].discard(alarm)
-
-    def subscribe(self, service_list: List[dict]):
-        """
-        Subscribe to services
-        :param service_list: list of services
-        """
-        for alarm in service_list:
-            broker = alarm["end_points"]["MQTT"]["broker"]["ip"]
-            topics = {
-                topic
-                for topic in alarm["end_points"]["MQTT"]["subscribe"]
-            }
-            # Subscribe to topics
-            if broker == SERVICE_BROKER_PORT["ip"]:
-                for topic in topics:
-                    self.service.subscribe(topic)
-                    print(f"[{time.ctime()}] SUBSCRIBED to : {topic}")
-
-            # Connect to external brokers
-            else:
-                if broker in self._mqtt_client:
-                    # Connection already made
-                    for topic in topics:
-                        self._mqtt_client[broker].subscribe(topic)
-                        print(f"[{time.ctime()}] SUBSCRIBED to : {topic}")
-                else:
-                    # Connect to the broker
-                    self._mqtt_client[broker] = Client(
-                        f"EmailAlarmService{randrange(1, 1000000)}"
-                    )
-                    self._mqtt_client[broker].on_message = self.my_on_message
-
-                    self._mqtt_client[broker].connect(
-                        host=broker, port=self._broker_port[broker]
-                    )
-
-                    for topic in topics:
-                        self._mqtt_client[broker].subscribe(topic)
-                        print(f"[{time.ctime()}] SUBSCRIBED to : {topic}")
-
-    def _clear(self):
-        """
-        Clear all the data stored
-        """
-        # Unsubscribe from all topics
-        self.unsubscribe(self._service_list.copy())
-
-        # Disconnect from all the external brokers
-        for broker in self._mqtt_client:
-            self._mqtt_client[broker].disconnect()
-            self._mqtt_client[broker].loop_stop()
-            print(f"[{time.ctime()}] DISCONNECTED from broker: {broker}")
-
-        # Clear
-        self._mqtt_client.clear()
-        self._service_list.clear()
-        self._broker.clear()
-        self._broker_port.clear()
-        self._topic.clear()
-
-    def stop(self):
-        """
-        Stop the service
-        """
-        # Stop the schedule
-        self._update_thread.cancel()
-
-        # Wait for the threads to finish
-        if self._update_thread.is_alive():
-            self._update_thread.join()
-
-        # Disconnect the clients
-        print(f"[{time.ctime()}] SHUTTING DOWN")
-        for client in self._mqtt_client:
-            self._mqtt_client[client].disconnect()
-            self._mqtt_client[client].loop_stop()
-        # Disconnect the service
-        self.service.disconnect()
-        print(f"[{time.ctime()}] EXIT")
-
+        chat_id = notification["chat_id"]
+        try:
+            self.bot.sendMessage(chat_id=chat_id, text=notification["text"])
+        except Unauthorized:
+            # The user blocked the bot, or the bot was removed from the group
+            if self.chats.remove(chat_id):
+                print(f"[{time.ctime()}] CHAT_ID {chat_id} REMOVED, the bot can't write to it")
+            raise
+        except ChatMigrated as error:
+            # The group became a supergroup with a new id, the subscription follows it
+            if chat_id in self.chats:
+                self.chats.subscribe(error.new_chat_id, self.chats.devices(chat_id))
+                self.chats.remove(chat_id)
+            chat_id = error.new_chat_id
+            self.bot.sendMessage(chat_id=chat_id, text=notification["text"])
+        print(f"[{time.ctime()}] TELEGRAM MESSAGE SENT TO CHAT_ID: {chat_id}")
 
 # -----------------------------------------------------------------------------------------------------------
 
 
 if __name__ == "__main__":
+    register_defaults("notify", NOTIFY_POLICY)
+    register_defaults("telegram", TELEGRAM_POLICY)
+    register_defaults("digest", DIGEST_POLICY)
+    settings = load_settings()
+    CATALOG_IP_PORT.update(settings["catalog"])
+    NOTIFY_POLICY.update(settings["notify"])
+    TELEGRAM_POLICY.update(settings["telegram"])
+    DIGEST_POLICY.update(settings["digest"])
+    SERVICE_BROKER_PORT.update(discover_broker(CATALOG_IP_PORT, session=catalog_client(CATALOG_IP_PORT).session))
+    profile_from_env()
     service = Service()
     service.start()
@@ -22,6 +22,9 @@ import json
 from paho.mqtt.client import Client
 from prompt_toolkit.shortcuts import input_dialog
 
+# Internals
+from configuration.loader import discover_broker, load_settings
+
 # -----------------------------------------------------------------------------
 
 SERVICE_BROKER_PORT = {"ip": "test.mosquitto.org", "port": 1883}
@@ -40,10 +43,16 @@ def main():
                  ' telegram chat id .. to obtain it go to '
                  'https://telegram.me/get_id_bot:').run()
     )
-    client.publish(topic=SERVICE_TOPIC, payload=json.dumps({"chat_id": chat_id}))
+    devices = input_dialog(
+        title='Devices',
+        text='Type the devices whose alarms you want to receive, separated by commas,'
+             ' or leave empty for all of them:').run() or ""
+    devices = [device.strip() for device in devices.split(",") if device.strip()]
+    client.publish(topic=SERVICE_TOPIC, payload=json.dumps({"chat_id": chat_id, "devices": devices}))
     client.loop_stop()
     client.disconnect()
 
 
 if __name__ == "__main__":
+    SERVICE_BROKER_PORT.update(discover_broker(load_settings()["catalog"]))
     main()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark of the service
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import argparse
+from contextlib import redirect_stdout
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+from threading import Event, Thread
+import time
+from typing import Any, List, Optional
+
+# Third Party
+from paho.mqtt.client import Client, MQTTMessage
+import requests
+
+# Internals
+from configuration.loader import discover_broker, settings
+import service_alarm_main as service_main
+from fake_device_main import FAKE_DEVICE_ID, UPDATE_BODY
+from mqtt_broker.broker import running_broker
+
+# -----------------------------------------------------------------------------
+
+#############
+# CONSTANTS #
+#############
+
+TELEMETRY_TOPIC = f"{UPDATE_BODY['ED']['S'][0]}/{FAKE_DEVICE_ID}"
+"""Topic on which the device sends its temperature"""
+
+PUBLISH_INTERVAL = 0.05
+"""Seconds between two temperatures sent by the device"""
+
+# -----------------------------------------------------------------------------
+
+###########
+# HELPERS #
+###########
+
+
+def free_port() -> int:
+    """
+    Port not in use on the loopback interface
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_catalog(port: int, broker_port: int, db: str) -> subprocess.Popen:
+    """
+    Run the catalog REST server in a subprocess
+
+    :param port: port of the catalog
+    :param broker_port: port of the local broker advertised by the catalog
+    :param db: database of the catalog
+    :return: the catalog process
+    """
+    return subprocess.Popen(
+        [
+            sys.executable, "catalog_main.py",
+            "--broker", f"127.0.0.1:{broker_port}",
+            "--set", "server.host=127.0.0.1",
+            "--set", f"server.port={port}",
+            "--set", f"server.db={db}",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+
+
+def register_device(port: int, broker_port: int, timeout: float) -> float:
+    """
+    Wait for the catalog to answer and register the device in it
+
+    :param port: port of the catalog
+    :param broker_port: port of the broker of the device
+    :param timeout: seconds to wait for the catalog
+    :return: time at which the device has been registered
+    """
+    body = {**UPDATE_BODY, "IP": "127.0.0.1", "P": broker_port}
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.post(f"http://127.0.0.1:{port}/catalog/devices", json=body, timeout=1).status_code == 200:
+                return time.monotonic()
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.05)
+    raise TimeoutError("catalog not started")
+
+
+class Probe(service_main.Service):
+    """
+    Service that records when it is connected and when it handles the first message
+    """
+
+    def __init__(self):
+        """
+        Instantiate the service
+        """
+        super().__init__()
+        self.message_handled = Event()
+        self.connected_at = self.handled_at = None
+        on_connect = self.service.on_connect
+
+        def probe_on_connect(client: Client, userdata: Any, flags: dict, rc: int):
+            if self.connected_at is None:
+                self.connected_at = time.monotonic()
+            on_connect(client, userdata, flags, rc)
+
+        self.service.on_connect = probe_on_connect
+
+    def my_on_message(self, client: Client, userdata: Any, msg: MQTTMessage):
+        """
+        Handle the message and record the first one sent by the device
+
+        :param client: MQTT client
+        :param userdata: They could be any type
+        :param msg: MQTT message
+        """
+        super().my_on_message(client, userdata, msg)
+        if msg.topic == TELEMETRY_TOPIC and self.handled_at is None:
+            self.handled_at = time.monotonic()
+            self.message_handled.set()
+
+# -----------------------------------------------------------------------------
+
+#############
+# BENCHMARK #
+#############
+
+
+def bench(delay: Optional[float], timeout: float, stalled: bool = False) -> dict:
+    """
+    Measure the startup of the service, from the broker discovery as in __main__
+
+    :param delay: seconds after which the catalog is started, None if it is running before the service
+    :param timeout: seconds to wait for the first message
+    :param stalled: until the catalog is started its port accepts connections without ever answering
+    """
+    with running_broker() as broker, tempfile.TemporaryDirectory() as folder:
+        port = free_port()
+        service_main.CATALOG_IP_PORT.update({"ip": "127.0.0.1", "port": port})
+        # Broker of the configuration, used when the discovery fails
+        settings["broker"].update({"ip": "127.0.0.1", "port": broker.port})
+        catalog = silent = None
+        device = Client(f"Bench{FAKE_DEVICE_ID}")
+        device.connect("127.0.0.1", broker.port)
+        device.loop_start()
+        try:
+            if delay is None:
+                catalog = start_catalog(port, broker.port, os.path.join(folder, "catalog.db"))
+                register_device(port, broker.port, timeout)
+            elif stalled:
+                silent = socket.socket()
+                silent.bind(("127.0.0.1", port))
+                silent.listen(64)
+
+            start = time.monotonic()
+            service_main.SERVICE_BROKER_PORT.update(discover_broker(service_main.CATALOG_IP_PORT))
+            discovered = time.monotonic()
+            service = Probe()
+            Thread(target=service.start, name="Service", daemon=True).start()
+
+            registered = None
+            if delay is not None:
+                time.sleep(delay)
+                if silent is not None:
+                    silent.close()
+                catalog = start_catalog(port, broker.port, os.path.join(folder, "catalog.db"))
+                registered = register_device(port, broker.port, timeout)
+
+            # The device sends its temperature until the service handles it
+            deadline = time.monotonic() + timeout
+            while not service.message_handled.is_set() and time.monotonic() < deadline:
+                device.publish(
+                    TELEMETRY_TOPIC,
+                    payload=json.dumps({"n": "temperature", "v": 25.3, "u": "Cel", "t": time.time()})
+                )
+                service.message_handled.wait(PUBLISH_INTERVAL)
+            service.stop()
+        finally:
+            device.disconnect()
+            device.loop_stop()
+            if silent is not None:
+                silent.close()
+            if catalog is not None:
+                catalog.terminate()
+                catalog.wait()
+
+    def elapsed(moment: Optional[float]) -> Optional[float]:
+        return None if moment is None else round((moment - start) * 1e3, 3)
+
+    return {
+        "catalog_delay_s": delay,
+        "discovery_ms": elapsed(discovered),
+        "connected_ms": elapsed(service.connected_at),
+        "device_registered_ms": elapsed(registered),
+        "first_message_ms": elapsed(service.handled_at),
+    }
+
+
+def summary(results: List[dict], key: str) -> Optional[dict]:
+    """
+    Summarize a measure over the runs
+
+    :param results: results of the runs
+    :param key: measure to summarize
+    """
+    values = [result[key] for result in results if result[key] is not None]
+    if not values:
+        return None
+    return {"min": min(values), "median": round(statistics.median(values), 3), "max": max(values)}
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse the command line
+
+    :param argv: arguments, default sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Startup time of the service to the first message handled")
+    parser.add_argument("--delay", type=float, default=3.0,
+                        help="seconds after which the catalog is started in the late and stalled catalog scenarios")
+    parser.add_argument("--runs", type=int, default=3, help="runs of each scenario")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for the first message")
+    parser.add_argument("--output", help="file in which store the report, default stdout")
+    parser.add_argument("--history", help="JSON lines file to which append the report")
+    return parser.parse_args(argv)
+
+
+def main():
+    """
+    Run the benchmark and store the report
+    """
+    args = parse_args()
+    report = {"timestamp": time.time(), "results": {}}
+    for scenario, delay, stalled in (
+        ("catalog_up", None, False), ("catalog_late", args.delay, False), ("catalog_stalled", args.delay, True)
+    ):
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            runs = [bench(delay, args.timeout, stalled) for _ in range(args.runs)]
+        report["results"][scenario] = {
+            "runs": runs,
+            "discovery_ms": summary(runs, "discovery_ms"),
+            "connected_ms": summary(runs, "connected_ms"),
+            "first_message_ms": summary(runs, "first_message_ms"),
+        }
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.history:
+        with open(args.history, "a") as fp:
+            fp.write(json.dumps(report) + "\n")
+
+
+# -----------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the Telegram fan-out
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+    Copyright 2020 Angelo Cutaia
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+        http://www.apache.org/licenses/LICENSE-2.0
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import argparse
+from contextlib import redirect_stdout
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+# Internals
+from chats.bot import StandInBot
+from notify.dispatcher import Dispatcher
+from runtime.scheduler import Scheduler
+
+# -----------------------------------------------------------------------------
+
+###########
+# HELPERS #
+###########
+
+
+def chat_ids(chats: int, groups: float) -> List[int]:
+    """
+    Build the ids of the chats, groups have negative ids
+    :param chats: number of chats
+    :param groups: fraction of the chats that are groups
+    """
+    first_group = chats - int(chats * groups)
+    return [index + 1 if index < first_group else -(index + 1) for index in range(chats)]
+
+
+def percentiles(latencies: List[float]) -> Dict[str, float]:
+    """
+    Percentiles of the latencies, as notify.dispatcher.Channel.percentiles
+    :param latencies: seconds
+    """
+    samples = sorted(latencies)
+    return {
+        name: samples[min(len(samples) - 1, int(len(samples) * fraction))]
+        for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))
+    }
+
+# -----------------------------------------------------------------------------
+
+#############
+# BENCHMARK #
+#############
+
+
+def bench(chats: int, args: argparse.Namespace, baseline: bool) -> dict:
+    """
+    Send the alarms to all the chats through the stand-in bot, and measure the delivery
+    time, the latency of every message and the violations of the rate limits
+    :param chats: chats registered
+    :param args: options of the command line
+    :param baseline: send the messages one after the other, as before the dispatcher
+    """
+    bot = StandInBot(args.latency, global_rate=args.rate, chat_rate=args.chat_rate, group_rate=args.group_rate)
+    ids = chat_ids(chats, args.groups)
+    text = "BenchYUN is out of range of good functioning"
+
+    if baseline:
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(args.alarms):
+            for chat_id in ids:
+                bot.sendMessage(chat_id=chat_id, text=text)
+                latencies.append(time.perf_counter() - start)
+        elapsed = time.perf_counter() - start
+        latency = percentiles(latencies)
+    else:
+        scheduler = Scheduler()
+        dispatcher = Dispatcher(scheduler, capacity=chats * args.alarms, workers=args.concurrency)
+        dispatcher.register(
+            "telegram",
+            lambda payload: bot.sendMessage(chat_id=payload["chat_id"], text=payload["text"]),
+            args.concurrency,
+            rate=args.rate,
+            key="chat_id",
+            key_rate=lambda chat_id: args.group_rate if chat_id < 0 else args.chat_rate
+        )
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            scheduler.start()
+            dispatcher.start()
+            start = time.perf_counter()
+            for _ in range(args.alarms):
+                for chat_id in ids:
+                    dispatcher.submit("telegram", {"chat_id": chat_id, "text": text})
+            while len(dispatcher):
+                time.sleep(0.001)
+            elapsed = time.perf_counter() - start
+            dispatcher.stop()
+            scheduler.stop()
+        latency = dispatcher.latency("telegram")
+
+    return {
+        "mode": "serial" if baseline else "fanout",
+        "chats": chats,
+        "groups": len([chat_id for chat_id in ids if chat_id < 0]),
+        "alarms": args.alarms,
+        "messages": bot.counters["messages"],
+        "latency_ms": args.latency * 1e3,
+        "elapsed_s": round(elapsed, 3),
+        "messages_per_s": round(bot.counters["messages"] / elapsed, 2),
+        **{f"{name}_ms": round(seconds * 1e3, 1) for name, seconds in latency.items()},
+        "global_violations": bot.counters["global_violations"],
+        "chat_violations": bot.counters["chat_violations"],
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse the command line
+    :param argv: arguments, default sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Benchmark of the Telegram fan-out with a stand-in bot")
+    parser.add_argument("--chats", type=int, nargs="+", default=[10, 100, 300], help="numbers of chats to test")
+    parser.add_argument("--groups", type=float, default=0.1, help="fraction of the chats that are groups")
+    parser.add_argument("--alarms", type=int, default=2, help="alarms sent in a row to every chat")
+    parser.add_argument("--latency", type=float, default=0.1, help="mean seconds of a call to the Telegram API")
+    parser.add_argument("--concurrency", type=int, default=8, help="messages sent at the same time")
+    parser.add_argument("--rate", type=float, default=30.0, help="messages per second to all the chats")
+    parser.add_argument("--chat-rate", type=float, default=1.0, help="messages per second to a private chat")
+    parser.add_argument("--group-rate", type=float, default=0.33, help="messages per second to a group")
+    parser.add_argument("--baseline", action="store_true", help="also measure the serial sending")
+    parser.add_argument("--output", help="file in which store the report, default stdout")
+    parser.add_argument("--history", help="JSON lines file to which append the report")
+    return parser.parse_args(argv)
+
+
+def main():
+    """
+    Run the benchmark and store the report
+    """
+    args = parse_args()
+    modes = [True, False] if args.baseline else [False]
+    report = {
+        "timestamp": time.time(),
+        "results": [bench(chats, args, baseline) for chats in args.chats for baseline in modes]
+    }
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.history:
+        with open(args.history, "a") as fp:
+            fp.write(json.dumps(report) + "\n")
+
+
+# -----------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Test the registry of the chats
+
+:author: Angelo Cutaia, Claudio Tancredi
+:copyright: Copyright 2020, Angelo Cutaia, Claudio Tancredi
+..
+
+    Copyright 2020 Angelo Cutaia
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+# Standard Library
+import os
+import tempfile
+import unittest
+
+# Internals
+from chats.registry import ChatRegistry
+
+# -------------------------------------------------------------------------
+
+
+class TestChatRegistry(unittest.TestCase):
+    """
+    Test the recipients of the alarms, the replay of the journal and its compaction
+    """
+
+    def setUp(self):
+        """
+        Journal in a temporary folder
+        """
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.path = os.path.join(folder.name, "chats.journal")
+
+    def reopen(self, registry: ChatRegistry) -> ChatRegistry:
+        """
+        Close a registry and open its journal again, as at a restart
+
+        :param registry: registry to close
+        """
+        registry.close()
+        registry = ChatRegistry(self.path)
+        self.addCleanup(registry.close)
+        return registry
+
+    def lines(self) -> int:
+        """
+        Lines of the journal
+        """
+        with open(self.path) as fp:
+            return len(fp.readlines())
+
+    def test_recipients(self):
+        """
+        Test the chats of a device, computed again after every change
+        """
+        registry = ChatRegistry()
+        registry.subscribe(1)
+        registry.subscribe("2", ["a"])
+        self.assertEqual(registry.recipients("a"), (1, 2))
+        self.assertEqual(registry.recipients("b"), (1,))
+        self.assertFalse(registry.subscribe(2, ["a"]))
+        self.assertTrue(registry.subscribe(2, ["b"]))
+        self.assertEqual(registry.recipients("a"), (1,))
+        self.assertTrue(registry.remove(1))
+        self.assertEqual(registry.recipients("b"), (2,))
+
+    def test_chat_id(self):
+        """
+        Test that a chat id that is not an integer is refused
+        """
+        registry = ChatRegistry()
+        for chat_id in ("abc", True, None, 1.5):
+            with self.assertRaises(ValueError):
+                registry.subscribe(chat_id)
+        self.assertEqual(len(registry), 0)
+
+    def test_replay(self):
+        """
+        Test that the chats and their subscriptions survive a restart
+        """
+        registry = ChatRegistry(self.path)
+        registry.subscribe(1)
+        registry.subscribe(2, ["a", "b"])
+        registry.subscribe(3)
+        registry.remove(3)
+        registry = self.reopen(registry)
+        self.assertEqual(len(registry), 2)
+        self.assertIsNone(registry.devices(1))
+        self.assertEqual(registry.devices(2), {"a", "b"})
+        self.assertNotIn(3, registry)
+
+    def test_truncated_line(self):
+        """
+        Test that a line truncated by a crash is ignored, and the next changes are kept
+        """
+        registry = ChatRegistry(self.path)
+        registry.subscribe(1)
+        registry.close()
+        with open(self.path, "a") as fp:
+            fp.write('{"chat_id": 2, "dev')
+        registry = self.reopen(registry)
+        registry.subscribe(3)
+        registry = self.reopen(registry)
+        self.assertEqual(sorted(registry.recipients("a")), [1, 3])
+
+    def test_compaction(self):
+        """
+        Test that the journal is rewritten with only the current chats
+        """
+        registry = ChatRegistry(self.path, compact_after=2)
+        registry.subscribe(1)
+        registry.subscribe(1, ["a"])
+        self.assertEqual(self.lines(), 2)
+        registry.subscribe(1, ["b"])
+        self.assertEqual(self.lines(), 1)
+        registry.subscribe(2)
+        registry = self.reopen(registry)
+        self.assertEqual(registry.devices(1), {"b"})
+        self.assertIsNone(registry.devices(2))